@@ -0,0 +1,161 @@
+"""Generator of synthetic pyterraform projects, for benchmarks.
+
+The project holds N stacks x M environments, each with a stack.yml, variables
+and terraform files using providers and shared modules, plus a stub terraform
+binary. The AWS credential cache and the terraform version manifest are seeded,
+and the state lock check and the plan cache (reading the remote state version)
+are disabled, so the wrapper never calls AWS nor runs terraform to know its
+version.
+
+The stub terraform prints deterministic output and sleeps FAKE_TF_SLEEP seconds
+(default 0); `plan` prints FAKE_TF_PLAN_RESOURCES resource diffs (default 10).
+
+Usage: python benchmarks/generate.py ROOT [--stacks 20] [--environments 3]
+"""
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+from pathlib import Path
+
+REPO = Path(__file__).absolute().parent.parent
+TF_VERSION = '0.12.21'
+PROFILE = 'bench'
+PROVIDERS = ('aws', 'google', 'random', 'null', 'template', 'tls')
+
+STUB_TERRAFORM = '''#!/bin/sh
+sleep "${FAKE_TF_SLEEP:-0}"
+case "$1" in
+  -v|version) echo "Terraform v%(version)s" ;;
+  plan)
+    for arg in "$@"; do
+      case "$arg" in -out=*) echo plan > "${arg#-out=}" ;; esac
+    done
+    awk -v n="${FAKE_TF_PLAN_RESOURCES:-10}" 'BEGIN {
+      for (i = 0; i < n; i++) {
+        printf "module.m%%d.aws_instance.this: Refreshing state... [id=i-%%08d]\\n", i, i
+      }
+      print "\\nTerraform will perform the following actions:\\n"
+      for (i = 0; i < n; i++) {
+        printf "  # module.m%%d.aws_instance.this will be updated in-place\\n", i
+        printf "  ~ resource \\"aws_instance\\" \\"this\\" {\\n"
+        printf "        ami           = \\"ami-%%08d\\"\\n", i
+        printf "        id            = \\"i-%%08d\\"\\n", i
+        printf "      ~ instance_type = \\"t2.micro\\" -> \\"t3.micro\\"\\n"
+        printf "        tags          = {}\\n    }\\n\\n"
+      }
+      printf "Plan: 0 to add, %%d to change, 0 to destroy.\\n", n
+    }' ;;
+  *) echo "terraform $*" ;;
+esac
+'''
+
+
+def write(path, text):
+    """Write a file, creating its folder"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def module_source(index):
+    """Terraform source of a shared module"""
+    return (f'variable "name" {{}}\n\n'
+            f'resource "null_resource" "m{index}" {{\n'
+            f'  triggers = {{\n    name = var.name\n  }}\n}}\n\n'
+            f'output "id" {{\n  value = null_resource.m{index}.id\n}}\n')
+
+
+def stack_source(rng, modules, providers, files):
+    """Terraform files of a stack, as {name: content}"""
+    sources = {'providers.tf': ''.join(
+        f'provider "{name}" {{\n  version = "~> {rng.randint(1, 3)}.{rng.randint(0, 9)}"\n}}\n\n'
+        for name in rng.sample(PROVIDERS, providers))}
+    for index in range(files):
+        blocks = list()
+        for module in rng.sample(range(modules), min(modules, 3)):
+            blocks.append(f'module "m{index}_{module}" {{\n'
+                          f'  source = "../../modules/m{module}"\n'
+                          f'  name   = "${{var.stack}}-{index}"\n}}\n')
+        blocks.append(f'module "registry{index}" {{\n'
+                      f'  source  = "terraform-aws-modules/vpc/aws"\n'
+                      f'  version = "2.{rng.randint(0, 40)}.0"\n}}\n')
+        blocks.append(f'resource "null_resource" "r{index}" {{\n'
+                      f'  triggers = {{\n    plan = <<EOT\nline ${{var.stack}}\nEOT\n  }}\n}}\n')
+        sources[f'main{index}.tf'] = '\n'.join(blocks)
+    sources['variables.tf'] = 'variable "stack" {}\nvariable "environment" {}\n'
+    return sources
+
+
+def seed_credentials(root):
+    """Fresh credential cache of the bench profile, as the wrapper would write it"""
+    key = hashlib.sha1(f'{PROFILE}|None|None'.encode()).hexdigest()
+    path = root / '.run' / f'credentials_{PROFILE}_{key[:12]}.json'
+    write(path, json.dumps({'access_key': 'AKIABENCHMARK', 'secret_key': 'secret',
+                            'token': None, 'region': 'eu-west-1',
+                            'expiry': time.time() + 10 * 365 * 86400,
+                            'created': time.time()}))
+    path.chmod(0o600)
+
+
+def seed_manifest(root):
+    """Version manifest knowing the stub terraform, so it is never run to get its version"""
+    sys.path.insert(0, str(REPO))
+    from pyterraform.terraform.binaries import VersionManifest  # pylint: disable=import-outside-toplevel
+    VersionManifest(root / 'cache').record(TF_VERSION, root / 'terraform')
+
+
+def generate(root, stacks=20, environments=3, modules=10, files=4, providers=3, seed=0):
+    """Create a synthetic project under root, return the path of its first stack"""
+    rng = random.Random(seed)
+    root = Path(root).absolute()
+    write(root / 'pyterraform' / 'pyterraform.yml',
+          f'tf_version: {TF_VERSION}\n'
+          f'tf_binary_cache: {root / "cache"}\n'
+          f'plugin_cache_dir: {root / "plugin-cache"}\n'
+          # hermetic: no lookup of the state lock or of the remote state version
+          'state_lock_check: false\n'
+          'plan_cache: false\n')
+    write(root / 'pyterraform' / 'state.yml',
+          f'profile: {PROFILE}\n'
+          'backend:\n  s3:\n'
+          '    bucket: bench-{stack}\n'
+          '    key: "{stack}/{environment}/terraform.tfstate"\n'
+          '    dynamodb_table: bench-lock\n')
+    for index in range(modules):
+        write(root / 'modules' / f'm{index}' / 'main.tf', module_source(index))
+    for stack in range(stacks):
+        for environment in range(environments):
+            folder = root / f'stack{stack:03d}' / f'env{environment}'
+            write(folder / 'stack.yml',
+                  'vars:\n' + ''.join(f'  var{x}: "value{x}"\n' for x in range(5)))
+            for name, text in stack_source(rng, modules, providers, files).items():
+                write(folder / name, text)
+    write(root / 'bin' / 'terraform', STUB_TERRAFORM % {'version': TF_VERSION})
+    (root / 'bin' / 'terraform').chmod(0o755)
+    if os.path.lexists(root / 'terraform'):
+        (root / 'terraform').unlink()
+    (root / 'terraform').symlink_to(root / 'bin' / 'terraform')
+    seed_credentials(root)
+    seed_manifest(root)
+    return root / 'stack000' / 'env0'
+
+
+def main():
+    """Generate a project from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='Folder of the project to create')
+    parser.add_argument('--stacks', type=int, default=20)
+    parser.add_argument('--environments', type=int, default=3)
+    parser.add_argument('--modules', type=int, default=10)
+    parser.add_argument('--files', type=int, default=4, help='Terraform files per stack')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.root, args.stacks, args.environments, args.modules, args.files,
+                   seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Benchmark suite of the wrapper overhead, on a synthetic project.
+
+Each case runs the cli as users do, several times, and records wall times;
+cases also record the phase timings of the wrapper from its trace summary.
+Results are written as json (default benchmarks/results/<commit>.json), to be
+compared with the ones of another commit with --compare.
+
+Usage: python benchmarks/run.py [--runs 5] [--stacks 20] [--compare OLD.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+from generate import REPO, generate
+
+
+class Bench:
+    """Runner of wrapper commands into the synthetic project"""
+
+    def __init__(self, root, runs):
+        self.root = root
+        self.stack = root / 'stack000' / 'env0'
+        self.runs = runs
+        self.env = dict(os.environ, PYTHONPATH=str(REPO), TF_IN_AUTOMATION='1')
+        self.env.pop('PYTERRAFORM_TRACE', None)
+
+    def call(self, args, cwd=None, env=None):
+        """Run the wrapper once, return (seconds, trace summary)"""
+        trace = self.root / '.bench-trace.json'
+        command = [sys.executable, '-m', 'pyterraform', '--trace', str(trace)] + args
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd or self.stack, env=dict(self.env, **(env or {})),
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        with open(f'{trace}.summary.json') as _f:
+            return elapsed, json.load(_f)
+
+    def case(self, args, prepare=None, **kwargs):
+        """Time runs of a command, prepare() being called before each run"""
+        times, phases = list(), dict()
+        for _ in range(self.runs):
+            if prepare:
+                prepare()
+            elapsed, summary = self.call(args, **kwargs)
+            times.append(elapsed * 1000)
+            for name, item in summary.items():
+                phases.setdefault(name, list()).append(item['total_ms'])
+        return {'args': args, 'runs': len(times),
+                'median_ms': round(statistics.median(times), 2),
+                'min_ms': round(min(times), 2), 'max_ms': round(max(times), 2),
+                'phases_median_ms': {name: round(statistics.median(values), 2)
+                                     for name, values in phases.items()}}
+
+    def forget(self, *names):
+        """Preparation removing runtime caches, for cold runs"""
+        def prepare():
+            for name in names:
+                path = self.root / '.run' / name
+                if path.is_dir():
+                    shutil.rmtree(path)
+                elif path.exists():
+                    path.unlink()
+        return prepare
+
+
+def run_suite(bench, jobs):
+    """All the benchmark cases"""
+    results = dict()
+    results['startup_cold'] = bench.case(['version'],
+                                         prepare=bench.forget('config_cache'))
+    results['startup_warm'] = bench.case(['version'])
+    results['config_load'] = bench.case(['version'])['phases_median_ms'].get('config.load')
+    results['stack_discovery_cold'] = bench.case(['list_stacks'], cwd=bench.root,
+                                                 prepare=bench.forget('stack_index.json'))
+    results['stack_discovery_warm'] = bench.case(['list_stacks'], cwd=bench.root)
+    for listing in ('list_providers', 'list_modules'):
+        results[f'{listing}_all_cold'] = bench.case(
+            [listing, '--all'], cwd=bench.root, prepare=bench.forget('hcl_cache.json'))
+        results[f'{listing}_all_warm'] = bench.case([listing, '--all'], cwd=bench.root)
+    resources = 5000
+    plan = bench.case(['plan', '--no-plan-cache'],
+                      env={'FAKE_TF_PLAN_RESOURCES': str(resources)})
+    plan['lines'] = resources * 9 + 5
+    plan['lines_per_s'] = round(plan['lines'] / (plan['median_ms'] / 1000))
+    results['plan_piping'] = plan
+    results['run_all_fanout'] = bench.case(['run-all', '-j', str(jobs), '--', 'version'],
+                                           cwd=bench.root)
+    return results
+
+
+def git_commit():
+    """Current commit of the repository, 'unknown' outside git"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, check=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def median_of(value):
+    """Comparable number of a result"""
+    return value.get('median_ms') if isinstance(value, dict) else value
+
+
+def compare(old, new):
+    """Print the relative change of each case"""
+    print(f"\n{'Case':<28} {old['commit']:>10} {new['commit']:>10}   change")
+    for name, value in new['results'].items():
+        before, after = median_of(old['results'].get(name)), median_of(value)
+        if before is None or after is None:
+            continue
+        change = f'{100 * (after - before) / before:+.1f}%' if before else '-'
+        print(f"{name:<28} {before:>8.1f}ms {after:>8.1f}ms {change:>8}")
+
+
+def main():
+    """Run the suite, write and print results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Runs of each case')
+    parser.add_argument('--stacks', type=int, default=20)
+    parser.add_argument('--environments', type=int, default=3)
+    parser.add_argument('--modules', type=int, default=10)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--output', help='Results file. Defaults to results/<commit>.json')
+    parser.add_argument('--compare', help='Results file of another commit')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='pyterraform-bench-') as tmp:
+        root = Path(tmp) / 'project'
+        generate(root, args.stacks, args.environments, args.modules)
+        bench = Bench(root, args.runs)
+        bench.call(['version'])  # first run, out of the measures
+        results = run_suite(bench, args.jobs)
+    commit = git_commit()
+    document = {'commit': commit, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(), 'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'params': {'runs': args.runs, 'stacks': args.stacks,
+                           'environments': args.environments, 'modules': args.modules,
+                           'jobs': args.jobs},
+                'results': results}
+    output = Path(args.output or REPO / 'benchmarks' / 'results' / f'{commit}.json')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(document, indent=2) + '\n')
+    for name, value in results.items():
+        print(f"{name:<28} {median_of(value) or 0:>8.1f}ms")
+    print(f"\nResults written to {output}")
+    if args.compare:
+        with open(args.compare) as _f:
+            compare(json.load(_f), document)
+
+
+if __name__ == '__main__':
+    main()
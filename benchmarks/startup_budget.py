@@ -0,0 +1,76 @@
+"""Startup budget check of the cli entry point for passthrough subcommands.
+
+Run `pyterraform version` with -X importtime into a throwaway project using a
+stub terraform binary, then fail if heavy modules were imported or if the
+cumulative import time of pyterraform exceeds the budget.
+
+Usage: python benchmarks/startup_budget.py [--budget-ms 100] [--runs 5]
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+REPO = Path(__file__).absolute().parent.parent
+# Modules that passthrough subcommands shall never load
+FORBIDDEN = ('boto3', 'botocore', 'requests', 'urllib3', 'multiprocessing')
+STUB_TERRAFORM = '#!/bin/sh\necho "Terraform v0.12.21"\n'
+
+
+def make_project(root):
+    """A minimal project with one stack and a stub terraform"""
+    (root / 'pyterraform').mkdir()
+    (root / 'pyterraform' / 'pyterraform.yml').write_text(
+        f"tf_version: 0.12.21\ntf_binary_cache: {root / 'cache'}\n")
+    (root / 'stack' / 'env').mkdir(parents=True)
+    (root / 'stack' / 'env' / 'stack.yml').write_text("vars: {}\n")
+    (root / 'bin').mkdir()
+    (root / 'bin' / 'terraform').write_text(STUB_TERRAFORM)
+    (root / 'bin' / 'terraform').chmod(0o755)
+    (root / 'terraform').symlink_to(root / 'bin' / 'terraform')
+    return root / 'stack' / 'env'
+
+
+def importtime(cwd):
+    """Imported modules with their cumulative import time (us), under the
+    'pyterraform' key the total of the wrapper (imported lazily by main)"""
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'pyterraform', 'version'],
+                             cwd=cwd, env=env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, check=True)
+    modules, total = dict(), 0
+    for line in process.stderr.decode().splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            modules[name.strip()] = int(cumulative)
+            if name.startswith(' pyterraform') and not name.startswith('  '):
+                total += int(cumulative)
+    modules['pyterraform'] = total
+    return modules
+
+
+def main():
+    """Check the budget, exit 1 if exceeded"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=100,
+                        help='Maximum cumulative import time of pyterraform')
+    parser.add_argument('--runs', type=int, default=5, help='Best of N runs is checked')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = make_project(Path(tmp))
+        importtime(cwd)  # warm caches, like the binary version manifest
+        runs = [importtime(cwd) for _ in range(args.runs)]
+    failures = sorted({name for run in runs for name in run
+                       if name.split('.')[0] in FORBIDDEN})
+    best = min(run.get('pyterraform', 0) for run in runs) / 1000
+    print(f"pyterraform import time: {best:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    if failures:
+        print(f"Heavy modules imported: {', '.join(failures)}")
+    if failures or best > args.budget_ms:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,21 @@
 
 This script should let run terraform everywhere in a consistent way.
 """
-import os
-import sys
-import logging
-from copy import deepcopy
-
-from . import constants as const
-from .logs import logger
-from . import config
-from . import session
-from . import project
 
 
 def main():
     """Execute pyterraform wrapper."""
-    stack = project.Project()
-    return stack.run()
+    # Imported here, so that the thin daemon client does not load the wrapper
+    import sys  # pylint: disable=import-outside-toplevel
+    from . import trace  # pylint: disable=import-outside-toplevel
+    trace.setup(sys.argv[1:])
+    try:
+        with trace.span('main'):
+            from . import project  # pylint: disable=import-outside-toplevel
+            stack = project.Project()
+            return stack.run()
+    finally:
+        trace.finish()
 
 
 if __name__ == "__main__":
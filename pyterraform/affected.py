@@ -0,0 +1,204 @@
+"""Stacks affected by the changes since a git reference.
+
+Changed files are mapped to stacks through the folder structure; files of local
+modules affect every stack using them, directly or through other modules, as
+told by a reverse dependency graph of local module sources. Configuration files
+of the wrapper affect all the stacks, unless only wrapper-side settings changed."""
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+import yaml
+
+from . import constants as const
+from .logs import logger, get_logger
+from .utils import read_json, write_json
+from .trace import traced
+from .terraform.hcl import tf_files, CACHE_VERSION as SCAN_VERSION
+
+log = get_logger(__name__, 'INFO')  # pylint: disable=invalid-name
+
+# Cached graphs are invalidated by a change of the scanner results too
+GRAPH_VERSION = [1, SCAN_VERSION]
+# Settings of pyterraform.yml which do not change what terraform does
+WRAPPER_SETTINGS = {'log_to_file', 'log_max_mb', 'log_backups', 'log_compress',
+                    'pipe_plan_command', 'tf_binary_cache', 'tf_binary_cache_max_mb',
+                    'tf_binary_cache_max_versions', 'providers_concurrency', 'releases_ttl',
+                    'plan_filters', 'plan_logs', 'plan_cache', 'timeouts', 'plugin_cache_dir',
+                    'plugin_cache_max_mb', 'state_lock_check', 'state_lock_wait'}
+
+
+def git(*args, cwd=None, missing_ok=False):
+    """Output of a git command, exiting on failure (or None, if missing_ok)"""
+    try:
+        return subprocess.run(('git',) + args, cwd=cwd, check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).stdout.decode()
+    except (OSError, subprocess.CalledProcessError) as ex:
+        if missing_ok:
+            return None
+        logger.error("git %s failed: %s", ' '.join(args),
+                     getattr(ex, 'stderr', b'').decode().strip() or ex)
+        sys.exit(const.RC_KO)
+
+
+class ModuleGraph:
+    """Local modules used by each stack and module folder.
+    Direct dependencies of a folder are cached into the runtime folder, with the
+    size and mtime of its terraform files: only changed folders are scanned again."""
+
+    def __init__(self, project):
+        self.project = project
+        self._folders = None
+        self._used = set()
+        self._changed = False
+
+    @property
+    def graph_file(self):
+        """Where direct dependencies are persisted"""
+        return self.project.path.run() / 'module_graph.json'
+
+    @property
+    def folders(self):
+        """Cached direct dependencies, by folder"""
+        if self._folders is None:
+            cache = read_json(self.graph_file, dict())
+            self._folders = cache.get('folders', dict()) \
+                if cache.get('version') == GRAPH_VERSION else dict()
+        return self._folders
+
+    @staticmethod
+    def _key(folder):
+        """Identity of the terraform files of a folder"""
+        key = list()
+        for path in tf_files(folder):
+            stat_ = os.stat(path)
+            key.append([os.path.relpath(path, folder), stat_.st_size, stat_.st_mtime_ns])
+        return key
+
+    def dependencies(self, folders):
+        """Local module folders used directly by each folder; changed ones are scanned at once
+        :rtype: dict"""
+        folders = [str(x) for x in folders]
+        self._used.update(folders)
+        keys = {folder: self._key(folder) for folder in folders}
+        changed = [folder for folder in folders
+                   if self.folders.get(folder, dict()).get('key') != keys[folder]]
+        if changed:
+            for folder, scanned in self.project.tf.scanner.scan_folders(changed).items():
+                modules = set()
+                for module in scanned['modules']:
+                    source = module['source'] or ''
+                    if source.startswith(('./', '../')):
+                        path = (Path(folder) / os.path.dirname(module['file']) / source).resolve()
+                        if path.is_dir():
+                            modules.add(str(path))
+                self.folders[folder] = {'key': keys[folder], 'modules': sorted(modules)}
+            self._changed = True
+        return {folder: self.folders[folder]['modules'] for folder in folders}
+
+    @traced('affected.module_graph')
+    def users(self, stacks):
+        """Reverse dependencies: the stacks using each local module folder, transitively
+        :param dict stacks: stack folders by name
+        :rtype: dict"""
+        stacks = {name: str(Path(path).resolve()) for name, path in stacks.items()}
+        dependencies, todo = dict(), set(stacks.values())
+        while todo:  # one scan by level of nesting
+            dependencies.update(self.dependencies(sorted(todo)))
+            todo = {module for folder in todo for module in dependencies[folder]
+                    if module not in dependencies}
+        users = dict()
+        for name, path in stacks.items():
+            todo, seen = [path], set()
+            while todo:
+                for module in dependencies[todo.pop()]:
+                    if module not in seen:
+                        seen.add(module)
+                        todo.append(module)
+            for module in seen:
+                users.setdefault(module, set()).add(name)
+        if self._changed or self._used != set(self.folders):
+            write_json(self.graph_file,  # dropping folders not used anymore
+                       {'version': GRAPH_VERSION,
+                        'folders': {x: self.folders[x] for x in sorted(self._used)}},
+                       mode=0o644)
+        return users
+
+
+class Affected:
+    """Selection of the stacks changed since a git reference"""
+
+    def __init__(self, project, ref):
+        self.project = project
+        self.ref = ref
+        self.root = project.path.root().resolve()
+        self._base = None
+
+    def changed_files(self):
+        """Paths, relative to the root, of files changed since the merge base of the
+        reference: committed, staged, unstaged and untracked ones"""
+        toplevel = Path(git('rev-parse', '--show-toplevel', cwd=self.root).strip()).resolve()
+        self._base = git('merge-base', self.ref, 'HEAD', cwd=self.root).strip()
+        names = git('diff', '--name-only', '--no-renames', '-z', self._base,
+                    cwd=self.root).split('\0')
+        names += git('ls-files', '--others', '--exclude-standard', '-z', '--full-name',
+                     cwd=self.root).split('\0')
+        changed = set()
+        for name in filter(None, names):
+            try:
+                changed.add((toplevel / name).relative_to(self.root))
+            except ValueError:
+                continue  # outside the project
+        return sorted(changed)
+
+    def _config_changed(self, path):
+        """Whether a change of a wrapper configuration file may change what terraform does:
+        any change of state.yml, a change of pyterraform.yml beyond wrapper settings"""
+        if self.root / path != Path(self.project.path.conf.pyterraform()).resolve():
+            return True
+        old = git('show', f'{self._base}:{path.as_posix()}', cwd=self.root, missing_ok=True)
+        try:
+            with open(self.root / path, encoding='utf-8') as _f:
+                new = yaml.safe_load(_f) or dict()
+        except FileNotFoundError:
+            new = dict()
+        old = yaml.safe_load(old or '') or dict()
+        return any(old.get(key) != new.get(key) for key in set(old) | set(new)
+                   if key not in WRAPPER_SETTINGS)
+
+    @traced('affected.select')
+    def select(self, stacks):
+        """The given stacks affected by the changes
+        :param list stacks: as (meta, path)
+        :rtype: list"""
+        by_name = {'/'.join(meta.values()): Path(path).resolve() for meta, path in stacks}
+        changed = self.changed_files()
+        depth = len(self.project.cfg.pyt.stack_folder_structure)
+        affected, reasons = set(), dict()
+        for path in changed:
+            if path.parts[0] == const.CONF_DIR.name:
+                if self._config_changed(path):
+                    logger.info("'%s' changed, all stacks are affected", path)
+                    return stacks
+                continue
+            parent = path.parts[:-1]
+            if not parent:
+                continue  # files of the root folder
+            for name, folder in by_name.items():
+                # files of the stack, or shared by the stacks under their folder
+                if parent[:depth] == folder.relative_to(self.root).parts[:len(parent)]:
+                    affected.add(name)
+                    reasons.setdefault(name, path)
+        users = ModuleGraph(self.project).users(by_name)
+        for path in changed:
+            absolute = self.root / path
+            for module, names in users.items():
+                if str(absolute).startswith(module + os.sep):
+                    for name in names - affected:
+                        reasons[name] = path
+                    affected |= names
+        for name in sorted(affected):
+            log.info("Stack '%s' affected by '%s'", name, reasons[name])
+        logger.info("%d of %d stacks changed since %s", len(affected), len(stacks), self.ref)
+        return [(meta, path) for meta, path in stacks if '/'.join(meta.values()) in affected]
@@ -1,4 +1,5 @@
 """Parser for cli inputs"""
+import os
 import sys
 import argparse
 from . import constants as const
@@ -24,8 +25,12 @@ def parse_args(project, args):  # pylint: disable=too-many-locals,too-many-state
                         action='store_true', default=False)
     for stack_element in project.cfg.pyt.stack_folder_structure:  # at least stack and environment
         parser.add_argument(f'--{stack_element}',
-                            help='Target stack definition. Autodetected if none is provided.',
+                            help=('Target stack definition. Autodetected if none is provided. '
+                                  'Glob pattern for multi stack subcommands.'),
                             nargs='?')
+    parser.add_argument('--changed-since', metavar='REF',
+                        help=('Select only the stacks affected by the changes since the git '
+                              'reference REF, for multi stack subcommands.'))
     #parser.add_argument('-a', '--account',
     #                    help='Target account. Autodetected if none is provided.',
     #                    nargs='?')
@@ -39,16 +44,41 @@ def parse_args(project, args):  # pylint: disable=too-many-locals,too-many-state
                         action='store_true', default=False)
     parser.add_argument('--unattended', help='For automatic run (like CI).',
                         action='store_true', default=False)
-    parser.add_argument('-p', '--plugin-cache-dir', help='Plugins cache directory.',
-                        default=f'{const.HOME_DIR}/.terraform.d/plugin-cache')
+    parser.add_argument('--trace', metavar='FILE',
+                        help=('Write timings of the wrapper phases as Chrome trace events to FILE, '
+                              'and their summary to FILE.summary.json. Env: PYTERRAFORM_TRACE.'))
+    parser.add_argument('-p', '--plugin-cache-dir',
+                        help=('Plugins cache directory. Defaults to TF_PLUGIN_CACHE_DIR, '
+                              'plugin_cache_dir config or ~/.terraform.d/plugin-cache.'))
 
     subparsers = parser.add_subparsers(dest='subcommand',
                                        help='terraform subcommands plus some pyterraform gotchas')
 
-    subparsers.add_parser('list_modules', help='List modules used by terraform')
-    subparsers.add_parser('list_providers',
-                          help='List providers declared into terraform stack')
-    subparsers.add_parser('local_install', help='Install dependencies required by terraform')
+    parser_list_modules = subparsers.add_parser('list_modules',
+                                                help='List modules used by terraform')
+    parser_list_providers = subparsers.add_parser(
+        'list_providers', help='List providers declared into terraform stack')
+    for parser_list in (parser_list_modules, parser_list_providers):
+        parser_list.add_argument('--json', action='store_true', default=False,
+                                 help='Print a json document.')
+        parser_list.add_argument('--all', action='store_true', default=False,
+                                 help='Scan every stack, filtered by stack options (globs).')
+    subparsers.add_parser('list_stacks',
+                          help='List stacks of the project, filtered by stack options (globs)')
+    parser_outputs = subparsers.add_parser(
+        'outputs', help='Outputs of many stacks, read from their remote states')
+    parser_outputs.add_argument('--stacks',
+                                help=('Comma separated stacks, like a/prod,b/prod (globs). '
+                                      'Defaults to the stacks matching stack options.'))
+    parser_outputs.add_argument('-j', '--jobs', type=int, default=8,
+                                help='Number of states read in parallel.')
+    parser_outputs.add_argument('--json', action='store_true', default=False,
+                                help='Print a json document.')
+    parser_local_install = subparsers.add_parser(
+        'local_install', help='Install dependencies required by terraform')
+    parser_local_install.add_argument(
+        '-j', '--jobs', type=int,
+        help='Number of providers installed in parallel. Defaults to providers_concurrency.')
     parser_apply = subparsers.add_parser('apply', help='terraform apply')
     #parser_apply.add_argument('-u', '--unsafe',
     #                          help='Do not force plan and human interaction before apply.',
@@ -84,9 +114,16 @@ def parse_args(project, args):  # pylint: disable=too-many-locals,too-many-state
     parser_import.add_argument('tf_params', nargs=argparse.REMAINDER, help=tf_params_help)
 
     parser_init = subparsers.add_parser('init', help='terraform init')
+    parser_init.add_argument('--force-init', action='store_true', default=False,
+                             help='Run init even if nothing changed since the last one.')
     parser_init.add_argument('tf_params', nargs=argparse.REMAINDER, help=tf_params_help)
 
     parser_output = subparsers.add_parser('output', help='terraform output')
+    parser_output.add_argument('--terraform', action='store_true', default=False,
+                               help=("Run terraform output, instead of reading the outputs "
+                                     "from the remote state."))
+    parser_output.add_argument('--json', action='store_true', default=False,
+                               help='Print outputs as JSON, like -json.')
     parser_output.add_argument('tf_params', nargs=argparse.REMAINDER, help=tf_params_help)
 
     parser_plan = subparsers.add_parser('plan', help='terraform plan')
@@ -97,11 +134,23 @@ def parse_args(project, args):  # pylint: disable=too-many-locals,too-many-state
     #parser_plan.add_argument("--pipe-plan-command",
     #                         action='store', nargs='?',
     #          help="Pipe plan output to the command of your choice set as argument inline value.")
+    parser_plan.add_argument("--no-plan-cache", action="store_true",
+                             help=("With plan_cache in config, plan even if its inputs did"
+                                   " not change since the last one."))
+    parser_plan.add_argument('--force-init', action='store_true', default=False,
+                             help='With always_trigger_init, run init even if nothing changed.')
     parser_plan.add_argument('tf_params', nargs=argparse.REMAINDER, help=tf_params_help)
 
     parser_providers = subparsers.add_parser('providers', help='terraform providers')
     parser_providers.add_argument('tf_params', nargs=argparse.REMAINDER, help=tf_params_help)
 
+    parser_cache = subparsers.add_parser(
+        'cache', help='Manage the plugin and terraform binary caches')
+    parser_cache.add_argument('action', choices=['stats', 'prune'],
+                              help='Show cache usage, or evict entries beyond the size limit')
+    parser_cache.add_argument('--json', action='store_true', default=False,
+                              help='Print a json document.')
+
     parser_refresh = subparsers.add_parser('refresh', help='terraform refresh')
     parser_refresh.add_argument('tf_params', nargs=argparse.REMAINDER, help=tf_params_help)
 
@@ -127,11 +176,21 @@ def parse_args(project, args):  # pylint: disable=too-many-locals,too-many-state
     #parser_bootstrap.add_argument('template', nargs='?',
     #        help='template to use during bootstrap', default=None)
 
-    #parser_foreach = subparsers.add_parser('foreach', help='execute command for each stack')
-    #parser_foreach.add_argument('-c', dest='shell', action="store_true",
-    #          help='execute command in a shell')
-    #parser_foreach.add_argument('command', nargs=argparse.REMAINDER,
-    #          help='command to execute after a "--" delimiter')
+    parser_run_all = subparsers.add_parser(
+        'run-all', aliases=['foreach'],
+        help='execute a pyterraform subcommand for each stack (filtered by stack options)')
+    parser_run_all.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                                help='Number of stacks run in parallel. Defaults to cpu count.')
+    parser_run_all.add_argument('--timeout', type=int,
+                                help='Seconds after which a stack is terminated.')
+    parser_run_all.add_argument('command', nargs=argparse.REMAINDER,
+                                help='pyterraform subcommand to execute after a "--" delimiter')
+
+    parser_daemon = subparsers.add_parser(
+        'daemon', help='serve pyterraform-client calls from a warm process (foreground)')
+    parser_daemon.add_argument('--socket', help='Unix socket path. Defaults to .run/daemon.sock.')
+    parser_daemon.add_argument('--idle-timeout', type=int, default=3600,
+                               help='Stop after this many seconds without request (0: never).')
 
     #parser_switchver = subparsers.add_parser('switchver', help='switch terraform version')
     #parser_switchver.add_argument('version', nargs=1, help='terraform version to use')
@@ -142,13 +201,10 @@ def parse_args(project, args):  # pylint: disable=too-many-locals,too-many-state
         parser.print_help(file=sys.stderr)
         raise SystemExit(0)
 
-    #if parsed_args.func == foreach:
-    #    if len(parsed_args.command) > 0 and parsed_args.command[0] == '--':
-    #        parsed_args.command = parsed_args.command[1:]
-    #    if len(parsed_args.command) < 1:
-    #        raise ValueError("foreach: error: a command is required")
-    #    if parsed_args.shell and len(parsed_args.command) > 1:
-    #raise ValueError("foreach: error: -c must be followed by a single argument (hint: use quotes)")
-    #    parsed_args.executable = os.environ.get("SHELL", None) if parsed_args.shell else None
+    if parsed_args.subcommand in const.MULTI_STACK_SUBCOMMANDS:
+        if parsed_args.command and parsed_args.command[0] == '--':
+            parsed_args.command = parsed_args.command[1:]
+        if not parsed_args.command:
+            parser.error(f"{parsed_args.subcommand}: a pyterraform subcommand is required")
 
     return parsed_args
@@ -0,0 +1,90 @@
+"""Thin client of the pyterraform daemon.
+
+It only imports the standard modules it needs, so that a call costs little more
+than the interpreter startup. The daemon socket is looked up into the .run folder
+of the project root (or PYTERRAFORM_SOCKET); without daemon, the client execs the
+wrapper itself.
+
+Usage: pyterraform-client <pyterraform arguments>"""
+import os
+import sys
+import json
+import signal
+import socket
+import struct
+
+# Kept in sync with daemon.py, not imported to stay light
+SOCKET_ENV = 'PYTERRAFORM_SOCKET'
+HEADER = struct.Struct('!I')
+REPLY = struct.Struct('!cI')
+ROOT_DEPTH = 5
+
+
+def find_socket():
+    """Daemon socket of the project containing the working directory, None if none"""
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    path = os.getcwd()
+    for _ in range(ROOT_DEPTH):
+        if os.path.isdir(os.path.join(path, 'pyterraform')):
+            socket_path = os.path.join(path, '.run', 'daemon.sock')
+            return socket_path if os.path.exists(socket_path) else None
+        path = os.path.dirname(path)
+    return None
+
+
+def fallback(argv):
+    """Run the wrapper in process, without daemon"""
+    os.execv(sys.executable, [sys.executable, '-m', 'pyterraform'] + argv)
+
+
+def _recv_reply(conn):
+    data = b''
+    while len(data) < REPLY.size:
+        chunk = conn.recv(REPLY.size - len(data))
+        if not chunk:
+            raise ConnectionError("Daemon worker died")
+        data += chunk
+    return REPLY.unpack(data)
+
+
+def main(argv=None):
+    """Send the command to the daemon and wait for its exit code"""
+    argv = sys.argv[1:] if argv is None else argv
+    socket_path = find_socket()
+    if not socket_path:
+        fallback(argv)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        conn.close()
+        fallback(argv)
+    payload = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}).encode()
+    conn.sendmsg([HEADER.pack(len(payload))],
+                 [(socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack('3i', 0, 1, 2))])
+    conn.sendall(payload)
+    kind, worker = _recv_reply(conn)
+    if kind != b'P':
+        raise ConnectionError("Unexpected reply from the daemon")
+
+    def forward(signum, _frame):
+        try:
+            os.killpg(worker, signum)
+        except ProcessLookupError:
+            pass
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, forward)
+    while True:
+        try:
+            kind, returncode = _recv_reply(conn)
+            break
+        except InterruptedError:
+            continue
+        except ConnectionError:
+            return 2
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,7 @@ current working directory and cli options"""
 import os
 import sys
 import copy
+from pathlib import Path
 
 from . import setup
 
@@ -72,6 +73,18 @@ class Configuration:
             if value is not None:
                 os.environ[var] = str(value)
 
+    def get_tf_data_dir(self):
+        """Terraform data directory of the stack"""
+        if self.pyt.get('config.tf_data_dir'):
+            return Path(self.pyt.get('config.tf_data_dir').format(**self.stack.data))
+        return self.project.path.stack() / '.terraform'
+
+    def get_plugin_cache_dir(self):
+        """Terraform plugin cache folder, shared by all the stacks"""
+        return Path(self.project.input.args.get('plugin_cache_dir')
+                    or self.project.input.environment.get('TF_PLUGIN_CACHE_DIR')
+                    or self.pyt.get('config.plugin_cache_dir')).expanduser()
+
     def get_stack_custom_env(self):
         """Custom runtime env. Is it needed?"""
         terraform_vars = dict()
@@ -108,6 +121,7 @@ class Configuration:
         envs = copy.deepcopy(self.project.input.environment)
         if self.pyt.get('config.tf_data_dir'):
             envs['TF_DATA_DIR'] = self.pyt.get('config.tf_data_dir').format(**self.stack.data)
+        envs['TF_PLUGIN_CACHE_DIR'] = str(self.get_plugin_cache_dir())
         #if self.pyt.get('config.tf_plugin_dir'):
         #    cli_args.append(f"-plugin-dir={self.pyt.get('config.tf_plugin_dir')}")
         if command == 'console':
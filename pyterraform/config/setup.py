@@ -1,11 +1,31 @@
 """Configuration object storage for pyterraform and stacks"""
 from abc import ABC, abstractmethod
+import os
 import sys
+import hashlib
+from functools import wraps
 from pathlib import Path
 import yaml
-from schema import Schema, Optional, Or, SchemaError
 from .. import constants as const
 from ..logs import logger
+from ..utils import read_json, write_json
+from ..trace import span
+
+# libyaml parser, when available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # pylint: disable=invalid-name
+# Cached configs are invalidated when this code (and so schemas) changes
+CODE_REVISION = f'{const.VERSION}-{os.stat(__file__).st_mtime_ns}'
+_SCHEMAS = dict()
+
+
+def schema_property(builder):
+    """Property building the schema only once"""
+    @wraps(builder)
+    def wrapper(self):
+        if builder.__qualname__ not in _SCHEMAS:
+            _SCHEMAS[builder.__qualname__] = builder(self)
+        return _SCHEMAS[builder.__qualname__]
+    return property(wrapper)
 
 
 # pylint: disable=too-few-public-methods,missing-function-docstring
@@ -43,6 +63,41 @@ class Setups(ABC):
         """Load data from proper sources"""
         return
 
+    def _cache_file(self, path):
+        """Where the validated content of a config file is cached"""
+        key = hashlib.sha1(str(path).encode()).hexdigest()
+        return self.project.path.run() / 'config_cache' / f'{key}.json'
+
+    def _load_validated(self, path, schema, missing_message):
+        """Load a yaml file validated by the named schema property.
+        The validated data is cached by file path, size, mtime and content hash:
+        on a cache hit, neither yaml parsing nor validation happen."""
+        with span('config.load', file=os.path.basename(str(path))):
+            try:
+                with open(path, 'rb') as _f:
+                    stat_, content = os.fstat(_f.fileno()), _f.read()
+                key = {'path': str(path), 'size': stat_.st_size, 'mtime_ns': stat_.st_mtime_ns,
+                       'sha256': hashlib.sha256(content).hexdigest(), 'code': CODE_REVISION}
+            except FileNotFoundError:
+                logger.warning(missing_message)
+                content = None
+                key = {'path': str(path), 'size': None, 'code': CODE_REVISION}
+            cached = read_json(self._cache_file(path), memo=True)
+            if cached and cached.get('key') == key:
+                return cached['data']
+            config = dict()
+            if content is not None:
+                logger.debug("Loading config from '%s'", path)
+                config = yaml.load(content, Loader=YamlLoader)
+            from schema import SchemaError  # pylint: disable=import-outside-toplevel
+            try:
+                data = getattr(self, schema).validate(config)
+            except SchemaError as ex:
+                logger.error('Configuration error in %s : %s', path, ex)
+                sys.exit(const.RC_KO)
+            write_json(self._cache_file(path), {'key': key, 'data': data})
+            return data
+
 
 class Pyterraform(Setups):
     """Set up of pyterraform wrapper"""
@@ -57,9 +112,10 @@ class Pyterraform(Setups):
     def stack_folder_structure(self):
         """Structure of folder"""
         return self._get('config.folder_structure').split('.')
-    @property
+    @schema_property
     def _state_schema(self):
         """Schema validation and defaults"""
+        from schema import Schema, Optional  # pylint: disable=import-outside-toplevel
         return Schema( \
     {Optional('profile'): str,
      Optional('region'): str,
@@ -68,53 +124,50 @@ class Pyterraform(Setups):
          'bucket': str,
          'key': str,
          'dynamodb_table': str,
-         Optional('acl', default='private'): str}}})
+         Optional('acl', default='private'): str,
+         Optional('endpoint'): str,
+         Optional('dynamodb_endpoint'): str}}})
 
     def _load_state(self):
         """Load state example"""
-        if not self.project.path.conf.state().is_file():
-            logger.warning("No state configuration file found!")
-            return dict()
-        with self.project.path.conf.state().open() as _f:
-            logger.debug("Loading state config from '%s'", self.project.path.conf.state())
-            config = yaml.safe_load(_f)
-        try:
-            state = self._state_schema.validate(config)
-            return state
-        except SchemaError as ex:
-            logger.error('Configuration error in %s : %s',
-                         self.project.path.conf.state(), ex)
-            sys.exit(const.RC_KO)
+        return self._load_validated(self.project.path.conf.state(), '_state_schema',
+                                    "No state configuration file found!")
 
-    @property
+    @schema_property
     def _config_schema(self):
         """Schema validation and defaults"""
+        from schema import Schema, Optional, Or  # pylint: disable=import-outside-toplevel
         return Schema({ \
     Optional('always_trigger_init', default=False): bool,
+    Optional('log_to_file', default=False): bool,
+    Optional('log_max_mb', default=20): int,
+    Optional('log_backups', default=10): int,
+    Optional('log_compress', default=True): bool,
     Optional('pipe_plan_command', default='cat'): str,
     Optional('folder_structure', default='stack.environment'): str,
     Optional('tf_version', default='0.12.21'): str,
-    Optional('tf_binary_cache', default=Path.home() / '.terraform' / 'binaries'): str,})
+    Optional('tf_binary_cache', default=str(Path.home() / '.terraform' / 'binaries')): str,
+    Optional('tf_binary_cache_max_mb', default=None): Or(int, None),
+    Optional('tf_binary_cache_max_versions', default=10): Or(int, None),
+    Optional('providers_concurrency', default=4): int,
+    Optional('releases_ttl', default=3600): int,
+    Optional('plan_filters', default=[]): [Or('strip_refresh', 'collapse_unchanged')],
+    Optional('plan_logs', default=10): int,
+    Optional('plan_cache', default=False): bool,  # replayed plans do not see drift
+    Optional('timeouts', default={}): {str: int},
+    Optional('state_lock_check', default=True): bool,
+    Optional('state_lock_wait', default=900): int,  # by run-all, for locked stacks
+    Optional('plugin_cache_dir',
+             default=str(Path.home() / '.terraform.d' / 'plugin-cache')): str,
+    Optional('plugin_cache_max_mb', default=4096): Or(int, None),
+    Optional('module_store', default=True): bool,})
 #    Optional('tf_plugin_dir', default='/tmp/terraform.d/plugin'): str,
 #    Optional('tf_data_dir', default='/tmp/terraform.d/data/{stack}/{environment}'): str})
 
     def _load_config(self):
         """Load config example"""
-        try:
-            with self.project.path.conf.pyterraform().open() as _f:
-                logger.debug("Loading pyterraform wrapper config from '%s'",
-                             self.project.path.conf.pyterraform())
-                config = yaml.safe_load(_f)
-        except FileNotFoundError:
-            logger.warning("No pyterraform configuration file found!")
-            config = dict()
-        try:
-            config = self._config_schema.validate(config)
-            return config
-        except SchemaError as ex:
-            logger.error('Configuration error in %s : %s',
-                         self.project.path.conf.pyterraform(), ex)
-            sys.exit(const.RC_KO)
+        return self._load_validated(self.project.path.conf.pyterraform(), '_config_schema',
+                                    "No pyterraform configuration file found!")
 
     #@property
     #def plugin_cache_dir(self):
@@ -134,9 +187,10 @@ class Stack(Setups):
         config = self._load_config()
         self._data = config
 
-    @property
+    @schema_property
     def validation_schema(self):
         """Validate schema structure"""
+        from schema import Schema, Optional, Or  # pylint: disable=import-outside-toplevel
         return Schema( \
         {
             #Optional('state_configuration_name'): str,
@@ -157,28 +211,33 @@ class Stack(Setups):
 
     def _load_config(self):
         """Read stack configuration file, merged with element implicit into the cwd"""
-        try:
-            with self.project.path.stack.config().open() as _f:
-                stack_config = yaml.safe_load(_f)
-        except FileNotFoundError:
-            logger.warning("No stack configuration found!")
-            stack_config = dict()
-        try:
-            stack_config = self.validation_schema.validate(stack_config)
-            stack_config.update(self.project.input.path)
-            return stack_config
-        except SchemaError as ex:
-            logger.error('Configuration error in %s : %s',
-                         self.project.path.stack.config(), ex)
-            sys.exit(const.RC_KO)
+        stack_config = self._load_validated(self.project.path.stack.config(),
+                                            'validation_schema',
+                                            "No stack configuration found!")
+        stack_config.update(self.project.input.path)
+        return stack_config
+
+    def data_of(self, meta, path):
+        """Configuration of another stack, given its folder elements and path"""
+        data = self._load_validated(Path(path) / 'stack.yml', 'validation_schema',
+                                    f"No stack configuration found in {path}!")
+        return dict(data, **meta)
+
+    def backend_for(self, data):
+        """S3 backend configuration, interpolated with the given stack data"""
+        return {key: value.format(**data) for key, value in
+                self.project.cfg.pyt.get('state.backend', {}).get('s3', {}).items()}
+
+    @property
+    def backend(self):
+        """S3 backend configuration, interpolated with stack data"""
+        return self.backend_for(self.data)
 
     @property
     def backend_setup(self):
         """Option for backend setup"""
         params = list()
-        for key, value in \
-                self.project.cfg.pyt.get('state.backend', {}).get('s3', {}).items():
-            value = value.format(**self.data)
+        for key, value in self.backend.items():
             params.extend(['-backend-config', f"{key}={value}"])
             #params.append(f'-backend-config="{key}={value}"')
         return params
@@ -1,4 +1,5 @@
 """Common project's constants"""
+import os
 from pathlib import Path
 import platform
 
@@ -17,14 +18,28 @@ def get_architecture():
 RC_OK = 0
 RC_KO = 1
 RC_UNK = 2
+# the state is locked by someone else
+RC_LOCKED = 3
 
-LIMIT_TERRAFORM_VERSION = 'v0.11.1'
-LIMIT_GITHUB_RELEASES = 42
-GITHUB_RELEASES = 'https://github.com/{}/releases'
+MULTI_STACK_SUBCOMMANDS = ('run-all', 'foreach')
+
+# Release servers, overridable to point to a mirror or a local stand-in
+HASHICORP_RELEASES = os.environ.get('PYTERRAFORM_HASHICORP_RELEASES',
+                                    'https://releases.hashicorp.com')
+GITHUB_BASE = os.environ.get('PYTERRAFORM_GITHUB_BASE', 'https://github.com')
+GITHUB_API = os.environ.get('PYTERRAFORM_GITHUB_API', 'https://api.github.com')
+# AWS endpoint of the state bucket, overridable to point to a local stand-in
+S3_ENDPOINT = os.environ.get('PYTERRAFORM_S3_ENDPOINT')
+DYNAMODB_ENDPOINT = os.environ.get('PYTERRAFORM_DYNAMODB_ENDPOINT')
+# Seconds to wait for a locked state: none by default for a single stack, overriding
+# the state_lock_wait config of run-all
+LOCK_WAIT_ENV = 'PYTERRAFORM_LOCK_WAIT'
 ARCH_NAME = get_architecture()
 PLATFORM_SYSTEM = platform.system().lower()
 
 HOME_DIR = Path.home()
 CONF_DIR = Path('pyterraform')
+# Project root, exported to child wrappers to skip its detection
+ROOT_ENV = 'PYTERRAFORM_ROOT'
 
 CWD = Path.cwd()
@@ -0,0 +1,197 @@
+"""Warm wrapper process serving thin clients over a Unix socket.
+
+The daemon imports the wrapper and its heavy dependencies once, and warms the
+in-memory memos of configs, credentials, stack index and binary manifest. Each
+request is served by a forked worker, which inherits that warm state, takes
+over the standard streams of the client (passed as file descriptors) and runs
+the wrapper as a fresh process would. Memos are keyed by file identity, so a
+worker sees any file changed since the warmup.
+
+Protocol, see client.py: the client sends a length prefixed json message
+{argv, cwd, env} with its stdin, stdout and stderr as SCM_RIGHTS; the worker
+answers with its process group (b'P' + pid) then its exit code (b'R' + code)."""
+import os
+import sys
+import json
+import time
+import array
+import socket
+import select
+import signal
+import struct
+import importlib
+from pathlib import Path
+
+from . import constants as const
+from .logs import logger, stop_listeners
+from .utils import read_json
+
+SOCKET_NAME = 'daemon.sock'
+SOCKET_ENV = 'PYTERRAFORM_SOCKET'
+HEADER = struct.Struct('!I')
+REPLY = struct.Struct('!cI')
+# Warm state is refreshed after this many seconds without request
+WARMUP_PERIOD = 60
+
+
+def recv_request(conn):
+    """Read a request: (message, file descriptors)"""
+    fds = array.array('i')
+    data, ancdata, _, _ = conn.recvmsg(HEADER.size, socket.CMSG_SPACE(3 * fds.itemsize))
+    for level, kind, cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
+    if len(data) < HEADER.size:
+        raise ConnectionError("Truncated request")
+    size, = HEADER.unpack(data)
+    payload = b''
+    while len(payload) < size:
+        chunk = conn.recv(size - len(payload))
+        if not chunk:
+            raise ConnectionError("Truncated request")
+        payload += chunk
+    return json.loads(payload.decode()), list(fds)
+
+
+class Daemon:
+    """Server of wrapper requests for the project"""
+
+    def __init__(self, project):
+        self.project = project
+        self.last_warmup = 0
+
+    @property
+    def args(self):
+        """Just for convenience"""
+        return self.project.input.args
+
+    @property
+    def socket_path(self):
+        """Where the daemon listens"""
+        return Path(self.args.get('socket') or os.environ.get(SOCKET_ENV)
+                    or self.project.path.run() / SOCKET_NAME)
+
+    def warm(self):
+        """Load heavy modules and the memos that workers inherit"""
+        # pylint: disable=import-outside-toplevel,unused-import
+        import boto3
+        import requests
+        from .terraform import download, releases, plan_stream, hcl
+        self.project.path.index.update()
+        read_json(self.project.tf.utils.manifest.file, memo=True)
+        # pylint: disable=protected-access
+        for meta, path in self.project.path.index:
+            try:
+                self.project.cfg.stack._load_validated(
+                    path / 'stack.yml', 'validation_schema', "No stack configuration found!")
+            except SystemExit:
+                logger.warning("Invalid configuration of stack %s", '/'.join(meta.values()))
+        try:
+            self.project.session._get_session().client('s3')
+        except (SystemExit, Exception):  # pylint: disable=broad-except
+            logger.debug("No AWS session to warm up")
+        self.last_warmup = time.time()
+
+    def _bind(self):
+        """Listening socket, replacing a stale one"""
+        path = str(self.socket_path)
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                logger.error("A daemon is already listening on %s", path)
+                sys.exit(const.RC_KO)
+            finally:
+                probe.close()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(old_umask)
+        server.listen(64)
+        return server
+
+    def _serve_one(self, conn, server):
+        """Run one request into a forked worker"""
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        if struct.unpack('3i', creds)[1] != os.getuid():
+            logger.warning("Rejected a client of another user")
+            return
+        message, fds = recv_request(conn)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork():
+            for fd in fds:
+                os.close(fd)
+            return
+        returncode = const.RC_UNK
+        try:
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.setpgrp()  # signals of the client are forwarded to the whole group
+            conn.sendall(REPLY.pack(b'P', os.getpid()))
+            for target, fd in enumerate(fds[:3]):
+                os.dup2(fd, target)
+                os.close(fd)
+            returncode = self._run(message)
+        except SystemExit as ex:
+            returncode = ex.code if isinstance(ex.code, int) else \
+                (const.RC_OK if ex.code is None else const.RC_KO)
+        except BaseException:  # pylint: disable=broad-except
+            logger.exception("Worker failed")
+        finally:
+            try:
+                stop_listeners()  # not run at exit, skipped by _exit
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if returncode and returncode < 0:  # killed child, like a shell tells it
+                    returncode = 128 - returncode
+                conn.sendall(REPLY.pack(b'R', returncode or 0))
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+
+    @staticmethod
+    def _run(message):
+        """Run the wrapper as a fresh process into the client context"""
+        os.chdir(message['cwd'])
+        os.environ.clear()
+        os.environ.update(message['env'])
+        importlib.reload(const)  # settings read from the environment, and the cwd
+        sys.argv = ['pyterraform'] + message['argv']
+        from . import main  # pylint: disable=import-outside-toplevel
+        return main()
+
+    def serve(self):
+        """Serve requests until idle for --idle-timeout seconds"""
+        self.warm()
+        server = self._bind()
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # workers are reaped automatically
+        idle_timeout = self.args.get('idle_timeout')
+        last_request = time.time()
+        logger.info("Daemon listening on %s", self.socket_path)
+        try:
+            while True:
+                ready, _, _ = select.select([server], [], [], WARMUP_PERIOD)
+                if not ready:
+                    if idle_timeout and time.time() - last_request > idle_timeout:
+                        logger.info("Idle for %ss, stopping", idle_timeout)
+                        return const.RC_OK
+                    if time.time() - self.last_warmup > WARMUP_PERIOD:
+                        self.warm()
+                    continue
+                conn, _ = server.accept()
+                last_request = time.time()
+                with conn:
+                    try:
+                        self._serve_one(conn, server)
+                    except (OSError, ValueError, ConnectionError) as ex:
+                        logger.warning("Bad request: %s", ex)
+        except KeyboardInterrupt:
+            return const.RC_OK
+        finally:
+            server.close()
+            os.unlink(str(self.socket_path))
@@ -0,0 +1,244 @@
+"""Supervisor of child processes, like terraform or child wrappers, on an asyncio loop.
+
+Many children run at once, with a bound on their number. Their output is read
+without blocking, line by line in bounded memory, and either passed to a
+callback or printed with a prefix; the last lines of each are kept in ring
+buffers. Each child may have a timeout. SIGINT and SIGTERM are forwarded to
+the children, which get a grace period before being killed; interactive ones
+get the SIGINT from the terminal and are left to stop by themselves, unless a
+second signal comes. Children are
+reaped with wait4, to account their resource usage. A finished job may be run
+again after a delay, without holding a slot meanwhile."""
+import os
+import sys
+import time
+import signal
+import asyncio
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .logs import logger
+
+# Longer lines are split, to keep memory bounded
+MAX_LINE = 2**20
+CHUNK_SIZE = 2**16
+# Lines kept of the end of each output
+TAIL_LINES = 50
+# Seconds between the forwarded signal and the kill
+GRACE_PERIOD = 10
+# Seconds of silence after which an unterminated line of an interactive child,
+# like a prompt, is shown as is
+PROMPT_DELAY = 0.2
+
+
+class Job:
+    """A child process to run, then its results"""
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, command, cwd=None, env=None, name=None, prefix=None, timeout=None,
+                 on_line=None, capture_stdout=True, capture_stderr=True, interactive=False):
+        """
+        :param str name: label of the job, for the caller
+        :param str prefix: printed before each output line, like '[stack] '
+        :param float timeout: seconds before the child is terminated
+        :param on_line: called with (job, stream name, line as bytes, partial) instead of
+            printing; partial lines are the start of a line waiting for input, like a prompt
+        :param bool interactive: the child shares our stdin and our process group,
+            so it gets the terminal signals by itself"""
+        self.command = [str(x) for x in command]
+        self.name = name
+        self.cwd = cwd
+        self.env = env
+        self.prefix = prefix
+        self.timeout = timeout
+        self.on_line = on_line
+        self.capture = {'stdout': capture_stdout, 'stderr': capture_stderr}
+        self.interactive = interactive
+        self.tail = {'stdout': deque(maxlen=TAIL_LINES), 'stderr': deque(maxlen=TAIL_LINES)}
+        self.process = None
+        self.returncode = None
+        self.timed_out = False
+        self.duration = None
+        self.rusage = None
+        self.attempts = 0
+
+    @property
+    def running(self):
+        """Whether the child is started and not reaped yet"""
+        return self.process is not None and self.returncode is None
+
+    def signal(self, signum):
+        """Send a signal to the child (and its process group, if it has its own)"""
+        if not self.running:
+            return
+        try:
+            if self.interactive:
+                os.kill(self.process.pid, signum)
+            else:
+                os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+class Engine:
+    """Runner of jobs, at most `parallel` at once"""
+
+    def __init__(self, parallel=None, grace=GRACE_PERIOD, retry=None):
+        """
+        :param retry: called with each finished job, returns the seconds after which
+            to run it again, or None"""
+        self.parallel = max(1, parallel or 1)
+        self.grace = grace
+        self.retry = retry
+        self.interrupted = None
+        self._jobs = list()
+        self._loop = None
+        self._stopped = None
+
+    def _print(self, job, name, line, partial=False):
+        """Default output of a line"""
+        out = sys.stdout.buffer if name == 'stdout' else sys.stderr.buffer
+        if job.prefix:
+            out.write(job.prefix.encode())
+        out.write(line if partial or line.endswith(b'\n') else line + b'\n')
+        out.flush()
+
+    def _line(self, job, name, line, partial=False):
+        """:param bool partial: the start of a line, to be continued"""
+        job.tail[name].append(line)
+        if job.on_line:
+            job.on_line(job, name, line, partial)
+        else:
+            self._print(job, name, line, partial)
+
+    async def _read(self, job, name, pipe):
+        """Dispatch the lines of a child output"""
+        reader = asyncio.StreamReader(limit=MAX_LINE)
+        transport, _ = await self._loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        pending = b''
+        try:
+            while True:
+                if pending and job.interactive:
+                    try:  # a prompt waits for its answer without ending its line
+                        chunk = await asyncio.wait_for(reader.read(CHUNK_SIZE), PROMPT_DELAY)
+                    except asyncio.TimeoutError:
+                        self._line(job, name, pending, partial=True)
+                        pending = b''
+                        continue
+                else:
+                    chunk = await reader.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                pending += chunk
+                lines = pending.split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    self._line(job, name, line + b'\n')
+                while len(pending) >= MAX_LINE:
+                    self._line(job, name, pending[:MAX_LINE])
+                    pending = pending[MAX_LINE:]
+            if pending:
+                self._line(job, name, pending)
+        finally:
+            transport.close()
+
+    def _kill_later(self, job):
+        """Kill the job if still running after the grace period"""
+        self._loop.call_later(self.grace, job.signal, signal.SIGKILL)
+
+    def _on_signal(self, signum):
+        """Forward the signal to all children; a second one kills them"""
+        if self.interrupted is not None:
+            logger.warning("Killing all children")
+            for job in self._jobs:
+                job.signal(signal.SIGKILL)
+            return
+        self.interrupted = signum
+        if self._stopped:
+            self._stopped.set()
+        logger.warning("Received %s, stopping %d children",
+                       signal.Signals(signum).name, sum(1 for x in self._jobs if x.running))
+        for job in self._jobs:
+            if not job.running or (job.interactive and signum == signal.SIGINT):
+                continue  # interactive ones got the SIGINT from the terminal, let them stop
+            job.signal(signum)
+            self._kill_later(job)
+
+    async def _run(self, job, slots, reaper):
+        while True:
+            await self._run_once(job, slots, reaper)
+            delay = self.retry(job) if self.retry and self.interrupted is None else None
+            if delay is None:
+                return
+            try:  # cut short by a signal
+                await asyncio.wait_for(self._stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_once(self, job, slots, reaper):
+        async with slots:
+            if self.interrupted is not None:
+                return
+            job.attempts += 1
+            job.returncode, job.timed_out = None, False
+            start = time.time()
+            job.process = subprocess.Popen(
+                job.command, cwd=job.cwd, env=job.env, shell=False,
+                stdin=None if job.interactive else subprocess.DEVNULL,
+                stdout=subprocess.PIPE if job.capture['stdout'] else None,
+                stderr=subprocess.PIPE if job.capture['stderr'] else None,
+                start_new_session=not job.interactive)
+            # read while the child runs, not to block it on a full pipe
+            readers = [asyncio.ensure_future(self._read(job, name, getattr(job.process, name)))
+                       for name in ('stdout', 'stderr') if job.capture[name]]
+            exited = self._loop.run_in_executor(reaper, os.wait4, job.process.pid, 0)
+            try:
+                await asyncio.wait_for(asyncio.shield(exited), job.timeout)
+            except asyncio.TimeoutError:
+                logger.error("'%s' timed out after %ss, terminating it",
+                             ' '.join(job.command[:2]), job.timeout)
+                job.timed_out = True
+                job.signal(signal.SIGTERM)
+                self._kill_later(job)
+            _, status, rusage = await exited
+            job.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+                else os.WEXITSTATUS(status)
+            job.process.returncode = job.returncode  # reaped here, not by Popen
+            job.rusage = {'user_s': rusage.ru_utime, 'system_s': rusage.ru_stime,
+                          'max_rss_kb': rusage.ru_maxrss}
+            await asyncio.gather(*readers)
+            job.duration = time.time() - start
+
+    async def _run_all(self, jobs):
+        slots = asyncio.Semaphore(self.parallel)
+        self._stopped = asyncio.Event()
+        with ThreadPoolExecutor(max_workers=self.parallel) as reaper:
+            await asyncio.gather(*(self._run(job, slots, reaper) for job in jobs))
+
+    def run(self, jobs):
+        """Run the jobs, return them with their results.
+        Jobs not started because of a signal keep a None returncode."""
+        self._jobs = list(jobs)
+        self._loop = asyncio.new_event_loop()
+        handled = list()
+        try:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    self._loop.add_signal_handler(signum, self._on_signal, signum)
+                    handled.append(signum)
+                except (RuntimeError, ValueError):  # not in the main thread
+                    pass
+            self._loop.run_until_complete(self._run_all(self._jobs))
+        finally:
+            for signum in handled:
+                self._loop.remove_signal_handler(signum)
+            self._loop.close()
+        return self._jobs
+
+
+def run(job):
+    """Run a single job, return its exit code"""
+    Engine().run([job])
+    return job.returncode
@@ -2,7 +2,7 @@
 import os
 import sys
 import logging
-from . import logger
+from .logs import logger
 from . import constants as const
 from .cli_tools import parse_args
 
@@ -0,0 +1,128 @@
+"""Incremental reader of some top-level members of a large JSON object.
+
+The document is read chunk by chunk from a binary stream; values of the other
+members are skipped without being decoded, and reading stops as soon as all the
+requested members are found. Like for a terraform state, whose outputs come
+before its (large) resources."""
+import re
+import json
+import codecs
+
+CHUNK_SIZE = 2**16
+
+_SPACE = re.compile(r'\s*')
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_SCALAR = re.compile(r'[^\s,:\]}]+')
+# anything but strings and brackets, into a container being skipped
+_PLAIN = re.compile(r'[^"{}\[\]]*')
+
+
+class _Buffer:
+    """Decoded text of the stream, from the oldest position still needed"""
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.mark = None
+        self.eof = False
+
+    def fill(self):
+        """Read the next chunk, return False at the end of the stream"""
+        if self.eof:
+            return False
+        data = self.stream.read(self.chunk_size)
+        self.eof = not data
+        keep = self.pos if self.mark is None else self.mark
+        self.text = self.text[keep:] + self.decoder.decode(data, final=self.eof)
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark -= keep
+        return True
+
+    def match(self, regex, greedy=True):
+        """Consume the match of the regex at the current position, return it.
+        Greedy matches reaching the end of the text are retried with more text."""
+        while True:
+            found = regex.match(self.text, self.pos)
+            if found and not (greedy and found.end() == len(self.text) and not self.eof):
+                self.pos = found.end()
+                return found.group()
+            if not self.fill():
+                raise ValueError(f"Truncated JSON document, expected {regex.pattern}")
+
+    def peek(self):
+        """Next significant character, '' at the end"""
+        self.match(_SPACE)
+        while self.pos == len(self.text):
+            if not self.fill():
+                return ''
+            self.match(_SPACE)
+        return self.text[self.pos]
+
+    def expect(self, char):
+        """Consume the given character"""
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Invalid JSON document, expected '{char}' but got '{found}'")
+        self.pos += 1
+
+    def skip(self):
+        """Consume a value"""
+        char = self.peek()
+        if char == '"':
+            self.match(_STRING, greedy=False)
+            return
+        if char not in '{[':
+            self.match(_SCALAR)
+            return
+        self.pos += 1
+        depth = 1
+        while depth:
+            self.match(_PLAIN)
+            char = self.peek()
+            if char == '':
+                raise ValueError("Truncated JSON document")
+            if char == '"':
+                self.match(_STRING, greedy=False)
+                continue
+            depth += 1 if char in '{[' else -1
+            self.pos += 1
+
+    def value(self):
+        """Consume a value, return its text"""
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip()
+            return self.text[self.mark:self.pos]
+        finally:
+            self.mark = None
+
+
+def read_members(stream, keys, chunk_size=CHUNK_SIZE):
+    """Decoded values of the given top-level members of the JSON object of a stream.
+    Members not found are missing from the result.
+    :param stream: binary file-like object, with read(size)
+    :rtype: dict"""
+    buffer = _Buffer(stream, chunk_size)
+    wanted = set(keys)
+    found = dict()
+    buffer.expect('{')
+    if buffer.peek() == '}':
+        return found
+    while wanted:
+        buffer.peek()
+        key = json.loads(buffer.match(_STRING, greedy=False))
+        buffer.expect(':')
+        if key in wanted:
+            found[key] = json.loads(buffer.value())
+            wanted.discard(key)
+        else:
+            buffer.skip()
+        if buffer.peek() == '}':
+            break
+        buffer.expect(',')
+    return found
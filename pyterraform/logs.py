@@ -1,6 +1,14 @@
 """Logging setup"""
 import os
+import copy
+import json
+import gzip
+import queue
+import atexit
+import shutil
 import logging
+import logging.handlers
+from pathlib import PurePath
 import colorlog
 
 
@@ -12,24 +20,101 @@ logger = colorlog.getLogger('tfwrapper')
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+# Listeners of the queued log records, with the process which started them
+_listeners = list()
 
 
-def set_root_logger(log_to_file=None, log_to_stream=None):
-    """Set root logger for more verbose analisys"""
+class LazyJson:
+    """Json dump of data, built only if a handler actually formats the record.
+    The data is not copied: pass one the caller does not change afterwards."""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, indent=2, sort_keys=True)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Queue records unformatted, their listener formats them in its thread"""
+    IMMUTABLE = (str, bytes, int, float, type(None), PurePath, LazyJson)
+
+    @classmethod
+    def _copy(cls, arg):
+        """Argument of a message, safe from later changes by the logging thread"""
+        if isinstance(arg, cls.IMMUTABLE):
+            return arg
+        if isinstance(arg, dict):
+            return {key: cls._copy(value) for key, value in arg.items()}
+        if isinstance(arg, (list, tuple)):
+            return type(arg)(cls._copy(item) for item in arg)
+        try:
+            return copy.deepcopy(arg)
+        except Exception:  # pylint: disable=broad-except
+            return str(arg)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if isinstance(record.args, dict):
+            record.args = {key: self._copy(value) for key, value in record.args.items()}
+        elif record.args:
+            record.args = tuple(self._copy(arg) for arg in record.args)
+        return record
+
+
+def _gzip_rotator(source, dest):
+    """Compress a rotated log file"""
+    with open(source, 'rb') as _in, gzip.open(dest, 'wb') as _out:
+        shutil.copyfileobj(_in, _out)
+    os.remove(source)
+
+
+def stop_listeners():
+    """Write the queued records and stop the listeners started by this process"""
+    while _listeners:
+        pid, listener = _listeners.pop()
+        if pid == os.getpid():
+            listener.stop()
+
+atexit.register(stop_listeners)
+
+
+def set_root_logger(log_to_file=None, log_to_stream=None, max_bytes=20 * 2**20,
+                    backup_count=10, compress=False):
+    """Set root logger for more verbose analisys.
+    Records are queued by the logging threads, then formatted and written by a background
+    listener, so that formatting and slow handlers (disk) are out of the hot path.
+    :param int max_bytes: size of log_to_file triggering its rotation
+    :param bool compress: gzip rotated log files"""
     rootlog = logging.getLogger()
-    handlers = getattr(rootlog, 'handlers', list())
+    for _handler in list(rootlog.handlers):
+        # like one inherited from the daemon, whose listener did not survive the fork
+        if isinstance(_handler, logging.handlers.QueueHandler):
+            rootlog.removeHandler(_handler)
+    handlers = list()
     formatter = logging.Formatter(
         fmt=set_root_logger.message_format,
         datefmt=set_root_logger.date_format)
     if log_to_file:
-        import logging.handlers as handlers_  # pylint: disable=import-outside-toplevel
-        file_ = handlers_.RotatingFileHandler(log_to_file, backupCount=10, maxBytes=20*2**100)
-        file_.doRollover()
+        os.makedirs(os.path.dirname(str(log_to_file)), exist_ok=True)
+        file_ = logging.handlers.RotatingFileHandler(log_to_file, backupCount=backup_count,
+                                                     maxBytes=max_bytes)
+        if compress:
+            file_.namer = lambda name: name + '.gz'
+            file_.rotator = _gzip_rotator
         handlers.append(file_)
     if log_to_stream:  # like sys.stdout
         handlers.append(logging.StreamHandler(log_to_stream))
+    if not handlers:
+        return
     for _handler in handlers:
         _handler.setFormatter(formatter)
+    records = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append((os.getpid(), listener))
+    rootlog.addHandler(QueueHandler(records))
 
 set_root_logger.message_format = (
     '%(asctime)s.%(msecs)03d %(process)d-%(thread)d %(name)-8s:'
@@ -0,0 +1,175 @@
+"""Run a pyterraform subcommand across many stacks, with a bounded pool of workers."""
+import os
+import sys
+import json
+import time
+import fnmatch
+from pathlib import Path
+
+from . import constants as const
+from .logs import logger, get_logger
+from . import trace
+from . import engine
+from . import state_lock
+from .remote_state import read_many, json_outputs, format_outputs
+from .affected import Affected
+
+log = get_logger(__name__, 'DEBUG')  # pylint: disable=invalid-name
+
+
+class MultiStack:
+    """Executor of a pyterraform subcommand on each stack found under the root folder.
+    Every stack runs as a child wrapper process, started from the stack folder."""
+
+    def __init__(self, project):
+        self.project = project
+        self.results = dict()
+        self._locked_since = dict()
+
+    @property
+    def args(self):
+        """Just for convenience"""
+        return self.project.input.args
+
+    @staticmethod
+    def name(meta):
+        """Human name of a stack, like <stack>/<environment>"""
+        return '/'.join(meta.values())
+
+    def selected(self):
+        """Stacks matching the --<stack element> glob filters, and changed since the
+        --changed-since git reference if any"""
+        stacks = self.project.path.index.select(
+            **{key: self.args.get(key) for key in self.project.cfg.pyt.stack_folder_structure})
+        if self.args.get('changed_since') and stacks:
+            stacks = Affected(self.project, self.args['changed_since']).select(stacks)
+        return stacks
+
+    def list(self):
+        """Print the selected stacks, one per line"""
+        for meta, _ in self.selected():
+            print(self.name(meta))
+        return const.RC_OK
+
+    def outputs(self):
+        """Print the outputs of the selected stacks, read from their remote states"""
+        stacks = self.selected()
+        if self.args.get('stacks'):
+            patterns = [x.strip() for x in self.args['stacks'].split(',') if x.strip()]
+            unknown = [x for x in patterns
+                       if not any(fnmatch.fnmatchcase(self.name(meta), x) for meta, _ in stacks)]
+            if unknown:
+                logger.error("No stack matches %s", ', '.join(unknown))
+                return const.RC_KO
+            stacks = [(meta, path) for meta, path in stacks
+                      if any(fnmatch.fnmatchcase(self.name(meta), x) for x in patterns)]
+        stack_cfg = self.project.cfg.stack
+        backends = {'_'.join(meta.values()): stack_cfg.backend_for(stack_cfg.data_of(meta, path))
+                    for meta, path in stacks}
+        states = read_many(self.project, backends, self.args.get('jobs'))
+        names = {'_'.join(meta.values()): self.name(meta) for meta, _ in stacks}
+        if self.args.get('json'):
+            print(json.dumps({names[key]: json_outputs(state['outputs']) if state else None
+                              for key, state in states.items()}, indent=2))
+        else:
+            for key, state in states.items():
+                if state:
+                    print(f"# {names[key]} (serial {state.get('serial')})\n"
+                          f"{format_outputs(state['outputs'])[1]}\n")
+        return const.RC_OK if all(states.values()) else const.RC_KO
+
+    def _child_command(self):
+        """The pyterraform cli to run into each stack"""
+        command = [sys.executable, '-m', 'pyterraform', '--unattended']
+        if self.args.get('debug'):
+            command.append('--debug')
+        if self.args.get('log_to_file'):
+            command.append('--log-to-file')
+        if self.args.get('plugin_cache_dir'):
+            command.extend(['--plugin-cache-dir', self.args['plugin_cache_dir']])
+        return command + self.args['command']
+
+    def _child_env(self):
+        """Environment of child wrappers: no prompt and our own package importable"""
+        env = dict(self.project.input.environment)
+        package_parent = str(Path(__file__).absolute().parent.parent)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_parent] + [x for x in [env.get('PYTHONPATH')] if x])
+        env[const.ROOT_ENV] = str(self.project.path.root())
+        env['TF_IN_AUTOMATION'] = '1'
+        env['TF_INPUT'] = '0'
+        env[const.LOCK_WAIT_ENV] = '0'  # locked stacks are queued again here
+        env.pop(trace.TRACE_ENV, None)
+        return env
+
+    @property
+    def lock_wait(self):
+        """Seconds to wait for a locked stack"""
+        timeout = self.project.input.environment.get(const.LOCK_WAIT_ENV)
+        if timeout is None:
+            timeout = self.project.cfg.pyt.get('config.state_lock_wait')
+        return float(timeout)
+
+    def _retry(self, job):
+        """Seconds after which to run again a stack found locked, while others run.
+        None for other results, or once lock_wait is elapsed."""
+        if job.returncode != const.RC_LOCKED:
+            return None
+        waited = time.time() - self._locked_since.setdefault(job.name, time.time())
+        if waited >= self.lock_wait:
+            logger.error("'%s' still locked after %.0fs, giving up", job.name, waited)
+            return None
+        delay = min(self.lock_wait - waited, state_lock.backoff(job.attempts - 1))
+        logger.warning("'%s' is locked, queued again in %.0fs", job.name, delay)
+        return delay
+
+    def _job(self, meta, path, command, env):
+        """Engine job running the command on a single stack"""
+        name = self.name(meta)
+        log.info("Running '%s' on '%s'", ' '.join(command), path)
+        if trace.tracer():
+            env = dict(env, **{trace.TRACE_ENV: trace.tracer().child_trace()})
+        return engine.Job(command, cwd=path, env=env, name=name, prefix=f'[{name}] ',
+                          timeout=self.args.get('timeout'))
+
+    def summary(self):
+        """Print a table of results, one row per stack"""
+        width = max([len(name) for name in self.results] + [len('Stack')])
+        print(f"\n{'Stack':<{width}}  {'Exit':>4}  Duration      CPU  Max RSS")
+        for name in sorted(self.results):
+            returncode, duration, rusage = self.results[name]
+            if returncode is None:
+                print(f"{name:<{width}}  {'-':>4}  not started")
+                continue
+            if returncode == const.RC_LOCKED:
+                print(f"{name:<{width}}  {returncode:>4}  state locked")
+                continue
+            print(f"{name:<{width}}  {returncode:>4}  {duration:7.1f}s "
+                  f"{rusage['user_s'] + rusage['system_s']:7.1f}s "
+                  f"{rusage['max_rss_kb'] / 1024:6.0f}MB")
+        failed = [name for name, (rc, _, _) in self.results.items() if rc != const.RC_OK]
+        print(f"\n{len(self.results)} stacks, {len(failed)} not successful")
+
+    def run(self):
+        """Run the command on all selected stacks, return the aggregated exit code"""
+        stacks = self.selected()
+        if not stacks:
+            logger.warning("No stack matches the requested filters")
+            return const.RC_OK
+        jobs = max(1, self.args.get('jobs') or 1)
+        logger.info("Running '%s' on %d stacks with %d workers",
+                    ' '.join(self.args['command']), len(stacks), jobs)
+        command, env = self._child_command(), self._child_env()
+        runner = engine.Engine(parallel=jobs, retry=self._retry)
+        with trace.span('multistack.run', stacks=len(stacks)):
+            done = runner.run([self._job(meta, path, command, env) for meta, path in stacks])
+        for job in done:
+            self.results[job.name] = (job.returncode, job.duration, job.rusage)
+        # killed by a signal: exit code of shells, 128 + signal
+        returncodes = [const.RC_KO if job.returncode is None else
+                       job.returncode if job.returncode >= 0 else 128 - job.returncode
+                       for job in done]
+        if runner.interrupted:
+            returncodes.append(128 + runner.interrupted)
+        self.summary()
+        return max(returncodes)
@@ -1,5 +1,6 @@
 """Common path position.
 """
+import os
 import sys
 from pathlib import Path
 import itertools
@@ -7,6 +8,7 @@ import itertools
 from .logs import logger
 from .utils import error
 from . import constants as const
+from .stack_index import StackIndex
 
 
 class Conf:
@@ -56,6 +58,8 @@ class Paths:
 
     def root(self):
         """Wrapper root folder"""
+        if not self._cache.get("root") and os.environ.get(const.ROOT_ENV):
+            self._cache["root"] = Path(os.environ[const.ROOT_ENV])
         if not self._cache.get("root"):
             for i in range(0, 5):
                 if (Path("../" * i) / const.CONF_DIR).is_dir():
@@ -104,10 +108,21 @@ class Paths:
         Such path could be defined from cli args or from cwd"""
         return Stack(self)
 
+    @property
+    def index(self):
+        """Persistent index of all the stacks under the root folder"""
+        if not self._cache.get('index'):
+            self._cache['index'] = StackIndex(self)
+        return self._cache['index']
+
     def modules(self):
         """Terraform modules folder"""
         return self.root() / "modules"
 
+    def module_store(self):
+        """Remote modules shared by the stacks, hidden into the modules folder"""
+        return self.modules() / ".store"
+
     def run(self):
         """Execution data"""
         dir_ = self.root() / '.run'
@@ -8,7 +8,10 @@ from . import inputs
 from . import session
 from . import constants as const
 from .terraform import Command
+from .multistack import MultiStack
+from .daemon import Daemon
 from .logs import set_root_logger, get_logger, logger
+from .trace import traced
 
 log = get_logger(__name__, 'DEBUG')  # pylint: disable=invalid-name
 
@@ -16,6 +19,7 @@ log = get_logger(__name__, 'DEBUG')  # pylint: disable=invalid-name
 class Project:  # pylint: disable=too-few-public-methods
     """A terraform project"""
 
+    @traced('project.init')
     def __init__(self):
         self.path = paths.Paths(self)
         self.input = inputs.Data(self)
@@ -28,8 +32,15 @@ class Project:  # pylint: disable=too-few-public-methods
         """Based on cli inputs, enrich logging"""
         if self.input.args.get('log_to_file') or self.input.environment.get('log_to_file') \
                 or self.cfg.pyt.get('config.log_to_file'):
-            set_root_logger(log_to_file=self.path.run() / "pyterraform.logs")
-            logger.info("Enabled logging to file \"%s\"", self.path.run() / "pyterraform.logs")
+            log_file = self.path.run() / "pyterraform.logs"
+            if all(self.input.path.values()):
+                # one file per stack, not to mix the logs of concurrent stacks
+                log_file = self.path.run() / 'logs' / f'{self.tf.stack_name}.log'
+            set_root_logger(log_to_file=log_file,
+                            max_bytes=self.cfg.pyt.get('config.log_max_mb') * 2**20,
+                            backup_count=self.cfg.pyt.get('config.log_backups'),
+                            compress=self.cfg.pyt.get('config.log_compress'))
+            logger.info("Enabled logging to file \"%s\"", log_file)
             log.info("Enabled log to file for verbose analysis")
 
     def run(self):
@@ -39,8 +50,19 @@ class Project:  # pylint: disable=too-few-public-methods
             print(f'Current pyterraform wrapper version is {const.VERSION}')
             sys.exit(const.RC_OK)
 
+        if self.input.args.get('subcommand') in const.MULTI_STACK_SUBCOMMANDS:
+            returncode = MultiStack(self).run()
+            log.info("The aggregated exit status is '%s'", returncode)
+            sys.exit(returncode)
+        if self.input.args.get('subcommand') == 'list_stacks':
+            sys.exit(MultiStack(self).list())
+        if self.input.args.get('subcommand') == 'outputs':
+            sys.exit(MultiStack(self).outputs())
+        if self.input.args.get('subcommand') == 'daemon':
+            sys.exit(Daemon(self).serve())
+
         # run terraform finally!
-        if self.cfg.pyt.get('config.tf_data_dir'):
+        if self.cfg.pyt.get('config.tf_data_dir') and all(self.input.path.values()):
             logger.info("Plan data will be cached on %s",
                         self.cfg.pyt.get('config.tf_data_dir').format(**self.cfg.stack.data))
         returncode = self.tf.run()
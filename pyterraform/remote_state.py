@@ -0,0 +1,184 @@
+"""Terraform state stored into its remote backend, read without terraform."""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from . import constants as const
+from .logs import logger, get_logger
+from .utils import read_json, write_json
+from .json_stream import read_members
+from .trace import span, traced
+
+log = get_logger(__name__, 'INFO')  # pylint: disable=invalid-name
+
+# Members of the state read for its outputs; they come before the resources
+STATE_MEMBERS = ('version', 'serial', 'lineage', 'outputs')
+
+
+class RemoteState:
+    """State of a stack into the S3 backend"""
+
+    # pylint: disable=invalid-name,too-many-arguments
+    def __init__(self, project, backend=None, name=None, s3=None, bounded=False):
+        """
+        :param dict backend: interpolated backend configuration, defaults to the current stack
+        :param str name: name of the stack runtime files, defaults to the current stack
+        :param s3: S3 client to share, built from the session by default
+        :param bool bounded: built with short timeouts, for best effort reads"""
+        self.project = project
+        self._backend = backend
+        self._s3 = s3
+        self.bounded = bounded
+        self.name = name or project.tf.stack_name
+
+    @property
+    def backend(self):
+        """S3 backend of the stack"""
+        if self._backend is None:
+            self._backend = self.project.cfg.stack.backend
+        return self._backend
+
+    @property
+    def s3(self):  # pylint: disable=invalid-name
+        """S3 client, on the endpoint of the backend if any"""
+        if self._s3 is None:
+            self._s3 = self.project.session.client(
+                's3', endpoint_url=self.backend.get('endpoint') or const.S3_ENDPOINT,
+                bounded=self.bounded)
+        return self._s3
+
+    @property
+    def cache_file(self):
+        """Outputs of the last state read"""
+        return self.project.path.run() / 'outputs' / f'{self.name}.json'
+
+    def head(self):
+        """Identity of the current state object, as {'etag', 'version_id'}.
+        None if the stack has no remote backend, or its state does not exist yet."""
+        if not self.backend.get('bucket'):
+            return None
+        import botocore.exceptions  # pylint: disable=import-outside-toplevel
+        try:
+            response = self.s3.head_object(Bucket=self.backend['bucket'],
+                                           Key=self.backend['key'])
+        except botocore.exceptions.ClientError as ex:
+            if ex.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return {'etag': response['ETag'].strip('"'), 'version_id': response.get('VersionId')}
+
+    @traced('remote_state.fetch')
+    def _fetch(self, cached):
+        """Outputs of the state object, with its identity, serial and lineage.
+        False if it is the cached one, None if it does not exist."""
+        import botocore.exceptions  # pylint: disable=import-outside-toplevel
+        request = {'Bucket': self.backend['bucket'], 'Key': self.backend['key']}
+        if cached:
+            request['IfNoneMatch'] = f'"{cached["etag"]}"'
+        try:
+            response = self.s3.get_object(**request)
+        except botocore.exceptions.ClientError as ex:
+            code = ex.response.get('Error', {}).get('Code')
+            if code in ('304', 'NotModified'):
+                return False
+            if code in ('404', 'NoSuchKey'):
+                return None
+            raise
+        body = response['Body']
+        try:
+            state = read_members(body, STATE_MEMBERS)
+        finally:
+            body.close()  # the resources are left unread
+        state.setdefault('outputs', dict())
+        state.update(etag=response['ETag'].strip('"'), version_id=response.get('VersionId'))
+        return state
+
+    def outputs(self):
+        """The state outputs, with {'version', 'serial', 'lineage', 'etag', 'version_id'}.
+        Only downloaded when changed since the cached ones.
+        None if the stack has no remote backend, or its state does not exist yet."""
+        if not self.backend.get('bucket'):
+            return None
+        cached = read_json(self.cache_file)
+        if cached and (cached.get('bucket'), cached.get('key')) != \
+                (self.backend['bucket'], self.backend['key']):
+            cached = None
+        state = self._fetch(cached)
+        if state is False:
+            log.info("State of '%s' unchanged since serial %s", self.name, cached['serial'])
+            return cached
+        if state is not None:
+            if cached and state.get('lineage') != cached.get('lineage'):
+                logger.warning("State of '%s' was replaced (lineage %s, was %s)",
+                               self.name, state.get('lineage'), cached.get('lineage'))
+            state.update(bucket=self.backend['bucket'], key=self.backend['key'])
+            write_json(self.cache_file, state)  # private: outputs may be sensitive
+            log.info("Read outputs of '%s' at serial %s", self.name, state.get('serial'))
+        return state
+
+
+def _read_outputs(remote):
+    """Outputs of a remote state, None on failure"""
+    import botocore.exceptions  # pylint: disable=import-outside-toplevel
+    try:
+        state = remote.outputs()
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError,
+            ValueError) as ex:
+        logger.error("Cannot read the state of '%s': %s", remote.name, ex)
+        return None
+    if state is None:
+        logger.error("No remote state found for '%s'", remote.name)
+    return state
+
+
+def read_many(project, backends, workers=8):
+    """Outputs of many stacks, their states read concurrently.
+    Each one is only downloaded if changed since its cached outputs.
+    :param dict backends: interpolated backend configuration by stack runtime name
+    :return: state outputs by stack runtime name, None for the ones not read
+    :rtype: dict"""
+    clients = dict()
+    remotes = list()
+    for name, backend in backends.items():
+        endpoint = backend.get('endpoint') or const.S3_ENDPOINT
+        if endpoint not in clients:  # clients are thread safe, their creation is not
+            clients[endpoint] = project.session.client('s3', endpoint_url=endpoint)
+        remotes.append(RemoteState(project, backend, name, s3=clients[endpoint]))
+    with span('remote_state.read_many', stacks=len(remotes)), \
+            ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(backends, pool.map(_read_outputs, remotes)))
+
+
+def json_outputs(outputs):
+    """Outputs as printed by terraform output -json"""
+    return {key: {'sensitive': item.get('sensitive', False), 'type': item.get('type'),
+                  'value': item['value']} for key, item in sorted(outputs.items())}
+
+
+def format_outputs(outputs, name=None, as_json=False):
+    """Outputs printed like terraform output does.
+    :param str name: the single output to print
+    :return: exit code and text
+    :rtype: int, str"""
+    if name is not None:
+        if name not in outputs:
+            return const.RC_KO, ("The output variable requested could not be found in the "
+                                 "state file. If you recently added this to your configuration,"
+                                 " be sure to run `terraform apply`.")
+        value = outputs[name]['value']
+        if as_json:
+            return const.RC_OK, json.dumps(value, indent=2)
+        return const.RC_OK, value if isinstance(value, str) else json.dumps(value, indent=2)
+    if as_json:
+        return const.RC_OK, json.dumps(json_outputs(outputs), indent=2)
+    if not outputs:
+        return const.RC_KO, ("The state file either has no outputs defined, or all the "
+                             "defined outputs are empty.")
+    lines = list()
+    for key, item in sorted(outputs.items()):
+        value = item['value']
+        if item.get('sensitive'):
+            value = '<sensitive>'
+        elif not isinstance(value, str):
+            value = json.dumps(value, indent=2)
+        lines.append(f'{key} = {value}')
+    return const.RC_OK, '\n'.join(lines)
@@ -1,22 +1,34 @@
 """Manage aws sessions"""
 import os
 import time
-import pickle
+import hashlib
 import sys
-
-import boto3
-import botocore
+from collections import namedtuple
 
 from . import constants as const
 from .logs import logger
+from .utils import read_json, write_json, file_lock
+from .trace import traced
+
+Credentials = namedtuple('Credentials', ['access_key', 'secret_key', 'token'])
+
+# Credentials are refreshed this long before their expiration
+REFRESH_MARGIN = 300
+# Lifetime of credentials without expiration (like static keys), to catch profile changes
+STATIC_TTL = 2700
+# Bounded clients, for best effort calls: an unreachable endpoint must not delay the run much
+BOUNDED_TIMEOUT = 5
+BOUNDED_ATTEMPTS = 2
 
-# pylint: disable=fixme
 
 class Session:
-    """AWS session caching and setting"""
+    """AWS session caching and setting.
+    Credentials are cached in the runtime folder, one file per profile, role and region,
+    and refreshed by a single process at a time shortly before they expire."""
 
     def __init__(self, project):
         self._credentials = None
+        self._boto_session = None
         self.project = project
 
     @property
@@ -31,54 +43,118 @@ class Session:
             return self.project.cfg.pyt.get('state.profile')
         return os.environ['AWS_PROFILE']
 
+    @property
+    def role(self):
+        """Role to assume, if any"""
+        return self.project.cfg.pyt.get('state.assume_role')
+
+    @property
+    def region(self):
+        """Region set into state.yml, if any"""
+        return self.project.cfg.pyt.get('state.region')
+
     @property
     def session_cache_file(self):
         """Temporary store credential"""
-        return self.project.path.run() / f'session_cache_{self.profile}.pickle'
-        #return self.project.path.run / f'session_cache_{self.account}_{self.profile}.pickle'
+        key = hashlib.sha1(f'{self.profile}|{self.role}|{self.region}'.encode()).hexdigest()
+        return self.project.path.run() / f'credentials_{self.profile}_{key[:12]}.json'
+
+    @staticmethod
+    def _is_fresh(cache):
+        """Whether cached credentials are still usable"""
+        if not cache:
+            return False
+        if cache.get('expiry') is None:
+            return time.time() - cache['created'] < STATIC_TTL
+        return cache['expiry'] - time.time() > REFRESH_MARGIN
+
+    @traced('session.new_credentials')
+    def _new_credentials(self):
+        """Get credentials from the profile, assuming the role if any"""
+        import boto3  # pylint: disable=import-outside-toplevel
+        import botocore.exceptions  # pylint: disable=import-outside-toplevel
+        session_args = {"profile_name": self.profile}
+        if self.region:
+            session_args['region_name'] = self.region
+        try:
+            session = boto3.Session(**session_args)
+        except botocore.exceptions.ProfileNotFound:
+            logger.error("Profile not found.")
+            logger.error("No valid AWS session found. Exiting...")
+            sys.exit(const.RC_KO)
+        try:
+            if self.role:
+                response = session.client('sts').assume_role(
+                    RoleArn=self.role, RoleSessionName='pyterraform')['Credentials']
+                return {'access_key': response['AccessKeyId'],
+                        'secret_key': response['SecretAccessKey'],
+                        'token': response['SessionToken'],
+                        'region': session.region_name,
+                        'expiry': response['Expiration'].timestamp()}
+            credentials = session.get_credentials()
+            frozen = credentials.get_frozen_credentials()
+        except botocore.exceptions.ParamValidationError:
+            logger.error('Error validating authentication. Maybe the wrong MFA code ?')
+            sys.exit(const.RC_KO)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Unknown error')
+            sys.exit(const.RC_UNK)
+        # Refreshable credentials (SSO, assumed roles from profile) know their expiry
+        expiry = getattr(credentials, '_expiry_time', None)
+        return {'access_key': frozen.access_key,
+                'secret_key': frozen.secret_key,
+                'token': frozen.token,
+                'region': session.region_name,
+                'expiry': expiry.timestamp() if expiry else None}
 
+    @traced('session.credentials')
+    def _get_cache(self):
+        """Get or create cached credentials. Concurrent wrappers wait for the one
+        refreshing them instead of refreshing them all."""
+        cache = read_json(self.session_cache_file, memo=True)
+        if self._is_fresh(cache):
+            return cache
+        with file_lock(self.session_cache_file.with_suffix('.lock')):
+            cache = read_json(self.session_cache_file)
+            if self._is_fresh(cache):
+                return cache
+            logger.debug("Refreshing AWS credentials of profile %s", self.profile)
+            cache = self._new_credentials()
+            cache['created'] = time.time()
+            write_json(self.session_cache_file, cache, mode=0o600)
+        return cache
+
+    @traced('session.boto_session')
     def _get_session(self):
-        """Get or create boto cached session."""
-        if self.session_cache_file.is_file() and \
-                time.time() - os.stat(self.session_cache_file).st_mtime < 2700:
-            with open(self.session_cache_file, 'rb') as _f:
-                session_cache = pickle.load(_f)
-            session = boto3.Session(aws_access_key_id=session_cache['credentials'].access_key,
-                                    aws_secret_access_key=session_cache['credentials'].secret_key,
-                                    aws_session_token=session_cache['credentials'].token,
-                                    region_name=session_cache['region'])
-        else:
-            session_args = {"profile_name": self.profile}
-            if 'region' in self.project.cfg.pyt.get('state'):
-                session_args['region_name'] = self.project.cfg.pyt.get('state.region')
-            # TODO: add assume role
-            try:
-                session = boto3.Session(**session_args)
-            except botocore.exceptions.ProfileNotFound:
-                logger.error("Profile not found.")
-                logger.error("No valid AWS session found. Exiting...")
-                sys.exit(const.RC_KO)
-            try:
-                session_cache = {'credentials': session.get_credentials().get_frozen_credentials(),
-                                 'region': session.region_name}
-            except botocore.exceptions.ParamValidationError:
-                logger.error('Error validating authentication. Maybe the wrong MFA code ?')
-                sys.exit(const.RC_KO)
-            except Exception:  # pylint: disable=broad-except
-                logger.exception('Unknown error')
-                sys.exit(const.RC_UNK)
-            #with os.fdopen(os.open(self.session_cache_file, os.O_WRONLY | os.O_CREAT,
-            #                       mode=0o600), 'wb') as _f:
-            os.makedirs(self.project.path.run(), exist_ok=True)
-            with open(self.session_cache_file, 'wb') as _f:
-                pickle.dump(session_cache, _f, pickle.HIGHEST_PROTOCOL)
-        return session
+        """Boto session from cached credentials."""
+        if self._boto_session is None:
+            import boto3  # pylint: disable=import-outside-toplevel
+            cache = self._get_cache()
+            self._boto_session = boto3.Session(aws_access_key_id=cache['access_key'],
+                                               aws_secret_access_key=cache['secret_key'],
+                                               aws_session_token=cache['token'],
+                                               region_name=cache['region'])
+        return self._boto_session
+
+    def client(self, service, endpoint_url=None, config=None, bounded=False):
+        """Boto client of the given service
+        :param str endpoint_url: alternative endpoint, like a local stand-in
+        :param botocore.config.Config config: client settings, like timeouts
+        :param bool bounded: with short timeouts and few retries"""
+        if bounded:
+            from botocore.config import Config  # pylint: disable=import-outside-toplevel
+            bounds = Config(connect_timeout=BOUNDED_TIMEOUT, read_timeout=BOUNDED_TIMEOUT,
+                            retries={'max_attempts': BOUNDED_ATTEMPTS})
+            config = config.merge(bounds) if config else bounds
+        return self._get_session().client(service, endpoint_url=endpoint_url, config=config)
 
     @property
     def credentials(self):
         """Retun AWS credentials"""
         if not self._credentials:
-            self._credentials = self._get_session().get_credentials().get_frozen_credentials()
+            cache = self._get_cache()
+            self._credentials = Credentials(cache['access_key'], cache['secret_key'],
+                                            cache['token'])
         return self._credentials
 
     @property
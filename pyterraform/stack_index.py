@@ -0,0 +1,110 @@
+"""Persistent index of the stacks of a project, stored in the runtime folder."""
+import os
+import fnmatch
+
+from .logs import get_logger
+from .utils import read_json, write_json
+from . import constants as const
+
+log = get_logger(__name__, 'INFO')  # pylint: disable=invalid-name
+
+INDEX_VERSION = 1
+
+
+class StackIndex:
+    """Map of every folder holding a stack.yml, as deep as the folder structure.
+
+    The index remembers, for each walked folder, its mtime, its subfolders and
+    whether it holds a stack.yml: a folder whose mtime did not change is not
+    scanned again, so an update costs one stat per folder."""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._stacks = None
+
+    @property
+    def index_file(self):
+        """Where the index is persisted"""
+        return self.paths.run() / 'stack_index.json'
+
+    @property
+    def structure(self):
+        """Folder structure, like ['stack', 'environment']"""
+        return self.paths.project.cfg.pyt.stack_folder_structure
+
+    def _load(self):
+        """Previous index, if still matching the project layout"""
+        index = read_json(self.index_file, dict(), memo=True)
+        if index.get('version') != INDEX_VERSION \
+                or index.get('root') != str(self.paths.root()) \
+                or index.get('structure') != self.structure:
+            return dict()
+        return index.get('dirs', dict())
+
+    def _scan(self, path):
+        """List subfolders and stack.yml presence of a folder"""
+        subdirs, has_stack = list(), False
+        skip = {const.CONF_DIR.name, self.paths.modules().name}
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name == 'stack.yml':
+                    has_stack = True
+                elif entry.name[0] != '.' and entry.name not in skip \
+                        and entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+        return sorted(subdirs), has_stack
+
+    def update(self):
+        """Walk the root folder, rescanning only folders changed since last walk"""
+        old, new = self._load(), dict()
+        root, depth = str(self.paths.root()), len(self.structure)
+        stacks, scanned = list(), 0
+        todo = [('', 0)]
+        while todo:
+            rel, level = todo.pop()
+            path = os.path.join(root, rel) if rel else root
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            cached = old.get(rel)
+            if cached and cached[0] == mtime:
+                subdirs, has_stack = cached[1], cached[2]
+            else:
+                subdirs, has_stack = self._scan(path)
+                scanned += 1
+            new[rel] = [mtime, subdirs if level < depth else [], has_stack]
+            if level == depth:
+                if has_stack:
+                    stacks.append(rel)
+                continue
+            todo.extend((os.path.join(rel, name) if rel else name, level + 1)
+                        for name in subdirs)
+        if scanned or len(new) != len(old):
+            write_json(self.index_file, {'version': INDEX_VERSION, 'root': root,
+                                         'structure': self.structure, 'dirs': new})
+        log.debug("Stack index updated: %d folders, %d rescanned, %d stacks",
+                  len(new), scanned, len(stacks))
+        self._stacks = sorted(stacks)
+        return self._stacks
+
+    @property
+    def stacks(self):
+        """Relative path of all stacks"""
+        if self._stacks is None:
+            self.update()
+        return self._stacks
+
+    def __iter__(self):
+        """Yield every stack as (meta, path)"""
+        root = self.paths.root()
+        for rel in self.stacks:
+            yield dict(zip(self.structure, rel.split(os.sep))), root / rel
+
+    def select(self, **filters):
+        """Stacks whose folder elements match the given glob patterns,
+        like select(stack='net*', environment='prod')"""
+        filters = {key: pattern for key, pattern in filters.items() if pattern}
+        return [(meta, path) for meta, path in self
+                if all(fnmatch.fnmatchcase(meta[key], pattern)
+                       for key, pattern in filters.items())]
@@ -0,0 +1,114 @@
+"""Terraform state locks of the S3 backend, held into its DynamoDB table."""
+import json
+import time
+import random
+from datetime import datetime, timezone
+
+from . import constants as const
+from .logs import logger, get_logger
+from .trace import traced
+
+log = get_logger(__name__, 'INFO')  # pylint: disable=invalid-name
+
+# Terraform commands taking the state lock
+LOCKING_COMMANDS = ('apply', 'destroy', 'import', 'plan', 'refresh', 'taint', 'untaint')
+# Exponential backoff between lock checks, in seconds
+BACKOFF_BASE = 5
+BACKOFF_CAP = 60
+
+
+def backoff(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Seconds to wait before the given retry (from 0): exponential, with full jitter
+    not to have all waiting pipelines retry at once"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def describe(holder):
+    """Human description of a lock"""
+    since = holder.get('created') or 'an unknown time'
+    try:
+        created = datetime.strptime(holder['created'][:19], '%Y-%m-%dT%H:%M:%S')
+        age = datetime.now(timezone.utc).replace(tzinfo=None) - created
+        since += f' ({int(age.total_seconds()) // 60} min ago)'
+    except (KeyError, TypeError, ValueError):
+        pass
+    return (f"held by {holder.get('who') or 'unknown'} for {holder.get('operation') or '?'} "
+            f"since {since}, lock id {holder.get('id')}")
+
+
+class StateLock:
+    """Lock of a stack state, as taken by terraform into the DynamoDB table of the backend"""
+
+    def __init__(self, project, backend=None, name=None):
+        """
+        :param dict backend: interpolated backend configuration, defaults to the current stack
+        :param str name: name of the stack, for messages"""
+        self.project = project
+        self._backend = backend
+        self.name = name or project.tf.stack_name
+
+    @property
+    def backend(self):
+        """S3 backend of the stack"""
+        if self._backend is None:
+            self._backend = self.project.cfg.stack.backend
+        return self._backend
+
+    @property
+    def dynamodb(self):
+        """DynamoDB client, on the endpoint of the backend if any.
+        The check is best effort: an unreachable table must not delay the run much."""
+        return self.project.session.client(
+            'dynamodb',
+            endpoint_url=self.backend.get('dynamodb_endpoint') or const.DYNAMODB_ENDPOINT,
+            bounded=True)
+
+    @property
+    def lock_id(self):
+        """Key of the lock item, as terraform writes it"""
+        return f"{self.backend['bucket']}/{self.backend['key']}"
+
+    @traced('state_lock.holder')
+    def holder(self):
+        """Current lock of the state, as {'id', 'who', 'operation', 'created'}.
+        None if the state is not locked, or its lock cannot be read."""
+        if not self.backend.get('dynamodb_table') or not self.backend.get('bucket'):
+            return None
+        import botocore.exceptions  # pylint: disable=import-outside-toplevel
+        try:
+            item = self.dynamodb.get_item(TableName=self.backend['dynamodb_table'],
+                                          Key={'LockID': {'S': self.lock_id}},
+                                          ConsistentRead=True).get('Item')
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as ex:
+            logger.warning("Cannot check the state lock of '%s': %s", self.name, ex)
+            return None
+        if not item:
+            return None
+        try:
+            info = json.loads(item.get('Info', {}).get('S') or '{}')
+        except ValueError:
+            info = dict()
+        return {'id': info.get('ID'), 'who': info.get('Who'),
+                'operation': info.get('Operation'), 'created': info.get('Created')}
+
+    def wait(self, timeout):
+        """Wait for the state to be unlocked, checking it with a jittered backoff.
+        :param float timeout: seconds to wait at most, 0 for a single check
+        :return: whether the state is unlocked"""
+        deadline = time.time() + timeout
+        attempt = 0
+        while True:
+            holder = self.holder()
+            if holder is None:
+                if attempt:
+                    logger.info("State of '%s' unlocked", self.name)
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.error("State of '%s' is locked, %s", self.name, describe(holder))
+                return False
+            delay = min(remaining, backoff(attempt))
+            logger.warning("State of '%s' is locked, %s. Checking again in %.0fs",
+                           self.name, describe(holder), delay)
+            time.sleep(delay)
+            attempt += 1
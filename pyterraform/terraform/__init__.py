@@ -1,12 +1,28 @@
 """All terraform commands, with proper context."""
 import os
+import hashlib
 from copy import deepcopy
-import subprocess
+from pathlib import Path
 import shutil
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 
-from ..logs import logger, get_logger
+from .. import constants as const
+from ..logs import logger, get_logger, LazyJson
+from ..multistack import MultiStack
+from .. import engine
+from ..utils import read_json, write_json
+from ..trace import span, traced
+from ..remote_state import RemoteState, format_outputs
+from .. import state_lock
 from . import binaries
+from . import hcl
+from . import plan_stream
+from . import plan_cache
+from .plugin_cache import PluginCache
+from .module_store import ModuleStore
 
 log = get_logger(__name__, "DEBUG")  # pylint: disable=invalid-name
 
@@ -18,16 +34,29 @@ class Command:
         :param project.Project project: the project on which the commands shall be run"""
         self.project = project
         self.utils = binaries.Utils(project)
+        self._scanner = None
+        self._tf_path = None
 
-    @property
-    def _tf_bin(self):
-        """Terraform binary path"""
-        if not self.project.path.terraform().is_file():
+    @traced('terraform.resolve_binary')
+    def _resolve_tf_bin(self):
+        """Terraform binary of the stack, installed at the configured version when missing"""
+        terraform = self.project.path.terraform()
+        if not terraform.is_file():  # missing, or a dangling link into the binary cache
             self.utils.tf_align_version(self.project.cfg.pyt.get('config.tf_version'))
-        return self.project.path.terraform()
+        version = self.utils.manifest.version_of(terraform)
+        if version:
+            self.utils.manifest.touch(version)
+        return terraform
         #if shutil.which("terraform") is not None:
         #    return shutil.which("terraform")
 
+    @property
+    def _tf_bin(self):
+        """Terraform binary path, resolved once by command"""
+        if self._tf_path is None:
+            self._tf_path = self._resolve_tf_bin()
+        return self._tf_path
+
     def update_tf_version(self, version):
         """Update terraform to the wanted version"""
         self.utils.tf_align_version(version)
@@ -37,49 +66,117 @@ class Command:
         if self.project.cfg.stack.get("terraform_version"):
             self.update_tf_version(self.project.cfg.stack["terraform_version"])
 
+    def _install_provider(self, provider, _config):
+        """Install a single custom provider, return the elapsed time"""
+        start = time.time()
+        index = {'cache_dir': self.utils.releases_cache,
+                 'ttl': self.project.cfg.pyt.get('config.releases_ttl')}
+        if isinstance(_config, str):
+            # This should be the version
+            binaries.download_custom_provider(provider, _config, **index)
+        else:
+            # _config should be a hash of version / extension
+            binaries.download_custom_provider(
+                provider, _config['version'], _config['extension'], **index)
+        return time.time() - start
+
+    @traced('terraform.update_providers')
     def update_tf_providers(self):
-        """Locally install tf providers"""
+        """Locally install tf providers, concurrently"""
         # do we need a custom provider ?
-        for provider, _config in self.project.cfg.stack.get('custom-providers', {}).items():
-            if isinstance(_config, str):
-                # This should be the version
-                binaries.download_custom_provider(provider, _config)
-            else:
-                # _config should be a hash of version / extension
-                binaries.download_custom_provider(
-                    provider, _config['version'], _config['extension'])
+        providers = self.project.cfg.stack.get('terraform.custom-providers', {})
+        if not providers:
+            logger.info("No custom provider to install")
+            return const.RC_OK
+        jobs = self.project.input.args.get('jobs') \
+            or self.project.cfg.pyt.get('config.providers_concurrency')
+        results = dict()
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = {pool.submit(self._install_provider, provider, _config): provider
+                       for provider, _config in providers.items()}
+            for count, future in enumerate(as_completed(futures), 1):
+                provider = futures[future]
+                try:
+                    results[provider] = ('ok', future.result())
+                except Exception as ex:  # pylint: disable=broad-except
+                    results[provider] = ('failed', None)
+                    logger.error("Provider '%s' failed: %s", provider,
+                                 str(ex).split('\n\n')[0])
+                logger.info("[%d/%d] provider '%s' %s", count, len(futures),
+                            provider, results[provider][0])
+        width = max(len(provider) for provider in results)
+        print(f"\n{'Provider':<{width}}  {'Status':<6}  Duration")
+        for provider in sorted(results):
+            status, duration = results[provider]
+            duration = f'{duration:7.1f}s' if duration is not None else '      -'
+            print(f"{provider:<{width}}  {status:<6}  {duration}")
+        if any(status != 'ok' for status, _ in results.values()):
+            return const.RC_KO
+        return const.RC_OK
 
     ##  TF WRAPPING       ##
 
+    @property
+    def scanner(self):
+        """Terraform files scanner, with cache"""
+        if self._scanner is None:
+            self._scanner = hcl.Scanner(self.project.path.run() / 'hcl_cache.json')
+        return self._scanner
+
+    def local_modules(self, folder):
+        """Folders of local modules used by folder, transitively"""
+        seen, todo = set(), [folder]
+        while todo:  # one scan by level of nesting
+            scanned = self.scanner.scan_folders(todo)
+            todo = list()
+            for parent, result in scanned.items():
+                for module in result['modules']:
+                    source = module['source'] or ''
+                    if not source.startswith(('./', '../')):
+                        continue
+                    path = (Path(parent) / os.path.dirname(module['file']) / source).resolve()
+                    if path.is_dir() and path not in seen:
+                        seen.add(path)
+                        todo.append(path)
+        return seen
+
+    def _scan(self):
+        """Providers and modules of the current stack, or of every selected stack with --all
+        :return: {stack name: {'providers': [...], 'modules': [...]}}"""
+        if self.project.input.args.get('all'):
+            stacks = {MultiStack.name(meta): path
+                      for meta, path in MultiStack(self.project).selected()}
+        else:
+            stacks = {None: self.project.path.stack()}
+        results = self.scanner.scan_folders(stacks.values())
+        return {name: results[str(path)] for name, path in stacks.items()}
+
+    def _print_scan(self, key, title, line_format):
+        """Print scanned items as text or json"""
+        scanned = {name: result[key] for name, result in self._scan().items()}
+        if self.project.input.args.get('json'):
+            print(json.dumps(scanned if None not in scanned else {key: scanned[None]},
+                             indent=2, sort_keys=True))
+            return const.RC_OK
+        for name, items in sorted(scanned.items(), key=lambda x: x[0] or ''):
+            print(f"{name}: {title}" if name else f"{title[0].upper()}{title[1:]}:")
+            for item in items:
+                print('  ' + line_format.format(**item))
+        return const.RC_OK
+
     def list_providers(self):
-        """Return list of providers"""
-        cmd = f"""find {self.project.path.stack()} -type f -iname "*.tf" -exec awk '
-          BEGIN {{print "List of providers and versions:"}}
-          / *provider +".*"/ {{
-                PROV = $$2;
-                while ($$0!~/^[^#]*}}/)
-                      {{if ($$0~/^ *version/) match($$0,/version.*= *"(.+)" */,VER);
-                       getline;}};
-                print "  ", PROV, " is " VER[1]}}' {{}} +
-        """
-        print(subprocess.Popen(cmd, shell=True).wait())
+        """Print providers and version constraints"""
+        return self._print_scan('providers', 'list of providers and versions',
+                                '{name} is {version}  ({file}:{line})')
 
     def list_modules(self):
-        """Return list of modules"""
-        cmd = f"""find {self.project.path.stack()} -type f -iname "*.tf" -exec awk '
-          BEGIN {{print "List of modules and required sources:"}}
-          / *module +".*"/ {{
-                USEDBY = USEDBY ", " $$2;
-                while ($$0!~/^[^#]*}}/)
-                {{if ($$0~/^ *source/) match($$0,/ *source *= *"(.+)" */,SOURCE) ;
-                       getline ; }};
-                print "  ", SOURCE[1], " used by ", USEDBY }}' {{}} +
-        """
-        print(subprocess.Popen(cmd, shell=True).wait())
+        """Print modules and their sources"""
+        return self._print_scan('modules', 'list of modules and required sources',
+                                '{source} used by {name}  ({file}:{line})')
 
     def local_install(self):
         """Locally install required binaries for stack execution"""
-        self.update_tf_providers()
+        return self.update_tf_providers()
 
     def version(self):
         """Terraform version wrapper function."""
@@ -95,14 +192,142 @@ class Command:
         tf_params, env = self.project.cfg.context_for('providers')
         return self._run_terraform('providers', tf_params=tf_params, env=env)
 
+    def output(self):
+        """Terraform output, read straight from the remote state when possible:
+        terraform is not run, so the stack needs no init"""
+        tf_params = [x for x in self.project.input.args.get('tf_params') or [] if x != '--']
+        if self.project.input.args.get('json') and '-json' not in tf_params:
+            tf_params.append('-json')
+        names = [x for x in tf_params if not x.startswith('-')]
+        options = set(tf_params) - set(names)
+        state = None
+        if not self.project.input.args.get('terraform') and options <= {'-json'} \
+                and len(names) <= 1:
+            state = self._remote_outputs()
+        if state is None or state.get('version', 4) < 4:
+            log.info("Outputs not read from the remote state, running terraform")
+            _, env = self.project.cfg.context_for('output')
+            return self._run_terraform('output', tf_params=tf_params, env=env)
+        returncode, text = format_outputs(state['outputs'], names[0] if names else None,
+                                          '-json' in options)
+        if returncode == const.RC_OK:
+            print(text)
+        else:
+            logger.error(text)
+        return returncode
+
+    def _remote_outputs(self):
+        """Outputs of the remote state, None when they cannot be read"""
+        import botocore.exceptions  # pylint: disable=import-outside-toplevel
+        try:
+            return RemoteState(self.project).outputs()
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError,
+                ValueError) as ex:  # like access denied, or a truncated state
+            log.debug("Cannot read the remote state: %s", ex)
+            return None
+
+    @property
+    def stack_name(self):
+        """Current stack elements joined, to name its runtime files"""
+        return '_'.join(self.project.input.path[x]
+                        for x in self.project.cfg.pyt.stack_folder_structure)
+
+    def _plan_log(self):
+        """Compressed log of a new plan output, keeping the latest ones of the stack"""
+        stack_name = self.stack_name
+        plans = self.project.path.run() / 'plans'
+        plans.mkdir(exist_ok=True)
+        logs = sorted(plans.glob(f'{stack_name}_*.log.gz'))
+        keep = self.project.cfg.pyt.get('config.plan_logs') - 1
+        for old_log in logs[:max(0, len(logs) - keep)]:
+            old_log.unlink()
+        return plans / f"{stack_name}_{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.log.gz"
+
     def plan(self):
-        """Terraform plan wrapper function."""
-        pipe_plan_command = self.project.cfg.pyt.get('config.pipe_plan_command')
+        """Terraform plan wrapper function.
+        The output is streamed through filters, teed to .run/plans and counted.
+        When the inputs of the plan did not change since the last one of the stack,
+        the saved plan is replayed instead of running terraform."""
+        pipe_plan_command = None
+        if self.project.input.args.get('pipe_plan') \
+                and self.project.cfg.pyt.get('config.pipe_plan_command') != 'cat':
+            pipe_plan_command = self.project.cfg.pyt.get('config.pipe_plan_command')
+        if self.project.cfg.pyt.get('config.always_trigger_init'):
+            logger.info('Init has been activated in config')
+            returncode = self.init()
+            if returncode != const.RC_OK:
+                return returncode
         tf_params, env = self.project.cfg.context_for('plan')
-        return self._run_terraform('plan', tf_params=tf_params, env=env, pipe=pipe_plan_command)
+        stream = plan_stream.PlanStream(
+            filters=self.project.cfg.pyt.get('config.plan_filters'),
+            pipe_command=pipe_plan_command, cwd=self.project.path.stack(), env=env or None)
+        cache, fingerprint = None, None
+        if self.project.cfg.pyt.get('config.plan_cache') \
+                and not self.project.input.args.get('no_plan_cache') \
+                and not any(x.startswith('-out') for x in tf_params):
+            cache = plan_cache.PlanCache(self)
+            with span('terraform.plan_fingerprint'):
+                fingerprint = cache.fingerprint(tf_params)
+        if fingerprint:
+            saved = cache.lookup(fingerprint)
+            if saved:
+                plan_file = cache.replay(stream)
+                logger.info("Plan: %s (inputs unchanged, saved plan is %s)",
+                            stream.progress, plan_file)
+                return saved['returncode']
+            cache.folder.mkdir(parents=True, exist_ok=True)
+            tf_params.append(f'-out={cache.pending_plan}')
+        stream.tee_file = self._plan_log()
+        returncode = self._run_terraform('plan', tf_params=tf_params, env=env, stream=stream)
+        if returncode == const.RC_LOCKED:
+            return returncode
+        logger.info("Plan: %s (output saved to %s)", stream.progress, stream.tee_file)
+        if fingerprint and returncode in (const.RC_OK, 2):
+            cache.store(fingerprint, stream, returncode)
+        return returncode
+
+    @property
+    def _init_state_file(self):
+        """Fingerprint of the last successful init, into the data dir it initialized"""
+        return self.project.cfg.get_tf_data_dir() / 'pyterraform-init.json'
+
+    @traced('terraform.init_fingerprint')
+    def _init_fingerprint(self, tf_params):
+        """Fingerprint of what terraform init depends on"""
+        stack = self.project.path.stack()
+        folders = [stack] + sorted(self.local_modules(stack))
+        scanned = self.scanner.scan_folders(folders)
+        blocks = {key: sorted(json.dumps({k: v for k, v in item.items() if k != 'line'},
+                                         sort_keys=True)
+                              for folder in folders for item in scanned[str(folder)][key])
+                  for key in ('providers', 'modules')}
+        inputs = {'params': tf_params,
+                  'blocks': blocks,
+                  'custom_providers': self.project.cfg.stack.get('terraform.custom-providers'),
+                  'terraform': self.utils.manifest.version_of(self.project.path.terraform())
+                               or self.project.cfg.pyt.get('config.tf_version'),
+                  'data_dir': str(self.project.cfg.get_tf_data_dir())}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def _is_initialized(self, fingerprint):
+        """Whether the last init had the same fingerprint, and its providers are still there"""
+        state = read_json(self._init_state_file)
+        if not state or state.get('fingerprint') != fingerprint:
+            return False
+        data_dir = self.project.cfg.get_tf_data_dir()
+        # plugins of terraform 0.12, providers from 0.13: links to the plugin cache,
+        # to folders of it from 0.14, listed with the files when dangling
+        for folder in (data_dir / 'plugins', data_dir / 'providers'):
+            for dirpath, dirnames, filenames in os.walk(folder, followlinks=True):
+                if not all(os.path.exists(os.path.join(dirpath, x)) for x in filenames) \
+                        or dirpath != str(folder) and not dirnames and not filenames:
+                    return False  # like a provider evicted from the plugin cache
+        return True
 
     def init(self):
-        """Terraform init wrapper function."""
+        """Terraform init wrapper function.
+        Skipped when nothing init depends on changed since the last successful one,
+        unless --force-init is given."""
         tf_params, env = self.project.cfg.context_for('init')
         tf_params.extend(['-input=false',
                           '-force-copy',
@@ -113,50 +338,145 @@ class Command:
         if self.project.cfg.pyt.get('state.backend', {}).get('s3', {}):
             tf_params.append('-backend=true')
             tf_params.extend(self.project.cfg.stack.backend_setup)
-        return self._run_terraform('init', tf_params=tf_params, env=env)
+        fingerprint = self._init_fingerprint(tf_params)
+        if not self.project.input.args.get('force_init') and self._is_initialized(fingerprint):
+            logger.info("Init skipped, nothing changed since the last one (use --force-init)")
+            return const.RC_OK
+        plugin_cache = self.plugin_cache.init(self.project.cfg.get_tf_data_dir(), env)
+        returncode = self._install_modules('init', tf_params, env, plugin_cache)
+        if returncode == const.RC_OK:
+            write_json(self._init_state_file, {'fingerprint': fingerprint, 'time': time.time()},
+                       mode=0o644)
+        return returncode
+
+    def get(self):
+        """Terraform get wrapper function, with modules of the module store"""
+        tf_params, env = self.project.cfg.context_for('get')
+        return self._install_modules('get', tf_params, env)
+
+    def _module_calls(self):
+        """Source and version of the module blocks of the stack, by name"""
+        stack = str(self.project.path.stack())
+        return {module['name']: {'source': module['source'], 'version': module['version']}
+                for module in self.scanner.scan_folders([stack])[stack]['modules']
+                if os.sep not in module['file']}  # not from local modules of the stack
+
+    def _install_modules(self, action, tf_params, env, *contexts):
+        """Run a terraform command installing modules, linking stored ones first
+        and storing new ones after, when the module store is enabled"""
+        modules_dir = self.project.cfg.get_tf_data_dir() / 'modules'
+        calls = self._module_calls() if self.module_store else dict()
+        with ExitStack() as stack:
+            if self.module_store:
+                stack.enter_context(
+                    self.module_store.init(self.project.path.stack(), modules_dir, calls))
+            for context in contexts:
+                stack.enter_context(context)
+            returncode = self._run_terraform(action, tf_params=tf_params, env=env)
+            if self.module_store and returncode == const.RC_OK:
+                self.module_store.harvest(self.project.path.stack(), modules_dir, calls)
+        return returncode
+
+    @property
+    def module_store(self):
+        """Remote modules shared by the stacks, None if disabled"""
+        if not self.project.cfg.pyt.get('config.module_store'):
+            return None
+        return ModuleStore(self.project.path.module_store())
+
+    @property
+    def plugin_cache(self):
+        """Plugin cache shared by the stacks"""
+        max_mb = self.project.cfg.pyt.get('config.plugin_cache_max_mb')
+        return PluginCache(self.project.cfg.get_plugin_cache_dir(),
+                           max_mb * 2**20 if max_mb is not None else None)
+
+    def cache(self):
+        """Show usage of the plugin and binary caches, or prune them"""
+        if self.project.input.args.get('action') == 'prune':
+            logger.info("Evicted %d providers", self.plugin_cache.prune())
+            logger.info("Evicted %d terraform versions", len(self.utils.tf_cache_prune()))
+        stats = self.plugin_cache.stats()
+        binaries_stats = self.utils.tf_cache_stats()
+        modules_stats = self.module_store.stats() if self.module_store else None
+        if self.project.input.args.get('json'):
+            print(json.dumps({'plugins': stats, 'binaries': binaries_stats,
+                              'modules': modules_stats}, indent=2))
+            return const.RC_OK
+        hit_rate = f"{100 * stats['hit_rate']:.0f}%" if stats['hit_rate'] is not None else '-'
+        limit = f"{stats['max_size'] / 2**20:.0f} MB" if stats['max_size'] else 'none'
+        print(f"Plugin cache {stats['folder']}\n"
+              f"  providers:   {stats['providers']}\n"
+              f"  size:        {stats['size'] / 2**20:.1f} MB (limit {limit})\n"
+              f"  hit rate:    {hit_rate} ({stats['hits']} hits, {stats['misses']} misses)\n"
+              f"  bytes saved: {stats['bytes_saved'] / 2**20:.1f} MB\n"
+              f"  evicted:     {stats['evicted']}")
+        limits = list()
+        if binaries_stats['max_size']:
+            limits.append(f"{binaries_stats['max_size'] / 2**20:.0f} MB")
+        if binaries_stats['max_versions']:
+            limits.append(f"{binaries_stats['max_versions']} versions")
+        limit = ', '.join(limits) or 'none'
+        print(f"\nTerraform binary cache {binaries_stats['folder']}\n"
+              f"  size:        {binaries_stats['size'] / 2**20:.1f} MB (limit {limit})")
+        for item in binaries_stats['versions']:
+            print(f"  {item['version']:<12} {item['size'] / 2**20:6.1f} MB  last used "
+                  f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(item['used']))}"
+                  f"{'  (in use)' if item['protected'] else ''}")
+        if modules_stats:
+            print(f"\nModule store {modules_stats['folder']}\n"
+                  f"  modules:     {modules_stats['modules']} ({modules_stats['trees']} trees)\n"
+                  f"  size:        {modules_stats['size'] / 2**20:.1f} MB")
+        return const.RC_OK
+
+    def _state_unlocked(self, tf_params):
+        """Whether the state is not locked by someone else, not to start a terraform run
+        that would fail on the lock. Like terraform, fails fast unless asked to wait for it
+        by the environment: state_lock_wait only applies to the stacks of run-all."""
+        if not self.project.cfg.pyt.get('config.state_lock_check') \
+                or '-lock=false' in (tf_params or []):
+            return True
+        timeout = float(self.project.input.environment.get(const.LOCK_WAIT_ENV) or 0)
+        if state_lock.StateLock(self.project).wait(timeout):
+            return True
+        if not timeout:
+            logger.info("Set %s to the seconds to wait for the lock", const.LOCK_WAIT_ENV)
+        return False
 
-    def _run_terraform(self, action, tf_params=None, env=None, pipe=None):
-        """Run Terraform command."""
+    def _run_terraform(self, action, tf_params=None, env=None, stream=None):
+        """Run Terraform command.
+        :param plan_stream.PlanStream stream: consumer of the command output, if any"""
         # support for custom parameters
         command = [self._tf_bin, action]
         if tf_params is not None:
             if tf_params and tf_params[0] == '--':
                 tf_params = tf_params[1:]
             command += tf_params
+        if action in state_lock.LOCKING_COMMANDS and not self._state_unlocked(tf_params):
+            return const.RC_LOCKED
 
         cmd_env = env if env else deepcopy(os.environ)
 
-        with subprocess.Popen(command, cwd=self.project.path.stack(),
-                              env=cmd_env, shell=False,
-                              stdout=subprocess.PIPE if pipe else None) as process:
-            logger.debug('Execute command "%s"', command)
-            log.info("Running command: '%s'", ' '.join([str(x) for x in command]))
-            log.info("On path '%s'", self.project.path.stack())
-            #log.info('And with env: %s', {x: cmd_env[x] for x in sorted(dict(cmd_env))})
-            log.info('And with env: %s', json.dumps(dict(cmd_env), indent=2, sort_keys=True))
-            if pipe:
-                logger.debug('Piping command "%s"', pipe)
-                with subprocess.Popen(pipe, cwd=self.project.path.stack(),
-                                      env=cmd_env, shell=False,
-                                      stdin=process.stdout) as pipe_process:
-                    try:
-                        pipe_process.communicate()
-                    except KeyboardInterrupt:
-                        logger.warning('Received Ctrl+C')
-                    except:  # noqa
-                        pipe_process.kill()
-                        pipe_process.wait()
-                        raise
-                    pipe_process.poll()
+        job = engine.Job(command, cwd=self.project.path.stack(), env=cmd_env,
+                         timeout=self.project.cfg.pyt.get('config.timeouts').get(action),
+                         on_line=(lambda _job, _name, line, partial: stream.feed(line, partial))
+                         if stream else None,
+                         capture_stdout=bool(stream), capture_stderr=False, interactive=True)
+        logger.debug('Execute command "%s"', command)
+        log.info("Running command: '%s'", ' '.join(job.command))
+        log.info("On path '%s'", self.project.path.stack())
+        #log.info('And with env: %s', {x: cmd_env[x] for x in sorted(dict(cmd_env))})
+        log.debug('And with env: %s', LazyJson(dict(cmd_env)))
+        with span(f'terraform.{action}', cwd=str(self.project.path.stack())):
+            if stream:
+                stream.start()
             try:
-                process.communicate()
-            except KeyboardInterrupt:
-                logger.warning('Received Ctrl+C')
-            except:  # noqa
-                process.kill()
-                process.wait()
-                raise
-            return process.poll()
+                returncode = engine.run(job)
+            finally:
+                if stream:
+                    stream.finish()
+        log.debug("Terraform %s resources: %s", action, job.rusage)
+        return returncode
 
     def run(self):
         """Execute the command asked for by the cli input"""
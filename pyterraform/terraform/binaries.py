@@ -5,42 +5,111 @@ import shutil
 import re
 import subprocess
 import tempfile
-import zipfile
+import time
+from contextlib import contextmanager
 from pathlib import Path
-import requests
 
 from .. import constants as const
 from ..logs import logger
-from ..utils import error
-
-
-def search_on_github(repo, minor_version, patch_regex, patch, terraform=True):
-    """Search release on github."""
-    # Start search from the next incremented minor version
-    # Note: the github UI serves the first page if the requested version does not exist
-    release = 'v{}{}.0'.format(minor_version[:-1], int(minor_version[-1])+1)
-    releases_count = 0
-    while True:
-        result = requests.get('{}?after={}'.format(const.GITHUB_RELEASES.format(repo), release))
-        releases = re.findall(r'<a href=\"/{}/releases/tag/.*\">(.*)</a>'.format(repo), result.text)
-        releases_count += len(releases)
-        for release in releases:
-            if re.match(r'^v{}\.{}$'.format(minor_version, patch if patch else patch_regex),
-                        release):
-                patch = patch or release.split('.')[-1]
-                return patch
-            # hard limit or it will takes too long time and terraform versions older
-            # than 0.7 do not respect naming convention
-            if terraform and any(const.LIMIT_TERRAFORM_VERSION in r for r in releases):
-                return None
-            if releases_count > const.LIMIT_GITHUB_RELEASES:
+from ..utils import error, read_json, write_json, file_lock, sha256sum
+from ..trace import traced
+from .download import download, sha256sums
+from .releases import ReleaseIndex
+
+
+def extract_binaries(archive, dest_dir):
+    """Extract an archive and move its files, made executable, into dest_dir.
+    Each file appears at once in dest_dir, never partially written."""
+    os.makedirs(dest_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix='.extract-', dir=dest_dir)
+    try:
+        shutil.unpack_archive(str(archive), tmp_dir)
+        for name in os.listdir(tmp_dir):
+            path = os.path.join(tmp_dir, name)
+            # Permissions not preserved on extract https://bugs.python.org/issue15795
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            os.replace(path, os.path.join(dest_dir, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class VersionManifest:
+    """Versions of the extracted terraform binaries, to know the version of a binary
+    without running it. Each entry records the binary identity (size, inode and
+    mtime): an entry not matching the binary on disk anymore is stale.
+    Entries also record when the version was last used, and the manifest which
+    project binaries (<root>/terraform symlinks) point to a version."""
+
+    # Last use time is written at most once per this period, per version
+    TOUCH_PERIOD = 3600
+
+    def __init__(self, cache_dir):
+        self.file = Path(cache_dir) / 'manifest.json'
+
+    @property
+    def data(self):
+        """Whole manifest"""
+        data = read_json(self.file, dict(), memo=True)
+        data.setdefault('versions', dict())
+        data.setdefault('links', dict())
+        return data
+
+    @property
+    def entries(self):
+        """Recorded binaries, by version"""
+        return self.data['versions']
+
+    @contextmanager
+    def update(self):
+        """Locked read-modify-write of the manifest"""
+        with file_lock(self.file.with_suffix('.lock')):
+            data = self.data
+            yield data
+            write_json(self.file, data, mode=0o644)
+
+    @staticmethod
+    def _identity(stat_):
+        return {'size': stat_.st_size, 'inode': stat_.st_ino, 'mtime_ns': stat_.st_mtime_ns}
+
+    def record(self, version, binary):
+        """Record the binary of the given version"""
+        binary = os.path.realpath(binary)
+        entry = {'path': binary, 'sha256': sha256sum(binary), 'used': time.time()}
+        entry.update(self._identity(os.stat(binary)))
+        with self.update() as data:
+            data['versions'][version] = entry
+        logger.debug("Recorded terraform %s in version manifest", version)
+
+    def touch(self, version):
+        """Record the use of a version, if not done recently"""
+        entry = self.entries.get(version)
+        if entry is None or time.time() - entry.get('used', 0) < self.TOUCH_PERIOD:
+            return
+        with self.update() as data:
+            if version in data['versions']:
+                data['versions'][version]['used'] = time.time()
+
+    def link(self, symlink, version):
+        """Record that a project binary points to the given version"""
+        with self.update() as data:
+            data['links'][str(symlink)] = version
+            if version in data['versions']:
+                data['versions'][version]['used'] = time.time()
+
+    def version_of(self, binary):
+        """Version of the binary (following symlinks), None if unknown or stale"""
+        binary = os.path.realpath(binary)
+        try:
+            identity = self._identity(os.stat(binary))
+        except FileNotFoundError:
+            return None
+        for version, entry in self.entries.items():
+            if entry.get('path') == binary:
+                if all(entry.get(key) == value for key, value in identity.items()):
+                    return version
                 return None
-        if len(releases) < 1:
-            # no more versions available
-            break
+        return None
 
-        release = releases[-1:][0]
-    return None
 
 class Utils:
     """Utility for binary management"""
@@ -52,31 +121,111 @@ class Utils:
         """Where tf binary versions are stored"""
         return Path(self.project.cfg.pyt.get('config.tf_binary_cache'))
 
+    @property
+    def manifest(self):
+        """Versions of cached tf binaries"""
+        return VersionManifest(self._tf_binary_cache)
+
+    @property
+    def releases_cache(self):
+        """Where release indexes of github repositories are stored"""
+        return self._tf_binary_cache / 'releases'
+
     def tf_cached_version(self, version):
         """Cached file binary location"""
         return self._tf_binary_cache / 'versions' / version / 'terraform'
 
+    @traced('binaries.tf_download')
     def tf_download(self, version):
         """Download the wanted version"""
         if not self.tf_cached_version(version).is_file():
-            os.makedirs(self.tf_cached_version(version).parent, exist_ok=True)
-
             # Download and extract in user's home if needed
             logger.warning("Version does not exist locally, downloading it")
-            _, tmp_file = tempfile.mkstemp(prefix='terraform-', suffix='.zip')
-            get = requests.get(
-                f'https://releases.hashicorp.com/terraform/{version}/'
-                f'terraform_{version}_{const.PLATFORM_SYSTEM}_{const.ARCH_NAME}.zip',
-                stream=True)
-            with open(tmp_file, 'wb') as _fd:
-                for chunk in get.iter_content(chunk_size=128):
-                    _fd.write(chunk)
-            with zipfile.ZipFile(tmp_file, 'r') as zip_:
-                zip_.extractall(path=self.tf_cached_version(version).parent)
-            # Permissions not preserved on extract https://bugs.python.org/issue15795
-            os.chmod(self.tf_cached_version(version),
-                     stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-            os.remove(tmp_file)
+            base_url = f'{const.HASHICORP_RELEASES}/terraform/{version}'
+            archive = f'terraform_{version}_{const.PLATFORM_SYSTEM}_{const.ARCH_NAME}.zip'
+            downloads = self._tf_binary_cache / 'downloads'
+            with file_lock(downloads / f'terraform_{version}.lock'):
+                if self.tf_cached_version(version).is_file():
+                    return  # another process did it meanwhile
+                sums = sha256sums(f'{base_url}/terraform_{version}_SHA256SUMS') or dict()
+                if archive not in sums:
+                    logger.warning("No SHA256SUMS published for %s, checksum not verified",
+                                   archive)
+                download(f'{base_url}/{archive}', downloads / archive, sums.get(archive))
+                extract_binaries(downloads / archive, self.tf_cached_version(version).parent)
+                os.remove(downloads / archive)
+                self.manifest.record(version, self.tf_cached_version(version))
+            self.tf_cache_prune()
+
+    def _tf_cache_content(self, data):
+        """Cached versions, as {version: (folder, size, last use)}"""
+        content = dict()
+        versions_dir = self._tf_binary_cache / 'versions'
+        for folder in versions_dir.iterdir() if versions_dir.is_dir() else ():
+            size = sum(x.stat().st_size for x in folder.iterdir() if x.is_file())
+            used = data['versions'].get(folder.name, {}).get('used', folder.stat().st_mtime)
+            content[folder.name] = (folder, size, used)
+        return content
+
+    def _tf_cache_protected(self, data):
+        """Versions which must stay in cache: linked from a project, or pinned by config.
+        Links not pointing to the cached version anymore are forgotten."""
+        current = Path(os.path.realpath(self.project.path.terraform()))
+        if self.project.path.terraform().is_symlink() \
+                and current.parent.parent == (self._tf_binary_cache / 'versions').resolve():
+            data['links'][str(self.project.path.terraform())] = current.parent.name
+        cached = {link: os.path.realpath(self.tf_cached_version(version))
+                  for link, version in data['links'].items()}
+        data['links'] = {link: version for link, version in data['links'].items()
+                         if os.path.islink(link) and os.path.realpath(link) == cached[link]}
+        return set(data['links'].values()) | {self.project.cfg.pyt.get('config.tf_version')}
+
+    @property
+    def _tf_cache_limits(self):
+        """Maximum size in bytes and count of cached versions, None for no limit"""
+        max_mb = self.project.cfg.pyt.get('config.tf_binary_cache_max_mb')
+        return (max_mb * 2**20 if max_mb is not None else None,
+                self.project.cfg.pyt.get('config.tf_binary_cache_max_versions'))
+
+    @traced('binaries.tf_cache_prune')
+    def tf_cache_prune(self):
+        """Evict the least recently used versions beyond the cache limits.
+        :return: evicted versions"""
+        max_size, max_versions = self._tf_cache_limits
+        evicted = list()
+        with self.manifest.update() as data:
+            protected = self._tf_cache_protected(data)
+            content = self._tf_cache_content(data)
+            size = sum(x[1] for x in content.values())
+            count = len(content)
+            for version, (folder, version_size, _) in sorted(content.items(),
+                                                             key=lambda item: item[1][2]):
+                if (max_size is None or size <= max_size) \
+                        and (max_versions is None or count <= max_versions):
+                    break
+                if version in protected:
+                    continue
+                logger.info("Evicting terraform %s from the binary cache", version)
+                shutil.rmtree(folder)
+                data['versions'].pop(version, None)
+                size, count = size - version_size, count - 1
+                evicted.append(version)
+        return evicted
+
+    def tf_cache_stats(self):
+        """Content of the binary cache"""
+        with self.manifest.update() as data:
+            protected = self._tf_cache_protected(data)
+            content = self._tf_cache_content(data)
+        max_size, max_versions = self._tf_cache_limits
+        return {'folder': str(self._tf_binary_cache),
+                'size': sum(x[1] for x in content.values()),
+                'max_size': max_size,
+                'max_versions': max_versions,
+                'versions': [{'version': version, 'size': version_size, 'used': used,
+                              'protected': version in protected}
+                             for version, (_, version_size, used)
+                             in sorted(content.items(), key=lambda item: -item[1][2])]}
 
     def update_tf_symlink(self, version):
         """Create local link to cached one"""
@@ -86,8 +235,24 @@ class Utils:
         if not self.tf_cached_version(version).is_file():
             self.tf_download(version)
         self.project.path.terraform().symlink_to(self.tf_cached_version(version))
+        self.manifest.link(self.project.path.terraform(), version)
         logger.warning("Switch done, current terraform version is %s", version)
 
+    @traced('binaries.tf_probe_version')
+    def tf_probe_version(self):
+        """Version of the current tf binary, as printed by itself"""
+        try:
+            pr_ = subprocess.run([self.project.path.terraform(), '-v'],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 check=True)
+        except FileNotFoundError:
+            return 'not installed'
+        current_version = re.match(r'^Terraform v(.+)', pr_.stdout.decode('ascii')).group(1)
+        self.manifest.record(current_version, self.project.path.terraform())
+        return current_version
+
+    @traced('binaries.tf_align_version')
     def tf_align_version(self, version):
         """Align the tf binary to the one of the wanted version"""
         regex_version = r'(?P<major>[0-9]+)\.(?P<minor>[0-9]+)\.(?P<patch>[0-9]+)'
@@ -96,16 +261,10 @@ class Utils:
             print(match)
             error('The terraform version seems not correct, '
                   'it should be a version number like "X.Y.Z"')
-        # Getting current version
-        try:
-            pr_ = subprocess.run([self.project.path.terraform(), '-v'],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 check=True)
-            current_version = re.match(r'^Terraform v(.+)',
-                                       pr_.stdout.decode('ascii')).group(1)
-        except FileNotFoundError:
-            current_version = 'not installed'
+        # Getting current version, running the binary only if unknown to the manifest
+        current_version = self.manifest.version_of(self.project.path.terraform())
+        if current_version is None:
+            current_version = self.tf_probe_version()
 
         if current_version == version:
             logger.debug("Terraform is already on version %s", version)
@@ -117,37 +276,28 @@ class Utils:
         self.update_tf_symlink(version)
 
 
-def download_custom_provider(provider_name, provider_version, extension="zip"):
-    """Download Terraform custom provider."""
+def download_custom_provider(provider_name, provider_version, extension="zip",
+                             cache_dir=None, ttl=3600):
+    """Download Terraform custom provider.
+    :param str provider_version: a version, or a version constraint like "~> 1.2"
+    :param str cache_dir: where the release index of the provider is cached
+    :param int ttl: maximum age of the release index"""
     logger.info("Checking custom Terraform provider '%s' at version '%s'",
                 provider_name, provider_version)
-    github_base = 'https://github.com/'
-    github_endpoint = f"{github_base}{provider_name}"
     supported_extensions = ["zip", "tar.gz", "tar.bz2"]
 
     if extension not in supported_extensions:
         error(f"Extension {extension} is not supported. "
               f"Only {', '.join(supported_extensions)} are.")
 
-    req = requests.get(github_endpoint)
-    if req.status_code != 200:
-        error(f"The terraform provider {provider_name} does not exist ({github_endpoint})")
-
-    match = re.match(r'^v?([0-9]+.[0-9]+).?([0-9]+)?(-[a-z]+)?$', provider_version)
-    if not match:
-        error('The provider version does not seem correct, it should be a version number like '
-              '"X.Y", "X.Y.Z" or "X.Y.Z-custom"')
-    minor_version, patch, custom = match.groups()
-
-    patch = search_on_github(provider_name, minor_version, r'[0-9]+(-[a-z_-]+)?',
-                             patch, terraform=False)
-
-    if not patch:
+    try:
+        tag = ReleaseIndex(provider_name, cache_dir, ttl).resolve(provider_version)
+    except ValueError as ex:
+        error(str(ex))
+    if not tag:
         error(f"The provider version '{provider_name}-{provider_version}' does not exist")
 
-    full_version = f"{minor_version}.{patch}"
-    # Getting current version
-
+    full_version = tag.lstrip('v')
     plugins_path = os.path.expanduser(
         f'~/.terraform.d/plugins/{const.PLATFORM_SYSTEM}_{const.ARCH_NAME}')
     os.makedirs(plugins_path, exist_ok=True)
@@ -163,19 +313,21 @@ def download_custom_provider(provider_name, provider_version, extension="zip"):
     if not os.path.isfile(tf_bin_path):
         # Download and extract in user's home if needed
         logger.warning("Provider version does not exist locally, downloading it")
-        handle, tmp_file = tempfile.mkstemp(prefix='terraform-', suffix="." + extension)
-        req = requests.get(
-            f'https://github.com/{provider_name}/releases/download/v{full_version}/'
-            f'{bin_name}_{const.PLATFORM_SYSTEM}_{const.ARCH_NAME}.{extension}',
-            stream=True)
-        with open(tmp_file, 'wb') as fd_:
-            for chunk in req.iter_content(chunk_size=128):
-                fd_.write(chunk)
-        shutil.unpack_archive(tmp_file, plugins_path)
-        # Permissions not preserved on extract https://bugs.python.org/issue15795
-        os.chmod(tf_bin_path,
-                 os.stat(tf_bin_path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
-        os.remove(tmp_file)
+        base_url = f'{const.GITHUB_BASE}/{provider_name}/releases/download/{tag}'
+        archive = f'{bin_name}_{const.PLATFORM_SYSTEM}_{const.ARCH_NAME}.{extension}'
+        downloads = os.path.join(plugins_path, '.downloads')
+        with file_lock(os.path.join(downloads, f'{bin_name}.lock')):
+            if os.path.isfile(tf_bin_path):
+                logger.debug("Provider downloaded meanwhile by another process")
+                return
+            sums = sha256sums(f'{base_url}/{bin_name}_SHA256SUMS')
+            if sums is None:
+                logger.warning("No SHA256SUMS published for %s, checksum not verified",
+                               provider_name)
+            download(f'{base_url}/{archive}', os.path.join(downloads, archive),
+                     (sums or dict()).get(archive))
+            extract_binaries(os.path.join(downloads, archive), plugins_path)
+            os.remove(os.path.join(downloads, archive))
         logger.info("Download done, current provider version is %s", full_version)
     else:
         logger.debug("Current provider version is already %s", full_version)
@@ -0,0 +1,101 @@
+"""Download engine for terraform and provider archives.
+
+Downloads share a pooled http session, are written by large chunks into a
+partial file that is resumed with http Range requests after a failure, are
+verified against SHA256SUMS and renamed in place only once complete. A lock
+file let concurrent processes requesting the same file download it once."""
+import os
+import time
+import threading
+
+from ..logs import logger
+from ..utils import file_lock, sha256sum
+
+CHUNK_SIZE = 2**20
+RETRIES = 4
+BACKOFF = 1.5
+TIMEOUT = (10, 60)
+
+_LOCAL = threading.local()
+
+
+class DownloadError(Exception):
+    """Download failed, after all retries or because of a checksum mismatch"""
+
+
+def http_session():
+    """Pooled http session, one per thread"""
+    if getattr(_LOCAL, 'session', None) is None:
+        import requests  # pylint: disable=import-outside-toplevel
+        from requests.adapters import HTTPAdapter  # pylint: disable=import-outside-toplevel
+        _LOCAL.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        _LOCAL.session.mount('https://', adapter)
+        _LOCAL.session.mount('http://', adapter)
+    return _LOCAL.session
+
+
+def sha256sums(url):
+    """Parse a SHA256SUMS file into {filename: digest}, None if not published"""
+    response = http_session().get(url, timeout=TIMEOUT)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    sums = dict()
+    for line in response.text.splitlines():
+        if line.strip():
+            digest, name = line.split(None, 1)
+            sums[name.strip().lstrip('*')] = digest.lower()
+    return sums
+
+
+def _fetch(url, part):
+    """Fetch url into the partial file, resuming from its current size"""
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with http_session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 416:
+            return  # partial file is already complete
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            logger.debug("Server ignored range request, restarting download of %s", url)
+            offset = 0
+        elif offset:
+            logger.info("Resuming download of %s from byte %d", url, offset)
+        with open(part, 'r+b' if offset else 'wb', buffering=CHUNK_SIZE) as _f:
+            _f.seek(offset)
+            _f.truncate()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                _f.write(chunk)
+
+
+def download(url, dest, sha256=None):
+    """Download url to dest once, even with concurrent callers.
+    :param str sha256: expected hex digest, if known
+    :return: dest"""
+    import requests  # pylint: disable=import-outside-toplevel
+    dest = str(dest)
+    part = dest + '.part'
+    with file_lock(dest + '.lock'):
+        if os.path.isfile(dest) and (sha256 is None or sha256sum(dest) == sha256):
+            logger.debug("%s already downloaded", dest)
+            return dest
+        for attempt in range(1, RETRIES + 1):
+            try:
+                _fetch(url, part)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                    requests.exceptions.ChunkedEncodingError) as ex:
+                if isinstance(ex, requests.HTTPError) and ex.response is not None \
+                        and ex.response.status_code < 500:
+                    raise DownloadError(f"Cannot download {url}: {ex}") from ex
+                logger.warning("Download of %s failed (%s), attempt %d/%d",
+                               url, ex, attempt, RETRIES)
+                if attempt == RETRIES:
+                    raise DownloadError(f"Cannot download {url}: {ex}") from ex
+            time.sleep(BACKOFF ** attempt)
+        if sha256 is not None and sha256sum(part) != sha256:
+            os.remove(part)
+            raise DownloadError(f"Checksum mismatch for {url}")
+        os.replace(part, dest)
+    return dest
@@ -0,0 +1,230 @@
+"""In-process scanner of terraform files, extracting providers and modules.
+
+This is not a full HCL parser: it tokenizes enough of the language (strings,
+interpolations, heredocs, comments and braces) to follow the block nesting and
+to read the string attributes of provider, module and required_providers blocks.
+Per-file results are cached by content hash, so only changed files are parsed."""
+import os
+import re
+import time
+import hashlib
+from concurrent import futures
+
+from ..utils import read_json, write_json
+
+# Below this number of files to parse, a process pool costs more than it saves
+POOL_THRESHOLD = 32
+CACHE_RETENTION = 30 * 24 * 3600
+# Last use of cache hits is persisted at most this often
+USED_REFRESH = 24 * 3600
+CACHE_VERSION = 2
+
+IDENT = re.compile(r'[A-Za-z_][A-Za-z0-9_.-]*')
+HEREDOC = re.compile(r'<<-?\s*([A-Za-z_][A-Za-z0-9_]*)\s*\n')
+
+
+def _read_string(text, pos):
+    """Read a quoted string starting at pos, return (value, end position).
+    Interpolations are kept verbatim."""
+    value, pos, depth = list(), pos + 1, 0
+    while pos < len(text):
+        char = text[pos]
+        if char == '\\' and pos + 1 < len(text):
+            value.append(text[pos:pos + 2] if depth else text[pos + 1])
+            pos += 2
+            continue
+        if char == '"' and depth == 0:
+            return ''.join(value), pos + 1
+        if text.startswith('${', pos) or text.startswith('%{', pos):
+            depth += 1
+            value.append(text[pos:pos + 2])
+            pos += 2
+            continue
+        if char == '}' and depth:
+            depth -= 1
+        elif char == '\n' and depth == 0:
+            break  # unterminated string
+        value.append(char)
+        pos += 1
+    return ''.join(value), pos
+
+
+def tokenize(text):
+    """Yield (kind, value, line) tokens; kind among ident, string, {, }, =, nl, other"""
+    pos, line = 0, 1
+    while pos < len(text):
+        char = text[pos]
+        if char == '\n':
+            yield 'nl', None, line
+            line += 1
+            pos += 1
+        elif char in ' \t\r':
+            pos += 1
+        elif char == '#' or text.startswith('//', pos):
+            end = text.find('\n', pos)
+            pos = len(text) if end < 0 else end
+        elif text.startswith('/*', pos):
+            end = text.find('*/', pos + 2)
+            end = len(text) if end < 0 else end + 2
+            line += text.count('\n', pos, end)
+            pos = end
+        elif char == '"':
+            value, end = _read_string(text, pos)
+            yield 'string', value, line
+            line += text.count('\n', pos, end)
+            pos = end
+        elif text.startswith('<<', pos) and HEREDOC.match(text, pos):
+            match = HEREDOC.match(text, pos)
+            closing = re.compile(r'^\s*' + re.escape(match.group(1)) + r'\s*$', re.M)
+            end_match = closing.search(text, match.end())
+            end = end_match.end() if end_match else len(text)
+            yield 'string', text[match.end():end_match.start() if end_match else end], line
+            line += text.count('\n', pos, end)
+            pos = end
+        elif char in '{}=,':
+            if char == '=' and text.startswith('==', pos):
+                yield 'other', '==', line
+                pos += 2
+            else:
+                yield ('nl' if char == ',' else char), char, line
+                pos += 1
+        else:
+            match = IDENT.match(text, pos)
+            if match:
+                yield 'ident', match.group(), line
+                pos = match.end()
+            else:
+                yield 'other', char, line
+                pos += 1
+
+
+def scan(text):
+    """Extract providers and modules declared in a terraform source.
+    :return: {'providers': [...], 'modules': [...]}, each item holding a line"""
+    providers, modules = list(), list()
+    stack = list()  # open blocks as (type, labels, record)
+    statement = list()
+    for kind, value, line in tokenize(text):
+        if kind == '{':
+            words = [v for k, v, _ in statement if k in ('ident', 'string')]
+            record = None
+            if len(statement) >= 2 and statement[-1][0] == '=':
+                # object value, like `aws = { source = ... }` into required_providers
+                kind_ = ('object', [statement[-2][1]])
+                if stack and stack[-1][0] == 'required_providers':
+                    record = {'name': statement[-2][1], 'version': None, 'source': None,
+                              'line': statement[-2][2]}
+                    providers.append(record)
+            elif words and all(k in ('ident', 'string') for k, _, _ in statement):
+                kind_ = (words[0], words[1:])
+                if not stack and words[0] == 'provider' and len(words) > 1:
+                    record = {'name': words[1], 'version': None, 'source': None,
+                              'line': statement[0][2]}
+                    providers.append(record)
+                elif not stack and words[0] == 'module' and len(words) > 1:
+                    record = {'name': words[1], 'source': None, 'version': None,
+                              'line': statement[0][2]}
+                    modules.append(record)
+            else:
+                kind_ = ('other', [])
+            stack.append(kind_ + (record,))
+            statement = list()
+        elif kind in ('nl', '}'):
+            # an attribute ends with its line, or with its one-line block
+            if len(statement) == 3 and statement[0][0] == 'ident' \
+                    and statement[1][0] == '=' and statement[2][0] == 'string' and stack:
+                key, string = statement[0][1], statement[2][1]
+                record = stack[-1][2]
+                if record is not None and key in ('source', 'version'):
+                    record[key] = string
+                elif stack[-1][0] == 'required_providers':
+                    providers.append({'name': key, 'version': string, 'source': None,
+                                      'line': statement[0][2]})
+            statement = list()
+            if kind == '}' and stack:
+                stack.pop()
+        else:
+            statement.append((kind, value, line))
+    return {'providers': providers, 'modules': modules}
+
+
+def scan_file(path):
+    """Scan a terraform file"""
+    with open(path, encoding='utf-8', errors='replace') as _f:
+        return scan(_f.read())
+
+
+def tf_files(folder):
+    """Terraform files under folder, skipping hidden folders like .terraform"""
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = sorted(x for x in dirnames if not x.startswith('.'))
+        for name in sorted(filenames):
+            if name.endswith('.tf'):
+                yield os.path.join(dirpath, name)
+
+
+class Scanner:
+    """Scanner of stack folders, caching per-file results by content hash"""
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._cache = None
+        self._dirty = False
+
+    @property
+    def cache(self):
+        """Scan results by file content hash, without the ones unused for a long time"""
+        if self._cache is None:
+            cache = read_json(self.cache_file, dict())
+            files = cache.get('files', dict()) if cache.get('version') == CACHE_VERSION \
+                else dict()
+            now = time.time()
+            self._cache = {digest: entry for digest, entry in files.items()
+                           if now - entry['used'] < CACHE_RETENTION}
+            self._dirty = len(self._cache) != len(files)
+        return self._cache
+
+    def save(self):
+        """Persist the cache"""
+        write_json(self.cache_file, {'version': CACHE_VERSION, 'files': self.cache},
+                   mode=0o644)
+        self._dirty = False
+
+    def scan_files(self, paths):
+        """Scan results of many files, as {path: result}; cache misses are parsed
+        in parallel when numerous"""
+        digests, todo = dict(), dict()
+        for path in paths:
+            with open(path, 'rb') as _f:
+                digests[path] = hashlib.sha256(_f.read()).hexdigest()
+            if digests[path] not in self.cache:
+                todo.setdefault(digests[path], path)
+        if len(todo) >= POOL_THRESHOLD:
+            with futures.ProcessPoolExecutor() as pool:
+                results = list(pool.map(scan_file, todo.values(), chunksize=8))
+        else:
+            results = [scan_file(path) for path in todo.values()]
+        now = time.time()
+        for digest, result in zip(todo, results):
+            self.cache[digest] = {'result': result, 'used': now}
+        for digest in set(digests.values()):
+            if now - self.cache[digest]['used'] > USED_REFRESH:
+                self.cache[digest]['used'] = now
+                self._dirty = True
+        if todo or self._dirty:  # not on plain cache hits
+            self.save()
+        return {path: self.cache[digest]['result'] for path, digest in digests.items()}
+
+    def scan_folders(self, folders):
+        """Providers and modules of each folder, with file locations.
+        :return: {folder: {'providers': [...], 'modules': [...]}}"""
+        files = {str(folder): list(tf_files(folder)) for folder in folders}
+        results = self.scan_files([path for paths in files.values() for path in paths])
+        scanned = dict()
+        for folder, paths in files.items():
+            scanned[folder] = {'providers': list(), 'modules': list()}
+            for path in paths:
+                for key, items in results[path].items():
+                    scanned[folder][key].extend(
+                        dict(item, file=os.path.relpath(path, folder)) for item in items)
+        return scanned
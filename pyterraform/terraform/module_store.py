@@ -0,0 +1,212 @@
+"""Content-addressed store of remote modules, shared by all the stacks.
+
+Terraform downloads the git and registry modules of each stack into its own data
+directory. After an init, the pinned ones (registry modules with an exact version,
+other sources with a ref) are stored once per content digest, with a ref file by
+source and version, and the module folders of the stack become symlinks to them.
+Before an init, the stored modules of a stack are linked and recorded into its
+modules.json, so terraform does not download them again. Missing modules are
+locked during the init fetching them, so that concurrent stacks fetch each once."""
+import os
+import re
+import json
+import time
+import stat
+import shutil
+import hashlib
+import tempfile
+from functools import partial
+from contextlib import contextmanager, ExitStack
+from pathlib import Path
+
+from ..logs import logger
+from ..utils import read_json, write_json, file_lock
+
+# [host/]namespace/name/provider
+REGISTRY_SOURCE = re.compile(r'^([\w.-]+/)?[\w-]+/[\w-]+/[\w-]+$')
+EXACT_VERSION = re.compile(r'^=?\s*v?\d+\.\d+\.\d+([-+][\w.-]+)?$')
+GIT_REF = re.compile(r'[?&]ref=')
+
+
+def pinned(source, version):
+    """Whether a module source always designates the same content"""
+    if not source or source.startswith(('./', '../', '/')):
+        return False
+    if REGISTRY_SOURCE.match(source):
+        return bool(version and EXACT_VERSION.match(version.strip()))
+    return bool(GIT_REF.search(source))
+
+
+def tree_digest(folder):
+    """Digest of the files of a folder: relative paths, executable bits and contents"""
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            stat_ = os.lstat(path)
+            digest.update(os.path.relpath(path, folder).encode() + b'\0')
+            if stat.S_ISLNK(stat_.st_mode):
+                digest.update(b'l' + os.readlink(path).encode() + b'\0')
+                continue
+            digest.update(b'x' if stat_.st_mode & 0o111 else b'f')
+            with open(path, 'rb') as _f:
+                for chunk in iter(partial(_f.read, 2**20), b''):
+                    digest.update(chunk)
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _remove(path):
+    """Remove a module folder, or the symlink replacing it"""
+    if path.is_symlink() or path.is_file():
+        path.unlink()
+    elif path.is_dir():
+        shutil.rmtree(path)
+
+
+class ModuleStore:
+    """Store folder, holding trees/<digest>/ module contents and refs/<key>.json
+    telling the trees of a source and version, with the ones of its remote children"""
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    @staticmethod
+    def _key(source, version):
+        return hashlib.sha256(json.dumps([source, version or '']).encode()).hexdigest()
+
+    def _ref_file(self, call):
+        return self.folder / 'refs' / f"{self._key(call['source'], call['version'])}.json"
+
+    def _tree(self, digest):
+        return self.folder / 'trees' / digest
+
+    def _ref(self, call):
+        """Stored modules of a call, if complete"""
+        ref = read_json(self._ref_file(call))
+        if ref and all(self._tree(item['tree']).is_dir() for item in ref['modules']):
+            return ref
+        return None
+
+    def _store_tree(self, path):
+        """Store the content of a module folder, return its digest"""
+        digest = tree_digest(path)
+        if not self._tree(digest).is_dir():
+            self._tree(digest).parent.mkdir(parents=True, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self._tree(digest).parent)
+            shutil.copytree(str(path), os.path.join(tmp, 'tree'), symlinks=True)
+            try:
+                os.rename(os.path.join(tmp, 'tree'), self._tree(digest))
+            except OSError:  # stored meanwhile
+                pass
+            shutil.rmtree(tmp, ignore_errors=True)
+        return digest
+
+    @staticmethod
+    def _manifest(modules_dir):
+        """Records of modules.json, by key"""
+        manifest = read_json(modules_dir / 'modules.json', dict())
+        records = {record['Key']: record for record in manifest.get('Modules') or list()}
+        records.setdefault('', {'Key': '', 'Source': '', 'Dir': '.'})
+        return records
+
+    @staticmethod
+    def _record_dir(stack, path):
+        """Module folder as terraform records it, relative to the stack when inside"""
+        path = os.path.normpath(str(path))
+        try:
+            return str(Path(path).relative_to(stack))
+        except ValueError:
+            return path
+
+    def _link(self, stack, modules_dir, calls):
+        """Link the stored modules of the calls, return their number"""
+        records = self._manifest(modules_dir)
+        linked, changed = 0, False
+        for name, call in calls.items():
+            ref = self._ref(call)
+            if not ref:
+                continue
+            linked += 1
+            for item in ref['modules']:
+                key, target = name + item['suffix'], self._tree(item['tree'])
+                path = modules_dir / key
+                if records.get(key, {}).get('Source') == item['source'] \
+                        and path.is_symlink() and path.resolve() == target.resolve():
+                    continue
+                modules_dir.mkdir(parents=True, exist_ok=True)
+                _remove(path)
+                path.symlink_to(target)
+                records[key] = {'Key': key, 'Source': item['source'],
+                                'Dir': self._record_dir(stack, path / item['dir'])}
+                if item['version']:
+                    records[key]['Version'] = item['version']
+                changed = True
+        if changed:
+            write_json(modules_dir / 'modules.json',
+                       {'Modules': [records[key] for key in sorted(records)]}, mode=0o644)
+        return linked
+
+    @contextmanager
+    def init(self, stack, modules_dir, calls):
+        """Context of a terraform command installing the modules of a stack: stored ones
+        are linked first, missing ones are locked until the end.
+        :param dict calls: {'source', 'version'} of the module blocks of the stack, by name"""
+        calls = {name: call for name, call in calls.items()
+                 if pinned(call['source'], call['version'])}
+        with ExitStack() as locks:
+            missing = sorted({self._key(call['source'], call['version'])
+                              for call in calls.values() if not self._ref(call)})
+            if missing:
+                (self.folder / 'locks').mkdir(parents=True, exist_ok=True)
+            for key in missing:  # sorted, not to deadlock
+                locks.enter_context(file_lock(self.folder / 'locks' / f'{key}.lock'))
+            linked = self._link(Path(stack), Path(modules_dir), calls)
+            yield
+        logger.info("Module store: %d modules linked, %d left to terraform", linked,
+                    len(calls) - linked)
+
+    def harvest(self, stack, modules_dir, calls):
+        """Store the pinned modules fetched by terraform, replacing them by symlinks"""
+        stack, modules_dir = Path(stack), Path(modules_dir)
+        records = self._manifest(modules_dir)
+        for name, call in calls.items():
+            record = records.get(name)
+            if not pinned(call['source'], call['version']) or not record \
+                    or record.get('Source') != call['source'] or self._ref(call):
+                continue
+            modules, folders = list(), list()
+            for key in sorted(records):
+                path = modules_dir / key
+                # the module and its remote children, local ones being into their parents
+                if (key == name or key.startswith(name + '.')) and path.is_dir() \
+                        and not path.is_symlink():
+                    folder = os.path.join(str(stack), records[key]['Dir'])
+                    modules.append({'suffix': key[len(name):], 'source': records[key]['Source'],
+                                    'version': records[key].get('Version'),
+                                    'tree': self._store_tree(path),
+                                    'dir': os.path.relpath(folder, str(path))})
+                    folders.append(path)
+            if not modules or modules[0]['suffix'] != '':
+                continue
+            for path, item in zip(folders, modules):
+                _remove(path)
+                path.symlink_to(self._tree(item['tree']))
+            write_json(self._ref_file(call), {'source': call['source'],
+                                              'version': call['version'],
+                                              'modules': modules, 'stored': time.time()},
+                       mode=0o644)
+            logger.info("Module '%s' stored from %s", name, call['source'])
+
+    def stats(self):
+        """Store content"""
+        refs = list((self.folder / 'refs').glob('*.json')) \
+            if (self.folder / 'refs').is_dir() else list()
+        trees = [x for x in (self.folder / 'trees').iterdir() if not x.name.startswith('.')] \
+            if (self.folder / 'trees').is_dir() else list()
+        size = sum(os.lstat(os.path.join(dirpath, name)).st_size
+                   for tree in trees for dirpath, _, filenames in os.walk(tree)
+                   for name in filenames)
+        return {'folder': str(self.folder), 'modules': len(refs), 'trees': len(trees),
+                'size': size}
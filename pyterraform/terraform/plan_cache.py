@@ -0,0 +1,140 @@
+"""Plan cache: skip re-planning stacks whose inputs did not change.
+
+A plan is identified by a fingerprint of everything it depends on: terraform
+files of the stack and of the local modules it uses, variables, var-file,
+terraform and providers versions, backend and remote state version. A plan
+with the same fingerprint as the saved one of the stack is not run again:
+its saved output and plan file are returned instead.
+
+The fingerprint only knows of the state, not of the real infrastructure: changes
+made outside terraform, or remote values read by data sources, are not seen by a
+replayed plan. The cache is thus only used when enabled with config.plan_cache,
+for stacks whose drift is not a concern, like in CI of unchanged stacks."""
+import os
+import gzip
+import json
+import shutil
+import hashlib
+
+from ..logs import logger
+from ..utils import read_json, write_json, file_lock, sha256sum
+from ..remote_state import RemoteState
+from . import hcl
+
+
+class PlanCache:
+    """Saved plan of a stack, with hit/miss statistics"""
+
+    def __init__(self, command):
+        self.command = command
+        self.project = command.project
+
+    @property
+    def root(self):
+        """Plan cache folder"""
+        return self.project.path.run() / 'plan_cache'
+
+    @property
+    def folder(self):
+        """Plan cache folder of the stack"""
+        return self.root / self.command.stack_name
+
+    @property
+    def pending_plan(self):
+        """Where terraform writes the plan being computed"""
+        return self.folder / 'pending.tfplan'
+
+    def _providers(self):
+        """Installed providers of the stack, as names and sizes, and its dependency lock
+        file: plugins of terraform 0.12, providers and .terraform.lock.hcl from 0.13"""
+        data_dir = self.project.cfg.get_tf_data_dir()
+        found = list()
+        for folder in (data_dir / 'plugins', data_dir / 'providers'):
+            # providers are links to folders of the plugin cache from terraform 0.14
+            for dirpath, _, filenames in os.walk(folder, followlinks=True):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    found.append((os.path.relpath(path, data_dir),
+                                  os.path.getsize(path) if os.path.exists(path) else None))
+        lock_file = self.project.path.stack() / '.terraform.lock.hcl'
+        found.append(('.terraform.lock.hcl',
+                      sha256sum(lock_file) if lock_file.is_file() else None))
+        return sorted(found)
+
+    def _backend_type(self):
+        """Backend the stack is initialized with, None for the local state"""
+        data = read_json(self.project.cfg.get_tf_data_dir() / 'terraform.tfstate', dict())
+        return (data.get('backend') or dict()).get('type')
+
+    def _state(self):
+        """Version of the current state, remote or local"""
+        if self._backend_type() == 's3':
+            return RemoteState(self.project, bounded=True).head()
+        local = self.project.path.stack() / 'terraform.tfstate'
+        return sha256sum(local) if local.is_file() else None
+
+    def fingerprint(self, tf_params):
+        """Fingerprint of the plan inputs, None if they cannot be all known"""
+        digest = hashlib.sha256()
+
+        def add(label, value):
+            digest.update(f'{label}={json.dumps(value, sort_keys=True, default=str)}\n'.encode())
+
+        stack = self.project.path.stack()
+        add('params', tf_params)
+        try:
+            for folder in [stack] + sorted(self.command.local_modules(stack)):
+                for path in hcl.tf_files(folder):
+                    add(path, sha256sum(path))
+            for path in sorted(stack.glob('*.tfvars')) + sorted(stack.glob('*.tfvars.json')):
+                add(path, sha256sum(path))
+            add('vars', self.project.cfg.get_stack_tfvariables())
+            var_file = self.project.cfg.stack.get('var-file')
+            if var_file:
+                path = stack / var_file
+                add('var-file', [var_file, sha256sum(path) if path.is_file() else None])
+            add('terraform', self.command.utils.manifest.version_of(self.project.path.terraform())
+                or self.project.cfg.pyt.get('config.tf_version'))
+            add('providers', self._providers())
+            add('backend', self.project.cfg.stack.backend)
+            add('state', self._state())
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.warning("Plan cache disabled, cannot fingerprint the plan inputs: %s", ex)
+            return None
+        return digest.hexdigest()
+
+    def _count(self, key):
+        """Update hit/miss statistics"""
+        with file_lock(self.root / 'stats.lock'):
+            stats = read_json(self.root / 'stats.json', {'hits': 0, 'misses': 0})
+            stats[key] += 1
+            write_json(self.root / 'stats.json', stats, mode=0o644)
+        total = stats['hits'] + stats['misses']
+        logger.info("Plan cache %s (hit rate %d%% over %d plans)",
+                    'hit' if key == 'hits' else 'miss', 100 * stats['hits'] / total, total)
+
+    def lookup(self, fingerprint):
+        """Saved plan of the stack matching fingerprint, None if any"""
+        saved = read_json(self.folder / 'plan.json')
+        if saved and saved.get('fingerprint') == fingerprint \
+                and (self.folder / 'plan.tfplan').is_file():
+            self._count('hits')
+            return saved
+        self._count('misses')
+        return None
+
+    def store(self, fingerprint, stream, returncode):
+        """Save the plan just computed, replacing the previous one of the stack"""
+        if not self.pending_plan.is_file():
+            return
+        os.replace(self.pending_plan, self.folder / 'plan.tfplan')
+        shutil.copyfile(stream.tee_file, self.folder / 'plan.log.gz')
+        write_json(self.folder / 'plan.json',
+                   {'fingerprint': fingerprint, 'returncode': returncode,
+                    'summary': stream.summary or stream.counts}, mode=0o644)
+
+    def replay(self, stream):
+        """Print again the output of the saved plan"""
+        with gzip.open(self.folder / 'plan.log.gz') as log:
+            stream.consume(log)
+        return self.folder / 'plan.tfplan'
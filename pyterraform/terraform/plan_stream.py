@@ -0,0 +1,201 @@
+"""Streaming post-processing of terraform plan output.
+
+The output is processed line by line, in bounded memory: the raw stream is
+teed to a compressed log, filters may rewrite or drop lines, and the planned
+actions are counted while flowing through."""
+import re
+import sys
+import gzip
+import shlex
+import subprocess
+
+# Longer lines are processed in pieces, to keep memory bounded
+MAX_LINE = 2**20
+ANSI = re.compile(r'\x1b\[[0-9;]*m')
+ACTION = re.compile(r'^\s*# (?P<address>\S+) (?:is tainted, so )?(?P<action>will be created|'
+                    r'will be updated in-place|will be destroyed|must be replaced)')
+SUMMARY = re.compile(r'Plan: (?P<add>[0-9]+) to add, (?P<change>[0-9]+) to change, '
+                     r'(?P<destroy>[0-9]+) to destroy')
+
+
+class StripRefresh:
+    """Drop state refresh and data source reading noise"""
+    NOISE = re.compile(r'(: Refreshing state\.\.\.|: Reading\.\.\.|: Read complete after|'
+                       r'^Refreshing Terraform state in-memory prior to plan)')
+
+    def __call__(self, line, text):
+        return [] if self.NOISE.search(text) else [line]
+
+    def flush(self):
+        """Lines held back: none"""
+        return []
+
+
+class CollapseUnchanged:
+    """Replace runs of unchanged attributes, in resources diffs, with a count"""
+    ATTRIBUTE = re.compile(r'^(?P<indent>\s+)[\w"-]+\s+= ')
+
+    def __init__(self):
+        self.active = False
+        self.indent = None
+        self.hidden = 0
+
+    def flush(self):
+        """Count of the unchanged attributes hidden so far, if any"""
+        if not self.hidden:
+            return []
+        lines = [f'{self.indent}# ({self.hidden} unchanged attributes hidden)\n']
+        self.indent, self.hidden = None, 0
+        return lines
+
+    def __call__(self, line, text):
+        if ACTION.match(text) or not text.strip():
+            # a resource diff starts, or ends with a blank line
+            self.active = bool(text.strip())
+            return self.flush() + [line]
+        match = self.ATTRIBUTE.match(text)
+        if self.active and match \
+                and (self.indent is None or match.group('indent') == self.indent):
+            self.indent = match.group('indent')
+            self.hidden += 1
+            return []
+        return self.flush() + [line]
+
+
+FILTERS = {'strip_refresh': StripRefresh,
+           'collapse_unchanged': CollapseUnchanged}
+
+
+class PlanStream:
+    """Consumer of a terraform plan output"""
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, tee_file=None, filters=(), pipe_command=None, live=None, *,
+                 cwd=None, env=None):
+        """
+        :param str tee_file: gzip file receiving the raw output
+        :param list filters: names of filters to apply, among FILTERS
+        :param str pipe_command: command receiving the filtered output, instead of stdout
+        :param bool live: print a live counter on stderr (default: if it's a tty)
+        :param cwd: working directory of the pipe command, like the one of terraform
+        :param dict env: environment of the pipe command, like the one of terraform"""
+        self.tee_file = tee_file
+        self.filters = [FILTERS[name]() for name in filters]
+        self.pipe_command = pipe_command
+        self.cwd = cwd
+        self.env = env
+        self.live = sys.stderr.isatty() if live is None else live
+        self.counts = {'add': 0, 'change': 0, 'destroy': 0}
+        self.summary = None
+        self._pipe, self._out, self._tee = None, None, None
+        self._shown = b''  # start of the current line, already shown
+
+    def _count(self, text):
+        """Update counters from a line of output"""
+        match = ACTION.match(text)
+        if match:
+            action = match.group('action')
+            if action == 'will be created':
+                self.counts['add'] += 1
+            elif action == 'will be updated in-place':
+                self.counts['change'] += 1
+            elif action == 'will be destroyed':
+                self.counts['destroy'] += 1
+            else:
+                self.counts['add'] += 1
+                self.counts['destroy'] += 1
+            if self.live:
+                sys.stderr.write('\r\x1b[K' + self.progress + '\r')
+                sys.stderr.flush()
+            return
+        match = SUMMARY.search(text)
+        if match:
+            self.summary = {key: int(value) for key, value in match.groupdict().items()}
+
+    @property
+    def progress(self):
+        """Counters as text"""
+        counts = self.summary or self.counts
+        return f"{counts['add']} to add, {counts['change']} to change, " \
+               f"{counts['destroy']} to destroy"
+
+    def _filter(self, line):
+        """Apply filters in sequence to one line"""
+        lines = [line]
+        for filter_ in self.filters:
+            lines = [out for item in lines
+                     for out in filter_(item, ANSI.sub('', item))]
+        return lines
+
+    def _flush_filters(self):
+        lines = list()
+        for index, filter_ in enumerate(self.filters):
+            pending = filter_.flush()
+            for next_filter in self.filters[index + 1:]:
+                pending = [out for item in pending
+                           for out in next_filter(item, ANSI.sub('', item))]
+            lines.extend(pending)
+        return lines
+
+    def start(self):
+        """Open the outputs, before the first line"""
+        if self.pipe_command:
+            self._pipe = subprocess.Popen(  # pylint: disable=consider-using-with
+                shlex.split(self.pipe_command), stdin=subprocess.PIPE, cwd=self.cwd, env=self.env)
+        self._out = self._pipe.stdin if self._pipe else sys.stdout.buffer
+        if self.tee_file:
+            self._tee = gzip.open(self.tee_file, 'wb', compresslevel=1)
+
+    def feed(self, raw, partial=False):
+        """Process one line of output, as bytes
+        :param bool partial: the start of a line waiting for input, like a prompt: shown
+            now, then processed with the rest of the line, which alone is shown unfiltered"""
+        if partial:
+            for item in self._flush_filters():  # shown before the prompt
+                self._out.write(item.encode())
+            self._out.write(raw)
+            self._out.flush()
+            self._shown += raw
+            return
+        shown, raw = len(self._shown), self._shown + raw
+        self._shown = b''
+        if self._tee:
+            self._tee.write(raw)
+        line = raw.decode(errors='replace')
+        self._count(ANSI.sub('', line))
+        if shown:
+            self._out.write(raw[shown:])
+        else:
+            for item in self._filter(line):
+                self._out.write(item.encode())
+        self._out.flush()
+
+    def finish(self):
+        """Flush filters and close the outputs, return the counters"""
+        if self._shown:  # the output ended with a partial line
+            self.feed(b'')
+        try:
+            for item in self._flush_filters():
+                self._out.write(item.encode())
+            self._out.flush()
+        finally:
+            if self._tee:
+                self._tee.close()
+                self._tee = None
+            if self._pipe:
+                self._pipe.stdin.close()
+                self._pipe.wait()
+                self._pipe = None
+        if self.live:
+            sys.stderr.write('\r\x1b[K')
+        return self.summary or self.counts
+
+    def consume(self, stream):
+        """Process the whole binary stream, return the counters"""
+        self.start()
+        try:
+            for raw in iter(lambda: stream.readline(MAX_LINE), b''):
+                self.feed(raw)
+        finally:
+            counts = self.finish()
+        return counts
@@ -0,0 +1,252 @@
+"""Terraform plugin cache shared by all the stacks (TF_PLUGIN_CACHE_DIR).
+
+Terraform does not support concurrent writes to the plugin cache, so each init is
+given a private view of it, made of hardlinks of the cached providers, and the
+providers it downloads are merged into the cache after it. The cache lock is only
+held to take the view and to merge back, so that inits run concurrently; a provider
+missing from the cache may then be downloaded by several of them. Terraform links
+the providers of the data directory to the cache it was given: these links are
+repointed to the shared cache before the view is removed. Where hardlinks are not
+supported, inits use the cache directly, serialized by the lock.
+
+After each init, provider binaries copied into the stack data directory are
+replaced by hardlinks to the identical cached ones, and the cache is bounded in
+size by evicting the least recently used providers."""
+import os
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from ..logs import logger
+from ..utils import read_json, write_json, file_lock, sha256sum
+
+INDEX_FILE = '.pyterraform-index.json'
+LOCK_FILE = '.pyterraform.lock'
+VIEW_PREFIX = '.view-'
+
+
+class PluginCache:
+    """Plugin cache folder, with an index of its providers and usage statistics"""
+
+    def __init__(self, folder, max_size=None):
+        """
+        :param int max_size: size limit in bytes, None for no limit"""
+        self.folder = Path(folder)
+        self.max_size = max_size
+
+    @property
+    def index_file(self):
+        """Providers of the cache, by relative path, with last use time and statistics"""
+        return self.folder / INDEX_FILE
+
+    @contextmanager
+    def lock(self):
+        """Exclusive use of the cache, for terraform init or maintenance"""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.folder / LOCK_FILE):
+            yield
+
+    def _files(self):
+        """Provider binaries of the cache"""
+        for dirpath, dirnames, filenames in os.walk(self.folder):
+            dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+            for name in filenames:
+                if not name.startswith('.'):
+                    yield Path(dirpath, name)
+
+    def _refresh(self, index):
+        """Add new binaries to the index, forget removed ones (lock held)"""
+        now, files = time.time(), dict()
+        for path in self._files():
+            try:
+                stat_ = path.stat()
+            except FileNotFoundError:  # dangling symlink
+                continue
+            rel = str(path.relative_to(self.folder))
+            entry = index['files'].get(rel)
+            if not entry or entry['size'] != stat_.st_size \
+                    or entry['mtime_ns'] != stat_.st_mtime_ns:
+                entry = {'size': stat_.st_size, 'mtime_ns': stat_.st_mtime_ns,
+                         'sha256': sha256sum(path), 'used': now}
+            files[rel] = entry
+        index['files'] = files
+        return index
+
+    def _load(self):
+        index = read_json(self.index_file, dict())
+        index.setdefault('files', dict())
+        index.setdefault('stats', {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'evicted': 0})
+        return index
+
+    def _dedup(self, index, data_dir):
+        """Replace the plugins of a data dir identical to cached ones by hardlinks,
+        mark the cached ones as used, return (hits, misses)"""
+        by_digest = {entry['sha256']: self.folder / rel for rel, entry in index['files'].items()}
+        by_inode = dict()
+        for rel in index['files']:
+            stat_ = (self.folder / rel).stat()
+            by_inode[(stat_.st_dev, stat_.st_ino)] = rel
+        hits, misses, now = 0, 0, time.time()
+        # links to folders of the cache are followed, like the packages of terraform >= 0.14
+        for dirpath, _, filenames in os.walk(data_dir, followlinks=True):
+            for name in filenames:
+                path = Path(dirpath, name)
+                try:
+                    stat_ = path.stat()  # symlinks into the cache are followed
+                except FileNotFoundError:  # dangling symlink
+                    continue
+                rel = by_inode.get((stat_.st_dev, stat_.st_ino))
+                if rel is None and stat_.st_size > 2**20:
+                    cached = by_digest.get(sha256sum(path))
+                    if cached is not None:
+                        try:
+                            os.link(cached, f'{path}.pyterraform-link')
+                            os.replace(f'{path}.pyterraform-link', path)
+                        except OSError as ex:  # like a data dir on another filesystem
+                            logger.debug("Cannot hardlink %s to the plugin cache: %s", path, ex)
+                        else:
+                            rel = str(cached.relative_to(self.folder))
+                            logger.debug("Deduplicated %s", path)
+                if rel is None:
+                    continue
+                if index['files'][rel].get('added_by_init'):
+                    index['files'][rel].pop('added_by_init')
+                    misses += 1
+                else:
+                    hits += 1
+                    index['stats']['bytes_saved'] += stat_.st_size
+                index['files'][rel]['used'] = now
+        return hits, misses
+
+    def _evict(self, index, keep=()):
+        """Remove least recently used providers until under the size limit"""
+        if self.max_size is None:
+            return
+        total = sum(entry['size'] for entry in index['files'].values())
+        for rel, entry in sorted(index['files'].items(), key=lambda item: item[1]['used']):
+            if total <= self.max_size:
+                break
+            if rel in keep:
+                continue
+            logger.info("Evicting provider %s from the plugin cache", rel)
+            (self.folder / rel).unlink()
+            total -= entry['size']
+            index['stats']['evicted'] += 1
+            del index['files'][rel]
+
+    def _view(self):
+        """Private view of the cache: a folder of hardlinks of its providers (lock held).
+        :return: the folder and the providers in it, None if hardlinks are not supported"""
+        view = Path(tempfile.mkdtemp(prefix=VIEW_PREFIX, dir=str(self.folder)))
+        linked = set()
+        try:
+            for path in self._files():
+                rel = path.relative_to(self.folder)
+                (view / rel).parent.mkdir(parents=True, exist_ok=True)
+                os.link(str(path), str(view / rel))
+                linked.add(str(rel))
+        except OSError as ex:
+            logger.debug("Cannot hardlink the plugin cache, inits are serialized: %s", ex)
+            shutil.rmtree(str(view), ignore_errors=True)
+            return None, None
+        return view, linked
+
+    def _merge(self, view, linked):
+        """Add the providers downloaded into a view to the cache (lock held),
+        return their relative paths"""
+        downloaded = set()
+        for dirpath, _, filenames in os.walk(str(view)):
+            for name in filenames:
+                rel = str(Path(dirpath, name).relative_to(view))
+                if rel in linked or name.startswith('.'):
+                    continue
+                downloaded.add(rel)
+                if not (self.folder / rel).exists():  # else merged by a concurrent init
+                    (self.folder / rel).parent.mkdir(parents=True, exist_ok=True)
+                    os.link(os.path.join(dirpath, name), str(self.folder / rel))
+        return downloaded
+
+    def _relink(self, view, data_dir):
+        """Repoint the symlinks of a data dir into a view to the same providers of the
+        cache (lock held, after the merge), return their number"""
+        views = {os.path.abspath(str(view)), os.path.realpath(str(view))}
+        relinked = 0
+        for dirpath, dirnames, filenames in os.walk(str(data_dir)):
+            for name in dirnames + filenames:  # links to folders are not walked
+                path = os.path.join(dirpath, name)
+                if not os.path.islink(path):
+                    continue
+                target = os.path.abspath(os.path.join(dirpath, os.readlink(path)))
+                root = next((x for x in views if target.startswith(x + os.sep)), None)
+                if root is None:
+                    continue
+                os.symlink(str(self.folder / os.path.relpath(target, root)),
+                           f'{path}.pyterraform-link')
+                os.replace(f'{path}.pyterraform-link', path)
+                relinked += 1
+        if relinked:
+            logger.debug("Repointed %d providers of %s to the plugin cache", relinked, data_dir)
+        return relinked
+
+    def _update(self, index, data_dir, downloaded):
+        """Account the providers used by an init, enforce the size limit, save the
+        index (lock held)"""
+        for rel in downloaded & set(index['files']):
+            index['files'][rel]['added_by_init'] = True
+        hits, misses = self._dedup(index, data_dir)
+        index['stats']['hits'] += hits
+        index['stats']['misses'] += misses
+        for entry in index['files'].values():
+            entry.pop('added_by_init', None)
+        used = {rel for rel, entry in index['files'].items()
+                if entry['used'] >= time.time() - 60}
+        self._evict(index, keep=used)
+        write_json(self.index_file, index, mode=0o644)
+        logger.info("Plugin cache: %d providers reused, %d downloaded", hits, misses)
+
+    @contextmanager
+    def init(self, data_dir, env):
+        """Context of a terraform init using the cache for the given data dir
+        :param dict env: environment of terraform, whose TF_PLUGIN_CACHE_DIR is set"""
+        with self.lock():
+            before = set(self._refresh(self._load())['files'])
+            view, linked = self._view()
+        if view is None:
+            with self.lock():
+                yield
+                index = self._refresh(self._load())
+                self._update(index, data_dir, set(index['files']) - before)
+            return
+        env['TF_PLUGIN_CACHE_DIR'] = str(view)
+        try:
+            yield
+            with self.lock():
+                downloaded = self._merge(view, linked)
+                self._relink(view, data_dir)
+                self._update(self._refresh(self._load()), data_dir, downloaded)
+        finally:
+            shutil.rmtree(str(view), ignore_errors=True)
+
+    def stats(self):
+        """Cache content and usage statistics"""
+        with self.lock():
+            index = self._refresh(self._load())
+            write_json(self.index_file, index, mode=0o644)
+        stats = dict(index['stats'])
+        stats.update(folder=str(self.folder), providers=len(index['files']),
+                     size=sum(entry['size'] for entry in index['files'].values()),
+                     max_size=self.max_size)
+        total = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / total if total else None
+        return stats
+
+    def prune(self):
+        """Enforce the size limit now, return the number of evicted providers"""
+        with self.lock():
+            index = self._refresh(self._load())
+            evicted = index['stats']['evicted']
+            self._evict(index)
+            write_json(self.index_file, index, mode=0o644)
+        return index['stats']['evicted'] - evicted
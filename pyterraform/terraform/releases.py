@@ -0,0 +1,175 @@
+"""Release index of github repositories and version constraints resolver.
+
+The tags of a repository are cached on disk: within the ttl, resolving a version
+is a local lookup; after it, the index is refreshed with a conditional request
+(ETag) that costs no download when nothing was released. When github cannot be
+reached, an outdated index is used rather than failing."""
+import os
+import re
+import time
+from functools import total_ordering
+from pathlib import Path
+
+from .. import constants as const
+from ..logs import logger
+from ..utils import read_json, write_json, file_lock
+from .download import http_session, TIMEOUT
+
+VERSION_REGEX = re.compile(
+    r'^v?(?P<major>[0-9]+)(?:\.(?P<minor>[0-9]+))?(?:\.(?P<patch>[0-9]+))?'
+    r'(?:-(?P<pre>[0-9A-Za-z_.-]+))?$')
+CONSTRAINT_REGEX = re.compile(r'^\s*(?P<op>~>|>=|<=|!=|=|>|<)?\s*(?P<version>\S+)\s*$')
+
+
+@total_ordering
+class Version:
+    """A semantic version, like 1.2.3 or v1.2.3-beta1"""
+
+    def __init__(self, text):
+        match = VERSION_REGEX.match(text.strip())
+        if not match:
+            raise ValueError(f"'{text}' is not a version")
+        self.text = text.strip()
+        self.parts = tuple(int(match.group(x)) if match.group(x) is not None else None
+                           for x in ('major', 'minor', 'patch'))
+        self.precision = sum(1 for x in self.parts if x is not None)
+        self.pre = match.group('pre')
+
+    @property
+    def release(self):
+        """major, minor, patch with missing parts as zero"""
+        return tuple(x or 0 for x in self.parts)
+
+    @property
+    def key(self):
+        """Sort key: pre-releases come before their release"""
+        return self.release + ((0, self.pre) if self.pre else (1, ''),)
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __repr__(self):
+        return f'Version({self.text!r})'
+
+
+class Constraint:
+    """Terraform-like version constraint: comma separated conditions among
+    =, !=, >, >=, <, <= and ~> (pessimistic). Pre-releases only match
+    conditions naming a pre-release."""
+
+    def __init__(self, text):
+        self.text = text
+        self.conditions = list()
+        for term in text.split(','):
+            match = CONSTRAINT_REGEX.match(term)
+            if not match:
+                raise ValueError(f"'{term}' is not a version constraint")
+            self.conditions.append((match.group('op') or '=', Version(match.group('version'))))
+
+    @staticmethod
+    def _check(operator, version, limit):
+        if operator == '~>':
+            # ~> 1.2 allows 1.x >= 1.2, ~> 1.2.3 allows 1.2.x >= 1.2.3
+            fixed = max(1, limit.precision - 1)
+            return version.release[:fixed] == limit.release[:fixed] and version >= limit
+        return {'=': version == limit, '!=': version != limit,
+                '>': version > limit, '>=': version >= limit,
+                '<': version < limit, '<=': version <= limit}[operator]
+
+    def allows(self, version):
+        """Whether version satisfies all the conditions"""
+        if version.pre and not any(limit.pre for _, limit in self.conditions):
+            return False
+        return all(self._check(op, version, limit) for op, limit in self.conditions)
+
+    def resolve(self, versions):
+        """Highest of the given version strings satisfying the constraint, None if none"""
+        candidates = list()
+        for text in versions:
+            try:
+                version = Version(text)
+            except ValueError:
+                continue
+            if self.allows(version):
+                candidates.append(version)
+        return max(candidates).text if candidates else None
+
+
+def parse_constraint(text):
+    """Constraint from a stack version setting: a bare X.Y takes the latest X.Y patch"""
+    match = VERSION_REGEX.match(text.strip())
+    if match and match.group('patch') is None and not match.group('pre'):
+        return Constraint(f"~> {text.strip().lstrip('v')}.0")
+    return Constraint(text)
+
+
+class ReleaseIndex:
+    """On disk index of the release tags of a github repository"""
+
+    def __init__(self, repo, cache_dir=None, ttl=3600):
+        self.repo = repo
+        self.ttl = ttl
+        cache_dir = Path(cache_dir) if cache_dir else const.HOME_DIR / '.terraform.d' / 'releases'
+        self.file = cache_dir / (repo.replace('/', '_') + '.json')
+
+    @property
+    def _headers(self):
+        headers = {'Accept': 'application/vnd.github.v3+json'}
+        if os.environ.get('GITHUB_TOKEN'):
+            headers['Authorization'] = f"token {os.environ['GITHUB_TOKEN']}"
+        return headers
+
+    def _fetch(self, etag=None):
+        """Fetch all tags, None if unchanged since etag"""
+        url = f'{const.GITHUB_API}/repos/{self.repo}/releases?per_page=100'
+        headers = dict(self._headers, **({'If-None-Match': etag} if etag else {}))
+        tags, first = list(), True
+        while url:
+            response = http_session().get(url, headers=headers if first else self._headers,
+                                          timeout=TIMEOUT)
+            if first and response.status_code == 304:
+                return None, etag
+            if response.status_code == 404:
+                raise ValueError(f"The github repository {self.repo} does not exist")
+            response.raise_for_status()
+            if first:
+                etag, first = response.headers.get('ETag'), False
+            tags.extend(release['tag_name'] for release in response.json()
+                        if not release.get('draft'))
+            url = response.links.get('next', {}).get('url')
+        return tags, etag
+
+    @property
+    def tags(self):
+        """Release tags, refreshed from github if older than ttl"""
+        index = read_json(self.file, dict())
+        if index and time.time() - index.get('fetched_at', 0) < self.ttl:
+            return index['tags']
+        with file_lock(self.file.with_suffix('.lock')):
+            index = read_json(self.file, dict())
+            if index and time.time() - index.get('fetched_at', 0) < self.ttl:
+                return index['tags']
+            logger.debug("Refreshing release index of %s", self.repo)
+            import requests  # pylint: disable=import-outside-toplevel
+            try:
+                tags, etag = self._fetch(index.get('etag'))
+            except requests.RequestException as ex:
+                if not index:
+                    raise
+                logger.warning("Cannot refresh the release index of %s, using the one of %s: %s",
+                               self.repo, time.strftime('%Y-%m-%d %H:%M',
+                                                        time.localtime(index['fetched_at'])), ex)
+                return index['tags']
+            if tags is None:
+                logger.debug("Release index of %s not modified", self.repo)
+                tags = index['tags']
+            write_json(self.file, {'etag': etag, 'fetched_at': time.time(), 'tags': tags},
+                       mode=0o644)
+        return tags
+
+    def resolve(self, constraint):
+        """Release tag satisfying the version constraint, None if none"""
+        return parse_constraint(constraint).resolve(self.tags)
@@ -0,0 +1,165 @@
+"""Timing spans of the wrapper phases, exported as Chrome trace events.
+
+Tracing is enabled by --trace FILE or the PYTERRAFORM_TRACE environment variable.
+FILE receives the trace (to be opened with chrome://tracing or Perfetto), and
+FILE.summary.json the total time by span name. When disabled, a span costs a
+global lookup.
+
+Child wrappers of multi-stack runs write their own trace into FILE.parts/, and
+the parent merges them into its trace: timestamps are wall clock based, so all
+the processes render on one timeline."""
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import functools
+
+TRACE_ENV = 'PYTERRAFORM_TRACE'
+_TRACER = None
+
+
+class Tracer:
+    """Collector of the spans of this process"""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.events = list()
+        self._lock = threading.Lock()
+        self._anchor = (time.time(), time.perf_counter())
+        self._children = 0
+
+    def now(self):
+        """Wall clock time in microseconds, with the precision of perf_counter"""
+        return (self._anchor[0] + time.perf_counter() - self._anchor[1]) * 1e6
+
+    def add(self, name, start, end, args):
+        """Record a complete span"""
+        event = {'name': name, 'ph': 'X', 'ts': start, 'dur': end - start,
+                 'pid': os.getpid(), 'tid': threading.get_ident()}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    def child_trace(self):
+        """Trace file of a new child wrapper, merged at write"""
+        with self._lock:
+            self._children += 1
+            return os.path.join(f'{self.path}.parts', f'{os.getpid()}-{self._children}.json')
+
+    def _merge_children(self):
+        """Events of the child wrappers, removing their files"""
+        events, parts = list(), f'{self.path}.parts'
+        if os.path.isdir(parts):
+            for name in sorted(os.listdir(parts)):
+                try:
+                    with open(os.path.join(parts, name), encoding='utf-8') as _f:
+                        events.extend(json.load(_f)['traceEvents'])
+                except (OSError, ValueError, KeyError):
+                    continue
+            shutil.rmtree(parts, ignore_errors=True)
+        return events
+
+    @staticmethod
+    def summary(events):
+        """Count, total and max duration (ms) by span name, longest first"""
+        spans = dict()
+        for event in events:
+            if event.get('ph') != 'X':
+                continue
+            item = spans.setdefault(event['name'], {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            item['count'] += 1
+            item['total_ms'] += event['dur'] / 1000
+            item['max_ms'] = max(item['max_ms'], event['dur'] / 1000)
+        return dict(sorted(((name, {key: round(value, 3) for key, value in item.items()})
+                            for name, item in spans.items()),
+                           key=lambda item: -item[1]['total_ms']))
+
+    def write(self):
+        """Write the trace, with the ones of child wrappers, and its summary"""
+        from .utils import write_json  # pylint: disable=import-outside-toplevel
+        process = {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                   'args': {'name': ' '.join(['pyterraform'] + sys.argv[1:])}}
+        events = [process] + self.events + self._merge_children()
+        write_json(self.path, {'traceEvents': events, 'displayTimeUnit': 'ms'}, mode=0o644)
+        write_json(f'{self.path}.summary.json', self.summary(events), mode=0o644)
+
+
+class _Span:
+    """Context of a span"""
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer_, name, args):
+        self.tracer, self.name, self.args = tracer_, name, args
+        self.start = None
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.start, self.tracer.now(), self.args)
+        return False
+
+
+class _NullSpan:
+    """Context doing nothing, when tracing is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **args):
+    """Context timing a phase, like `with span('config.load', path=path):`"""
+    if _TRACER is None:
+        return _NULL_SPAN
+    return _Span(_TRACER, name, args)
+
+
+def traced(name):
+    """Decorator timing every call of a function as a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _TRACER is None:
+                return func(*args, **kwargs)
+            with _Span(_TRACER, name, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def tracer():
+    """Current tracer, None if tracing is disabled"""
+    return _TRACER
+
+
+def setup(argv):
+    """Enable tracing if asked by --trace (looked up before argument parsing, to
+    time it too) or the environment"""
+    global _TRACER  # pylint: disable=global-statement
+    path = os.environ.get(TRACE_ENV)
+    for index, arg in enumerate(argv):
+        if arg == '--':
+            break
+        if arg == '--trace' and index + 1 < len(argv):
+            path = argv[index + 1]
+        elif arg.startswith('--trace='):
+            path = arg[len('--trace='):]
+    _TRACER = Tracer(os.path.abspath(path)) if path else None
+    return _TRACER
+
+
+def finish():
+    """Write the trace, if enabled"""
+    if _TRACER is not None:
+        _TRACER.write()
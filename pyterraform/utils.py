@@ -1,5 +1,81 @@
 """Common utilities"""
+import os
+import copy
+import json
+import fcntl
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
 
 def error(message):
     """Raise a ValueError with an help message appended to the original message."""
     raise ValueError(f"{message}\n\nUse -h to show the help message")
+
+
+def sha256sum(path):
+    """Hex sha256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as _f:
+        for block in iter(lambda: _f.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def atomic_write(path, data, mode=0o600):
+    """Write data (str or bytes) to path through a temporary file and a rename,
+    so that concurrent readers never see a partial file."""
+    path = str(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, tmp_file = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.',
+                                        dir=os.path.dirname(path))
+    try:
+        binary = isinstance(data, bytes)
+        with os.fdopen(handle, 'wb' if binary else 'w',
+                       encoding=None if binary else 'utf-8') as _f:
+            _f.write(data)
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+
+# Content of json files read with memo, by path, with the file identity when read
+_JSON_MEMO = dict()
+
+
+def read_json(path, default=None, memo=False):
+    """Load a json file, returning default if missing or corrupted.
+    :param bool memo: keep the content in memory, to be returned (as a copy) again
+        while the file is unchanged. This matters for long running processes,
+        like the daemon, whose forked workers inherit the memo."""
+    try:
+        with open(path, encoding='utf-8') as _f:
+            if not memo:
+                return json.load(_f)
+            stat_ = os.fstat(_f.fileno())
+            identity = (stat_.st_ino, stat_.st_size, stat_.st_mtime_ns)
+            cached = _JSON_MEMO.get(str(path))
+            if cached is None or cached[0] != identity:
+                cached = _JSON_MEMO[str(path)] = (identity, json.load(_f))
+            return copy.deepcopy(cached[1])
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, data, mode=0o600):
+    """Atomically dump data as json"""
+    atomic_write(path, json.dumps(data, separators=(',', ':')), mode=mode)
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """Hold an flock on the given lock file, shared among processes"""
+    os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+    with open(path, 'a', encoding='utf-8') as _f:
+        fcntl.flock(_f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(_f, fcntl.LOCK_UN)
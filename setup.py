@@ -37,7 +37,8 @@ setuptools.setup(
     packages=setuptools.find_packages(),
     entry_points={
         'console_scripts': [
-            'pyterraform = pyterraform.__main__:main'
+            'pyterraform = pyterraform.__main__:main',
+            'pyterraform-client = pyterraform.client:main'
         ]
     },
     classifiers=[
@@ -0,0 +1,53 @@
+"""Shared fixtures: stand-in servers and a minimal project using them"""
+from types import SimpleNamespace
+
+import pytest
+
+from pyterraform import constants as const
+from pyterraform.session import Session
+
+from fakes import FakeReleases, FakeS3, FakeDynamoDB
+
+
+class StaticSession(Session):
+    """AWS session with static test credentials, clients are built as in the wrapper"""
+
+    def _get_session(self):
+        import boto3  # pylint: disable=import-outside-toplevel
+        return boto3.session.Session(aws_access_key_id='test', aws_secret_access_key='test',
+                                     region_name='eu-west-1')
+
+
+@pytest.fixture
+def releases(monkeypatch):
+    """Release servers of hashicorp and github"""
+    with FakeReleases() as server:
+        for name in ('HASHICORP_RELEASES', 'GITHUB_BASE', 'GITHUB_API'):
+            monkeypatch.setattr(const, name, server.url)
+        yield server
+
+
+@pytest.fixture
+def s3(monkeypatch):  # pylint: disable=invalid-name
+    """S3 endpoint of the state bucket"""
+    with FakeS3() as server:
+        monkeypatch.setattr(const, 'S3_ENDPOINT', server.url)
+        yield server
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    """DynamoDB endpoint of the state lock table"""
+    with FakeDynamoDB() as server:
+        monkeypatch.setattr(const, 'DYNAMODB_ENDPOINT', server.url)
+        yield server
+
+
+@pytest.fixture
+def project(tmp_path):
+    """What remote state and state lock use of a project: its AWS session, its runtime
+    folder and the name of its current stack"""
+    project_ = SimpleNamespace(path=SimpleNamespace(run=lambda: tmp_path / '.run'),
+                               tf=SimpleNamespace(stack_name='app_prod'))
+    project_.session = StaticSession(project_)
+    return project_
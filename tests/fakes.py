@@ -0,0 +1,194 @@
+"""Local stand-ins of the remote services used by the wrapper.
+
+Each one is an http server on a free port of the loopback, served from a thread,
+recording the requests it gets. Tests point the wrapper to it, like users point
+it to a mirror, with the PYTERRAFORM_* endpoints (see constants.py)."""
+import re
+import json
+import hashlib
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Dispatch requests to the server, as do_<method>(handler)"""
+    protocol_version = 'HTTP/1.1'
+
+    def _dispatch(self):
+        self.server.requests.append({'method': self.command, 'path': self.path,
+                                     'headers': dict(self.headers)})
+        getattr(self.server, f'do_{self.command}')(self)
+
+    do_GET = do_HEAD = do_POST = _dispatch
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def reply(self, status, body=b'', headers=None):
+        """Send a complete response"""
+        self.send_response(status)
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """Http server running in a thread while used as a context manager"""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.requests = list()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Base url of the server"""
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeReleases(FakeServer):
+    """Github api listing releases, and release files, with Range requests.
+    :attr dict releases: tags of each repository ('owner/name'), newest first
+    :attr dict files: content of each file, by url path
+    :attr set cut: paths whose next full download is cut in the middle"""
+    PAGE_SIZE = 2
+
+    def __init__(self):
+        super().__init__()
+        self.releases = dict()
+        self.files = dict()
+        self.cut = set()
+
+    def add_release(self, repo, tag, draft=False):
+        """Publish a release, as the newest one"""
+        self.releases.setdefault(repo, list()).insert(0, {'tag_name': tag, 'draft': draft})
+
+    def do_GET(self, handler):
+        """Release pages, or files"""
+        url = urlsplit(handler.path)
+        match = re.match(r'^/repos/(?P<repo>[^/]+/[^/]+)/releases$', url.path)
+        if match:
+            self._releases(handler, match.group('repo'), parse_qs(url.query))
+        else:
+            self._file(handler, url.path)
+
+    def _releases(self, handler, repo, query):
+        if repo not in self.releases:
+            handler.reply(404, b'{"message": "Not Found"}')
+            return
+        releases = self.releases[repo]
+        etag = '"%s"' % hashlib.sha256(json.dumps(releases).encode()).hexdigest()
+        if handler.headers.get('If-None-Match') == etag:
+            handler.reply(304, headers={'ETag': etag})
+            return
+        page = int(query.get('page', ['1'])[0])
+        headers = {'ETag': etag, 'Content-Type': 'application/json'}
+        if page * self.PAGE_SIZE < len(releases):
+            headers['Link'] = f'<{self.url}/repos/{repo}/releases?page={page + 1}>; rel="next"'
+        body = releases[(page - 1) * self.PAGE_SIZE:page * self.PAGE_SIZE]
+        handler.reply(200, json.dumps(body).encode(), headers)
+
+    def _file(self, handler, path):
+        if path not in self.files:
+            handler.reply(404, b'Not Found')
+            return
+        data = self.files[path]
+        match = re.match(r'^bytes=(\d+)-$', handler.headers.get('Range') or '')
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                handler.reply(416)
+                return
+            handler.reply(206, data[start:], {
+                'Content-Range': f'bytes {start}-{len(data) - 1}/{len(data)}'})
+            return
+        if path in self.cut:
+            self.cut.discard(path)
+            handler.send_response(200)
+            handler.send_header('Content-Length', str(len(data)))
+            handler.end_headers()
+            handler.wfile.write(data[:len(data) // 2])
+            handler.wfile.flush()
+            handler.close_connection = True
+            return
+        handler.reply(200, data)
+
+
+class FakeS3(FakeServer):
+    """S3 objects, with path-style urls and conditional GET.
+    :attr dict objects: content by 'bucket/key'
+    :attr set denied: 'bucket/key' of the objects whose access is denied"""
+
+    def __init__(self):
+        super().__init__()
+        self.objects = dict()
+        self.denied = set()
+
+    def _object(self, handler):
+        name = urlsplit(handler.path).path.lstrip('/')
+        if name in self.denied:
+            handler.reply(403, b'<Error><Code>AccessDenied</Code><Message>Access Denied'
+                               b'</Message></Error>', {'Content-Type': 'application/xml'})
+            return None, None
+        data = self.objects.get(name)
+        if data is None:
+            handler.reply(404, b'<Error><Code>NoSuchKey</Code><Message>No such key</Message>'
+                               b'</Error>', {'Content-Type': 'application/xml'})
+            return None, None
+        return data, '"%s"' % hashlib.md5(data).hexdigest()
+
+    def do_HEAD(self, handler):
+        """Object identity"""
+        data, etag = self._object(handler)
+        if data is not None:
+            handler.send_response(200)
+            handler.send_header('ETag', etag)
+            handler.send_header('Content-Length', str(len(data)))
+            handler.end_headers()
+
+    def do_GET(self, handler):
+        """Object content, unless it matches If-None-Match"""
+        data, etag = self._object(handler)
+        if data is None:
+            return
+        if handler.headers.get('If-None-Match') == etag:
+            handler.reply(304, headers={'ETag': etag})
+            return
+        handler.reply(200, data, {'ETag': etag})
+
+
+class FakeDynamoDB(FakeServer):
+    """GetItem of the lock table of the S3 backend.
+    :attr dict locks: lock info by LockID, as terraform writes it"""
+
+    def __init__(self):
+        super().__init__()
+        self.locks = dict()
+
+    def do_POST(self, handler):
+        """DynamoDB json api"""
+        request = json.loads(handler.rfile.read(int(handler.headers['Content-Length'])))
+        if handler.headers.get('X-Amz-Target') != 'DynamoDB_20120810.GetItem':
+            handler.reply(400, b'{"__type": "UnknownOperationException"}')
+            return
+        lock_id = request['Key']['LockID']['S']
+        body = dict()
+        if lock_id in self.locks:
+            body['Item'] = {'LockID': {'S': lock_id},
+                            'Info': {'S': json.dumps(self.locks[lock_id])}}
+        handler.reply(200, json.dumps(body).encode(),
+                      {'Content-Type': 'application/x-amz-json-1.0'})
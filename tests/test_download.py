@@ -0,0 +1,60 @@
+"""Download engine: resume, checksum verification, retries"""
+import hashlib
+
+import pytest
+
+from pyterraform.terraform import download as download_
+from pyterraform.terraform.download import download, sha256sums, DownloadError
+
+ARCHIVE = '/terraform/0.12.21/terraform_0.12.21_linux_amd64.zip'
+# several chunks, so that a cut download has some complete ones to resume from
+DATA = bytes(range(256)) * 3 * 2**12  # 3 chunks
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download_, 'BACKOFF', 0)
+
+
+def test_sha256sums(releases):
+    releases.files['/SHA256SUMS'] = b'ABC123  terraform.zip\ndef456 *other.zip\n\n'
+    assert sha256sums(releases.url + '/SHA256SUMS') == {'terraform.zip': 'abc123',
+                                                        'other.zip': 'def456'}
+    assert sha256sums(releases.url + '/missing') is None
+
+
+def test_download_verified(releases, tmp_path):
+    releases.files[ARCHIVE] = DATA
+    dest = tmp_path / 'terraform.zip'
+    download(releases.url + ARCHIVE, dest, hashlib.sha256(DATA).hexdigest())
+    assert dest.read_bytes() == DATA
+    assert not (tmp_path / 'terraform.zip.part').exists()
+    # already there: not downloaded again
+    download(releases.url + ARCHIVE, dest, hashlib.sha256(DATA).hexdigest())
+    assert len(releases.requests) == 1
+
+
+def test_download_resumed(releases, tmp_path):
+    releases.files[ARCHIVE] = DATA
+    releases.cut.add(ARCHIVE)
+    dest = tmp_path / 'terraform.zip'
+    download(releases.url + ARCHIVE, dest, hashlib.sha256(DATA).hexdigest())
+    assert dest.read_bytes() == DATA
+    assert 'Range' not in releases.requests[0]['headers']
+    offset = int(releases.requests[1]['headers']['Range'][len('bytes='):-1])
+    assert 0 < offset <= len(DATA) // 2
+
+
+def test_download_checksum_mismatch(releases, tmp_path):
+    releases.files[ARCHIVE] = DATA
+    dest = tmp_path / 'terraform.zip'
+    with pytest.raises(DownloadError, match='Checksum mismatch'):
+        download(releases.url + ARCHIVE, dest, '0' * 64)
+    assert not dest.exists()
+    assert not (tmp_path / 'terraform.zip.part').exists()
+
+
+def test_download_not_found_is_not_retried(releases, tmp_path):
+    with pytest.raises(DownloadError, match='404'):
+        download(releases.url + ARCHIVE, tmp_path / 'terraform.zip')
+    assert len(releases.requests) == 1
@@ -0,0 +1,152 @@
+"""Content-addressed module store: hits, misses and partial stores"""
+import json
+import threading
+
+import pytest
+
+from pyterraform.terraform.module_store import ModuleStore, pinned, tree_digest
+
+VPC = 'git::https://example.com/vpc.git?ref=v1.0.0'
+SUBNET = 'git::https://example.com/subnet.git?ref=v2.0.0'
+SG = 'acme/sg/aws'
+CALLS = {'vpc': {'source': VPC, 'version': None},
+         'sg': {'source': SG, 'version': '2.0.0'},
+         'app': {'source': './app', 'version': None},
+         'latest': {'source': 'acme/db/aws', 'version': '~> 1.0'}}
+
+
+def fetch(stack, names=('vpc', 'sg')):
+    """Install modules like terraform init: folders and modules.json records.
+    The registry module is extracted into a sub folder; vpc has a remote child."""
+    modules = stack / '.terraform' / 'modules'
+    manifest = modules / 'modules.json'
+    records = json.loads(manifest.read_text())['Modules'] if manifest.exists() \
+        else [{'Key': '', 'Source': '', 'Dir': '.'}]
+    installed = {'vpc': [('vpc', VPC, None, 'vpc', {'main.tf': 'module "subnet" {}'}),
+                         ('vpc.subnet', SUBNET, None, 'vpc.subnet', {'main.tf': 'subnet'})],
+                 'sg': [('sg', SG, '2.0.0', 'sg/terraform-aws-sg-2.0.0', {'main.tf': 'sg'})]}
+    for name in names:
+        for key, source, version, folder, files in installed[name]:
+            for path, text in files.items():
+                (modules / folder / path).parent.mkdir(parents=True, exist_ok=True)
+                (modules / folder / path).write_text(text)
+            records = [x for x in records if x['Key'] != key]
+            records.append(dict({'Key': key, 'Source': source,
+                                 'Dir': f'.terraform/modules/{folder}'},
+                                **({'Version': version} if version else {})))
+    manifest.write_text(json.dumps({'Modules': records}))
+
+
+def records(stack):
+    """modules.json records of a stack, by key"""
+    manifest = stack / '.terraform' / 'modules' / 'modules.json'
+    return {x['Key']: x for x in json.loads(manifest.read_text())['Modules']}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ModuleStore(tmp_path / 'modules' / '.store')
+
+
+@pytest.fixture
+def stacks(tmp_path):
+    """Folders of two stacks using the same modules"""
+    folders = [tmp_path / 'net' / env for env in ('dev', 'prod')]
+    for folder in folders:
+        folder.mkdir(parents=True)
+    return folders
+
+
+def init(store, stack, names=('vpc', 'sg')):
+    """terraform init of a stack with the store, fetching the given missing modules"""
+    modules = stack / '.terraform' / 'modules'
+    with store.init(stack, modules, CALLS):
+        fetch(stack, [x for x in names if not (modules / x).is_symlink()])
+    store.harvest(stack, modules, CALLS)
+
+
+def test_pinned():
+    assert pinned(VPC, None)
+    assert pinned(SG, '2.0.0') and pinned(SG, '= v2.0.0')
+    assert not pinned(SG, '~> 2.0') and not pinned(SG, None)
+    assert not pinned('git::https://example.com/vpc.git', None)
+    assert not pinned('./app', None) and not pinned('../shared', None)
+
+
+def test_tree_digest(tmp_path):
+    for name in ('a', 'b'):
+        (tmp_path / name / 'sub').mkdir(parents=True)
+        (tmp_path / name / 'sub' / 'main.tf').write_text('x')
+    assert tree_digest(tmp_path / 'a') == tree_digest(tmp_path / 'b')
+    (tmp_path / 'b' / 'sub' / 'main.tf').chmod(0o755)
+    assert tree_digest(tmp_path / 'a') != tree_digest(tmp_path / 'b')
+
+
+def test_miss_stores_fetched_modules(store, stacks):
+    init(store, stacks[0])
+    modules = stacks[0] / '.terraform' / 'modules'
+    for key in ('vpc', 'vpc.subnet', 'sg'):
+        assert (modules / key).is_symlink()
+        assert (modules / key).resolve().parent == (store.folder / 'trees').resolve()
+    assert (stacks[0] / records(stacks[0])['sg']['Dir'] / 'main.tf').read_text() == 'sg'
+    assert store.stats()['modules'] == 2
+    assert store.stats()['trees'] == 3
+
+
+def test_hit_links_stored_modules(store, stacks):
+    init(store, stacks[0])
+    modules = stacks[1] / '.terraform' / 'modules'
+    with store.init(stacks[1], modules, CALLS):
+        # before terraform runs: linked and recorded, nothing left to fetch
+        found = records(stacks[1])
+        assert set(found) == {'', 'vpc', 'vpc.subnet', 'sg'}
+        assert found['sg']['Version'] == '2.0.0'
+        assert (stacks[1] / found['sg']['Dir'] / 'main.tf').read_text() == 'sg'
+        assert (stacks[1] / found['vpc.subnet']['Dir'] / 'main.tf').read_text() == 'subnet'
+    assert records(stacks[1]) == records(stacks[0])
+    assert store.stats()['trees'] == 3
+
+
+def test_partial_store_is_fetched_again(store, stacks):
+    init(store, stacks[0])
+    subnet = (stacks[0] / '.terraform' / 'modules' / 'vpc.subnet').resolve()
+    for path in sorted(subnet.rglob('*'), reverse=True):
+        path.unlink()
+    subnet.rmdir()  # a tree of vpc is missing: vpc must be fetched, sg is still linked
+    modules = stacks[1] / '.terraform' / 'modules'
+    with store.init(stacks[1], modules, CALLS):
+        assert (modules / 'sg').is_symlink()
+        assert not (modules / 'vpc').exists()
+        fetch(stacks[1], ['vpc'])
+    store.harvest(stacks[1], modules, CALLS)
+    assert (modules / 'vpc.subnet').is_symlink()
+    assert (stacks[1] / records(stacks[1])['vpc.subnet']['Dir'] / 'main.tf').read_text() \
+        == 'subnet'
+
+
+def test_missing_module_fetched_once(store, stacks):
+    """A stack waits for the init fetching a module it misses, then links it"""
+    first_in, first_out, fetched = threading.Event(), threading.Event(), list()
+
+    def first():
+        modules = stacks[0] / '.terraform' / 'modules'
+        with store.init(stacks[0], modules, CALLS):
+            first_in.set()
+            first_out.wait(5)
+            fetch(stacks[0])
+            fetched.append('first')
+        store.harvest(stacks[0], modules, CALLS)
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    first_in.wait(5)
+    second = threading.Thread(target=init, args=(store, stacks[1]))
+    second.start()
+    second.join(0.3)
+    assert second.is_alive()  # waiting for the modules being fetched
+    first_out.set()
+    thread.join(5)
+    second.join(5)
+    assert fetched == ['first']
+    assert all((stacks[1] / '.terraform' / 'modules' / key).is_symlink()
+               for key in ('vpc', 'vpc.subnet', 'sg'))
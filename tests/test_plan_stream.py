@@ -0,0 +1,40 @@
+"""Plan output processing, with lines completed after a prompt"""
+import gzip
+import io
+import sys
+
+from pyterraform import engine
+from pyterraform.terraform.plan_stream import PlanStream
+
+
+def stream_to(tmp_path, filters=()):
+    """Plan stream writing into a buffer, with its tee file"""
+    stream = PlanStream(tee_file=tmp_path / 'plan.log.gz', filters=filters, live=False)
+    stream.start()
+    stream._out = io.BytesIO()  # pylint: disable=protected-access
+    return stream
+
+
+def test_partial_lines_counted_once(tmp_path):
+    stream = stream_to(tmp_path, ['strip_refresh'])
+    stream.feed(b'  # aws_instance.a will be created\n')
+    stream.feed(b'  # aws_instance.b will', partial=True)
+    stream.feed(b' be created\n')
+    stream.feed(b'aws_instance.c: Refreshing state...\n')
+    stream.feed(b'Enter a value: ', partial=True)
+    output = stream._out.getvalue()  # pylint: disable=protected-access
+    assert stream.finish() == {'add': 2, 'change': 0, 'destroy': 0}
+    expected = b'  # aws_instance.a will be created\n  # aws_instance.b will be created\n'
+    assert output == expected + b'Enter a value: '
+    assert gzip.open(tmp_path / 'plan.log.gz').read() == \
+        expected + b'aws_instance.c: Refreshing state...\nEnter a value: '
+
+
+def test_engine_flushes_prompts_as_partial():
+    script = ('import sys, time; sys.stdout.write("Enter a value: "); sys.stdout.flush(); '
+              'time.sleep(1); print("yes"); print("done")')
+    lines = list()
+    job = engine.Job([sys.executable, '-c', script], interactive=True, capture_stderr=False,
+                     on_line=lambda _job, _name, line, partial: lines.append((line, partial)))
+    assert engine.run(job) == 0
+    assert lines == [(b'Enter a value: ', True), (b'yes\n', False), (b'done\n', False)]
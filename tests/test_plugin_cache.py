@@ -0,0 +1,46 @@
+"""Plugin cache shared by concurrent inits through private views"""
+import os
+from pathlib import Path
+
+from pyterraform.terraform.plugin_cache import PluginCache
+
+AWS = 'registry.terraform.io/hashicorp/aws/3.0.0/linux_amd64'
+NULL = 'registry.terraform.io/hashicorp/null/2.1.0/linux_amd64'
+BINARY = 'terraform-provider-{}'
+
+
+def install(cache_dir, data_dir, name, provider, link_folder):
+    """Install a provider like terraform init does with a plugin cache: download it into
+    the cache if missing, then link it from the data dir, the folder of the package
+    (terraform >= 0.14) or the binary (0.13)"""
+    cached = Path(cache_dir) / provider
+    if not (cached / BINARY.format(name)).exists():
+        cached.mkdir(parents=True)
+        (cached / BINARY.format(name)).write_bytes(name.encode() * 1000)
+    installed = data_dir / 'providers' / provider
+    installed.parent.mkdir(parents=True, exist_ok=True)
+    if link_folder:
+        installed.symlink_to(cached, target_is_directory=True)
+    else:
+        installed.mkdir()
+        (installed / BINARY.format(name)).symlink_to(cached / BINARY.format(name))
+
+
+def test_providers_resolve_after_the_view_is_removed(tmp_path):
+    cache = PluginCache(tmp_path / 'cache')
+    for stack, link_folder in (('dev', True), ('prod', False)):
+        data_dir = tmp_path / stack / '.terraform'
+        env = dict()
+        with cache.init(data_dir, env):
+            view = env['TF_PLUGIN_CACHE_DIR']
+            assert Path(view).parent == cache.folder
+            install(view, data_dir, 'aws', AWS, link_folder)
+            install(view, data_dir, 'null', NULL, link_folder)
+        assert not os.path.exists(view)
+        for name, provider in (('aws', AWS), ('null', NULL)):
+            binary = data_dir / 'providers' / provider / BINARY.format(name)
+            assert binary.read_bytes() == name.encode() * 1000
+            assert str(binary.resolve()).startswith(str(cache.folder.resolve()))
+    stats = cache.stats()
+    assert stats['providers'] == 2
+    assert (stats['hits'], stats['misses']) == (2, 2)
@@ -0,0 +1,90 @@
+"""Version constraints and release index of github repositories"""
+import pytest
+import requests
+
+from pyterraform import constants as const
+from pyterraform.terraform.releases import Version, Constraint, ReleaseIndex, parse_constraint
+
+TAGS = ['v2.1.0', 'v2.0.1', 'v2.0.0', 'v1.5.3', 'v1.5.0', 'v1.4.9', 'v2.2.0-beta1', 'nightly']
+
+
+def test_version_order():
+    assert Version('1.2.3-beta1') < Version('1.2.3') < Version('v1.2.10') < Version('2')
+    assert Version('v1.2') == Version('1.2.0')
+    with pytest.raises(ValueError):
+        Version('latest')
+
+
+@pytest.mark.parametrize('constraint, expected', [
+    ('2.0.1', 'v2.0.1'),
+    ('= 1.5.0', 'v1.5.0'),
+    ('>= 1.5, < 2.0', 'v1.5.3'),
+    ('~> 1.4', 'v1.5.3'),
+    ('~> 1.4.0', 'v1.4.9'),
+    ('~> 2.0.0, != 2.0.1', 'v2.0.0'),
+    ('> 2.1.0', None),
+    ('>= 2.2.0-beta1', 'v2.2.0-beta1'),
+])
+def test_constraint_resolve(constraint, expected):
+    assert Constraint(constraint).resolve(TAGS) == expected
+
+
+def test_bare_minor_takes_latest_patch():
+    assert parse_constraint('1.5').resolve(TAGS) == 'v1.5.3'
+    assert parse_constraint('v2.0').resolve(TAGS) == 'v2.0.1'
+    assert parse_constraint('1.5.0').resolve(TAGS) == 'v1.5.0'
+
+
+def test_invalid_constraint():
+    with pytest.raises(ValueError):
+        Constraint('>> 1.0')
+
+
+def _api_calls(server):
+    return [x for x in server.requests if x['path'].startswith('/repos/')]
+
+
+def test_index_pages_and_drafts(releases, tmp_path):
+    for tag in ('v1.0.0', 'v1.1.0', 'v1.2.0', 'v1.3.0'):
+        releases.add_release('acme/terraform-provider-x', tag)
+    releases.add_release('acme/terraform-provider-x', 'v2.0.0', draft=True)
+    index = ReleaseIndex('acme/terraform-provider-x', cache_dir=tmp_path)
+    assert index.tags == ['v1.3.0', 'v1.2.0', 'v1.1.0', 'v1.0.0']
+    assert len(_api_calls(releases)) == 3  # pages of 2 releases
+    assert index.resolve('~> 1.1') == 'v1.3.0'
+
+
+def test_index_reused_within_ttl(releases, tmp_path):
+    releases.add_release('acme/terraform-provider-x', 'v1.0.0')
+    ReleaseIndex('acme/terraform-provider-x', cache_dir=tmp_path).resolve('1.0')
+    releases.add_release('acme/terraform-provider-x', 'v1.0.1')
+    assert ReleaseIndex('acme/terraform-provider-x', cache_dir=tmp_path).resolve('1.0') \
+        == 'v1.0.0'
+    assert len(_api_calls(releases)) == 1
+
+
+def test_index_revalidated_after_ttl(releases, tmp_path):
+    releases.add_release('acme/terraform-provider-x', 'v1.0.0')
+    index = ReleaseIndex('acme/terraform-provider-x', cache_dir=tmp_path, ttl=0)
+    assert index.resolve('1.0') == 'v1.0.0'
+    assert index.resolve('1.0') == 'v1.0.0'  # not modified
+    calls = _api_calls(releases)
+    assert 'If-None-Match' not in calls[0]['headers']
+    assert 'If-None-Match' in calls[1]['headers']
+    releases.add_release('acme/terraform-provider-x', 'v1.0.1')
+    assert index.resolve('1.0') == 'v1.0.1'
+
+
+def test_index_unknown_repository(releases, tmp_path):
+    with pytest.raises(ValueError):
+        ReleaseIndex('acme/missing', cache_dir=tmp_path).tags
+
+
+def test_index_outdated_when_offline(releases, tmp_path, monkeypatch):
+    releases.add_release('acme/terraform-provider-x', 'v1.0.0')
+    ReleaseIndex('acme/terraform-provider-x', cache_dir=tmp_path).resolve('1.0')
+    monkeypatch.setattr(const, 'GITHUB_API', 'http://127.0.0.1:9')
+    assert ReleaseIndex('acme/terraform-provider-x', cache_dir=tmp_path, ttl=0).resolve('1.0') \
+        == 'v1.0.0'
+    with pytest.raises(requests.RequestException):
+        ReleaseIndex('acme/terraform-provider-y', cache_dir=tmp_path, ttl=0).resolve('1.0')
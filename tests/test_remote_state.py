@@ -0,0 +1,125 @@
+"""Outputs read from the remote state, and the streaming JSON reader behind it"""
+import io
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from pyterraform import constants as const
+from pyterraform.json_stream import read_members
+from pyterraform.terraform import Command
+from pyterraform.remote_state import RemoteState, read_many, format_outputs
+
+BACKEND = {'bucket': 'states', 'key': 'app/prod/terraform.tfstate'}
+
+
+def state(serial, outputs, lineage='l1'):
+    """State document, with resources after the outputs as terraform writes them"""
+    return json.dumps({'version': 4, 'terraform_version': '0.12.21', 'serial': serial,
+                       'lineage': lineage, 'outputs': outputs,
+                       'resources': [{'name': f'r{x}', 'attributes': {'id': 'x' * 100}}
+                                     for x in range(1000)]}, indent=2).encode()
+
+
+class Reads(io.BytesIO):
+    """Stream counting the bytes read"""
+    consumed = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.consumed += len(data)
+        return data
+
+
+def test_read_members_stops_early():
+    document = state(3, {'name': {'value': 'a "quoted" {name}', 'type': 'string'}})
+    stream = Reads(document)
+    found = read_members(stream, ('serial', 'outputs', 'lineage'), chunk_size=64)
+    assert found == {'serial': 3, 'lineage': 'l1',
+                     'outputs': {'name': {'value': 'a "quoted" {name}', 'type': 'string'}}}
+    assert stream.consumed < len(document) / 10
+
+
+@pytest.mark.parametrize('document', [
+    '{}', '{"a": [1, {"b": "]}"}], "outputs": {"x": null}}', '{"a":1,"outputs":{"x":"\\u00e9"}}'])
+def test_read_members_documents(document):
+    expected = {key: value for key, value in json.loads(document).items() if key == 'outputs'}
+    assert read_members(io.BytesIO(document.encode()), ('outputs',), chunk_size=3) == expected
+
+
+def test_read_members_truncated():
+    with pytest.raises(ValueError):
+        read_members(io.BytesIO(b'{"a": [1, 2'), ('outputs',))
+
+
+def test_outputs_revalidated(s3, project):
+    s3.objects['states/app/prod/terraform.tfstate'] = state(1, {'ip': {'value': '10.0.0.1'}})
+    remote = RemoteState(project, BACKEND)
+    first = remote.outputs()
+    assert first['serial'] == 1 and first['outputs'] == {'ip': {'value': '10.0.0.1'}}
+    assert remote.outputs() == first
+    assert s3.requests[-1]['headers']['If-None-Match'] == f'"{first["etag"]}"'
+    s3.objects['states/app/prod/terraform.tfstate'] = state(2, {'ip': {'value': '10.0.0.2'}})
+    assert RemoteState(project, BACKEND).outputs()['outputs']['ip']['value'] == '10.0.0.2'
+
+
+def test_outputs_missing_state(s3, project):  # pylint: disable=unused-argument
+    assert RemoteState(project, BACKEND).outputs() is None
+    assert RemoteState(project, {}).outputs() is None
+    assert RemoteState(project, BACKEND).head() is None
+
+
+@pytest.fixture
+def output(project, monkeypatch):
+    """pyterraform output of the stack, with the terraform runs it falls back to"""
+    runs = list()
+    project.input = SimpleNamespace(args={'tf_params': ['-json']})
+    project.cfg = SimpleNamespace(stack=SimpleNamespace(backend=BACKEND),
+                                  context_for=lambda command: (list(), dict()))
+    monkeypatch.setattr(Command, '_run_terraform',
+                        lambda self, *args, **kwargs: runs.append(args) or const.RC_OK)
+    return lambda: (Command(project).output(), runs)
+
+
+def test_output_from_remote_state(s3, output, capsys):
+    s3.objects['states/app/prod/terraform.tfstate'] = state(1, {'ip': {'value': '10.0.0.1'}})
+    assert output() == (const.RC_OK, [])
+    assert json.loads(capsys.readouterr().out)['ip']['value'] == '10.0.0.1'
+
+
+@pytest.mark.parametrize('failure', ['denied', 'invalid', 'truncated'])
+def test_output_falls_back_to_terraform(s3, output, failure):
+    name = 'states/app/prod/terraform.tfstate'
+    s3.objects[name] = {'denied': state(1, {}), 'invalid': b'<html>proxy error</html>',
+                        'truncated': state(1, {'ip': {'value': '10.0.0.1'}})[:50]}[failure]
+    if failure == 'denied':
+        s3.denied.add(name)
+    assert output() == (const.RC_OK, [('output',)])
+
+
+def test_output_unreachable_state(monkeypatch, output):
+    monkeypatch.setattr(const, 'S3_ENDPOINT', 'http://127.0.0.1:9')
+    assert output() == (const.RC_OK, [('output',)])
+
+
+def test_read_many(s3, project):
+    for stack in ('app', 'db'):
+        s3.objects[f'states/{stack}/prod/terraform.tfstate'] = state(
+            1, {'name': {'value': stack}})
+    backends = {f'{stack}_prod': {'bucket': 'states', 'key': f'{stack}/prod/terraform.tfstate'}
+                for stack in ('app', 'db', 'web')}
+    found = read_many(project, backends, workers=3)
+    assert found['app_prod']['outputs']['name']['value'] == 'app'
+    assert found['db_prod']['outputs']['name']['value'] == 'db'
+    assert found['web_prod'] is None
+
+
+def test_format_outputs():
+    outputs = {'ip': {'value': '10.0.0.1'}, 'ports': {'value': [80, 443]},
+               'pw': {'value': 'secret', 'sensitive': True}}
+    assert format_outputs(outputs) == (
+        const.RC_OK, 'ip = 10.0.0.1\nports = [\n  80,\n  443\n]\npw = <sensitive>')
+    assert format_outputs(outputs, 'pw') == (const.RC_OK, 'secret')
+    assert format_outputs(outputs, 'missing')[0] == const.RC_KO
+    assert json.loads(format_outputs(outputs, as_json=True)[1])['pw'] == \
+        {'sensitive': True, 'type': None, 'value': 'secret'}
@@ -0,0 +1,103 @@
+"""State lock checks against a local DynamoDB stand-in, and requeue of locked stacks"""
+import sys
+import time
+from types import SimpleNamespace
+
+from pyterraform import engine
+from pyterraform import constants as const
+from pyterraform import state_lock
+from pyterraform.state_lock import StateLock, backoff, describe
+from pyterraform.terraform import Command
+
+BACKEND = {'bucket': 'states', 'key': 'app/prod/terraform.tfstate', 'dynamodb_table': 'locks'}
+LOCK = {'ID': 'a1b2', 'Who': 'alice@laptop', 'Operation': 'OperationTypeApply',
+        'Created': '2026-01-02T03:04:05.123456Z'}
+
+
+def test_backoff_is_jittered_and_capped():
+    for attempt in range(10):
+        delays = [backoff(attempt, base=5, cap=60) for _ in range(200)]
+        assert 0 <= min(delays) and max(delays) <= min(60, 5 * 2 ** attempt)
+        assert len(set(delays)) > 1
+
+
+def test_describe():
+    text = describe({'id': 'a1b2', 'who': 'alice@laptop', 'operation': 'OperationTypeApply',
+                     'created': '2026-01-02T03:04:05.123456Z'})
+    assert 'alice@laptop' in text and 'OperationTypeApply' in text and 'a1b2' in text
+    assert 'min ago' in text
+    assert 'unknown' in describe({})
+
+
+def test_holder(dynamodb, project):
+    lock = StateLock(project, BACKEND)
+    assert lock.holder() is None
+    dynamodb.locks['states/app/prod/terraform.tfstate'] = LOCK
+    assert lock.holder() == {'id': 'a1b2', 'who': 'alice@laptop',
+                             'operation': 'OperationTypeApply', 'created': LOCK['Created']}
+
+
+def test_no_lock_table(dynamodb, project):
+    assert StateLock(project, dict(BACKEND, dynamodb_table=None)).holder() is None
+    assert not dynamodb.requests
+
+
+def test_unreachable_table_is_not_locked(monkeypatch, project):
+    monkeypatch.setattr(const, 'DYNAMODB_ENDPOINT', 'http://127.0.0.1:9')
+    start = time.time()
+    assert StateLock(project, BACKEND).holder() is None
+    assert time.time() - start < 10
+
+
+def test_wait(dynamodb, project, monkeypatch):
+    dynamodb.locks['states/app/prod/terraform.tfstate'] = LOCK
+    lock = StateLock(project, BACKEND)
+    assert not lock.wait(0)
+    assert len(dynamodb.requests) == 1
+    sleeps = list()
+
+    def sleep(delay):
+        sleeps.append(delay)
+        if len(sleeps) == 3:
+            del dynamodb.locks['states/app/prod/terraform.tfstate']
+
+    monkeypatch.setattr(state_lock.time, 'sleep', sleep)
+    assert lock.wait(900)
+    assert len(sleeps) == 3
+    assert all(0 <= delay <= 60 for delay in sleeps)
+
+
+def test_single_stack_fails_fast(dynamodb, project, monkeypatch):
+    """Like terraform, a single stack only waits for its lock when asked to"""
+    dynamodb.locks['states/app/prod/terraform.tfstate'] = LOCK
+    settings = {'config.state_lock_check': True, 'config.state_lock_wait': 900}
+    project.cfg = SimpleNamespace(stack=SimpleNamespace(backend=BACKEND),
+                                  pyt=SimpleNamespace(get=settings.get))
+    project.input = SimpleNamespace(environment=dict())
+    monkeypatch.setattr(Command, '_tf_bin', 'terraform')
+    sleeps, sleep = list(), time.sleep
+    monkeypatch.setattr(state_lock.time, 'sleep',
+                        lambda delay: sleeps.append(delay) or sleep(delay))
+    command = Command(project)
+    assert command._run_terraform('plan') == const.RC_LOCKED  # pylint: disable=protected-access
+    assert not sleeps and len(dynamodb.requests) == 1
+    assert command._state_unlocked(['-lock=false'])  # pylint: disable=protected-access
+    assert 'init' not in state_lock.LOCKING_COMMANDS
+    project.input.environment[const.LOCK_WAIT_ENV] = '1'
+    assert command._run_terraform('plan') == const.RC_LOCKED  # pylint: disable=protected-access
+    assert sleeps and sum(sleeps) <= 1
+
+
+def test_engine_requeues_locked_jobs(tmp_path):
+    """A job exiting as locked runs again, until it succeeds"""
+    script = ('import os, sys; open(os.environ["F"], "a").write("x"); '
+              'sys.exit(3 if len(open(os.environ["F"]).read()) < int(os.environ["N"]) else 0)')
+
+    def retry(job):
+        return 0.01 if job.returncode == const.RC_LOCKED and job.attempts < 5 else None
+
+    jobs = [engine.Job([sys.executable, '-c', script], on_line=lambda *_: None,
+                       env={'N': str(count), 'F': str(tmp_path / str(count))})
+            for count in (1, 3)]
+    engine.Engine(parallel=1, retry=retry).run(jobs)
+    assert [(job.returncode, job.attempts) for job in jobs] == [(0, 1), (0, 3)]